@@ -0,0 +1,133 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Background jobs for the gridcentric actions.
+
+The actions are submitted to the gridcentric API from a background thread,
+so that the request that asked for them returns right away. The page then
+follows the progress of the job (and the status of its instances) through
+the job view.
+
+The jobs are kept in the Django cache, so that any of the dashboard's
+processes can report on a job that another one started. Deployments with
+more than one process need a shared cache backend (e.g. memcached).
+"""
+
+import logging
+import threading
+import time
+import uuid
+
+from django.core.cache import cache
+
+LOG = logging.getLogger(__name__)
+
+# The number of seconds a finished job can still be looked up for.
+JOB_TTL = 300
+# The number of seconds an unfinished job is kept for.
+JOB_TIMEOUT = 3600
+
+def _key(job_id):
+    return 'gridcentric-job-%s' % job_id
+
+class Job(object):
+
+    def __init__(self, tenant_id, user_id, action, instance_ids, params=None):
+        self.id = uuid.uuid4().hex
+        self.tenant_id = tenant_id
+        self.user_id = user_id
+        self.action = action
+        self.params = params or {}
+        self.state = 'pending'
+        self.finished = None
+        # Whether the page has been told that the job is done.
+        self.reported = False
+        self.items = [{'id': instance_id,
+                       'state': 'pending',
+                       'message': None,
+                       'servers': []} for instance_id in instance_ids]
+
+    @classmethod
+    def load(cls, job_id):
+        """ Returns the job stored in the cache, or None. """
+        state = cache.get(_key(job_id))
+        if state == None:
+            return None
+        job = cls.__new__(cls)
+        job.__dict__.update(state)
+        return job
+
+    def save(self):
+        """ Stores the job in the cache. """
+        timeout = self.finished == None and JOB_TIMEOUT or JOB_TTL
+        cache.set(_key(self.id), dict(self.__dict__), timeout)
+
+    def run(self, client):
+        """ Submits the actions as one bulk request and records their results. """
+        self.state = 'running'
+        self.save()
+        try:
+            results = client.bulk_action([{'id': item['id'],
+                                           'action': self.action,
+                                           'params': self.params} for item in self.items],
+                                         view='summary')
+            for item, result in zip(self.items, results):
+                if result.get('status') == 'ok':
+                    item['state'] = 'submitted'
+                    item['servers'] = [server['id'] for server in result.get('servers', [])]
+                else:
+                    item['state'] = 'error'
+                    item['message'] = (result.get('error') or {}).get('message')
+        except Exception, e:
+            LOG.exception("Gridcentric job %s failed." % self.id)
+            for item in self.items:
+                if item['state'] == 'pending':
+                    item['state'] = 'error'
+                    item['message'] = str(e)
+        self.state = 'done'
+        self.finished = time.time()
+        self.save()
+
+    def instance_ids(self):
+        """ The instances the job acts on, and the instances it created. """
+        ids = []
+        for item in self.items:
+            ids.append(item['id'])
+            ids.extend(item['servers'])
+        return ids
+
+    def to_dict(self):
+        return {'id': self.id,
+                'action': self.action,
+                'state': self.state,
+                'items': self.items}
+
+def submit(request, client, action, instance_ids, params=None):
+    """ Starts a job that runs action on each of the instances. Returns the job. """
+    job = Job(request.user.tenant_id, request.user.id, action, instance_ids, params=params)
+    job.save()
+    thread = threading.Thread(target=job.run, args=(client,))
+    thread.daemon = True
+    thread.start()
+    return job
+
+def get(request, job_id):
+    """ Returns the job, or None if it does not exist or belongs to another user. """
+    job = Job.load(job_id)
+    if job == None or job.tenant_id != request.user.tenant_id or \
+       job.user_id != request.user.id:
+        return None
+    return job
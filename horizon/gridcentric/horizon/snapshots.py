@@ -0,0 +1,112 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Short-lived, per-tenant snapshots of the instances shown in the panel.
+
+A snapshot is built from one server list and one flavor list. It holds the
+lineage of every instance (what it was blessed or launched from), so that the
+row actions and the row updates do not have to go back to nova for each
+instance.
+"""
+
+import threading
+import time
+
+from django.conf import settings
+from django.utils.datastructures import SortedDict
+
+from horizon import api
+
+# The number of seconds a snapshot is reused for.
+SNAPSHOT_TTL = getattr(settings, 'GRIDCENTRIC_SNAPSHOT_TTL', 5)
+
+class Snapshot(object):
+
+    def __init__(self, instances, flavors):
+        self.created = time.time()
+        self.instances = SortedDict([(instance.id, instance) for instance in instances])
+        self.flavors = SortedDict([(str(flavor.id), flavor) for flavor in flavors])
+
+        # The instances blessed from (and launched from) each instance.
+        self.blessed = {}
+        self.launched = {}
+        for instance in instances:
+            metadata = getattr(instance, 'metadata', None) or {}
+            if 'blessed_from' in metadata:
+                self.blessed.setdefault(metadata['blessed_from'], []).append(instance.id)
+            if 'launched_from' in metadata:
+                self.launched.setdefault(metadata['launched_from'], []).append(instance.id)
+            self.add_flavor(instance)
+
+    def add_flavor(self, instance):
+        flavor = getattr(instance, 'flavor', None) or {}
+        instance.full_flavor = self.flavors.get(str(flavor.get('id')))
+
+    def expired(self):
+        return time.time() - self.created > SNAPSHOT_TTL
+
+    def get(self, instance_id):
+        return self.instances.get(instance_id)
+
+    def has_launched(self, instance_id):
+        return len(self.launched.get(instance_id, [])) > 0
+
+    def statuses(self, instance_ids=None):
+        """ Returns the status and task of the instances (all of them by default). """
+        if instance_ids == None:
+            instance_ids = self.instances.keys()
+        statuses = {}
+        for instance_id in instance_ids:
+            instance = self.instances.get(instance_id)
+            if instance != None:
+                statuses[instance_id] = {'status': instance.status,
+                                         'task': getattr(instance, 'OS-EXT-STS:task_state', None)}
+        return statuses
+
+_snapshots = {}
+_lock = threading.Lock()
+# The lock held while a tenant's snapshot is being loaded, by tenant.
+_loading = {}
+
+def load(request):
+    """ Builds a new snapshot for the request's tenant. """
+    snapshot = Snapshot(api.server_list(request), api.flavor_list(request))
+    with _lock:
+        _snapshots[request.user.tenant_id] = snapshot
+    return snapshot
+
+def get(request):
+    """
+    Returns the snapshot of the request's tenant, loading one if it has
+    expired. Only one request per tenant loads it, the others wait for it.
+    """
+    tenant_id = request.user.tenant_id
+    with _lock:
+        snapshot = _snapshots.get(tenant_id)
+        if snapshot != None and not snapshot.expired():
+            return snapshot
+        loading = _loading.setdefault(tenant_id, threading.Lock())
+    with loading:
+        with _lock:
+            snapshot = _snapshots.get(tenant_id)
+        if snapshot == None or snapshot.expired():
+            snapshot = load(request)
+    return snapshot
+
+def invalidate(request):
+    """ Drops the tenant's snapshot (e.g. after an action changed its instances). """
+    with _lock:
+        _snapshots.pop(request.user.tenant_id, None)
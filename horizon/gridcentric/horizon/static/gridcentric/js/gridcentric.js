@@ -0,0 +1,141 @@
+/*
+ * Submits the gridcentric row actions through AJAX and shows the progress of
+ * each instance in its row until the action has been carried out.
+ *
+ * The rows of the instances table are taken out of Horizon's row updates,
+ * which poll every changing row on its own. Instead, the statuses of all the
+ * changing rows are polled with one request, and a row is only fetched again
+ * once its instance is done changing.
+ */
+var gridcentric = {
+  poll_interval: 2000,
+  statuses_url: null,
+
+  csrf_token: function () {
+    var match = document.cookie.match(/(?:^|;\s*)csrftoken=([^;]+)/);
+    return match ? decodeURIComponent(match[1]) : null;
+  },
+
+  row: function (instance_id) {
+    return $('tr[data-object-id="' + instance_id + '"]');
+  },
+
+  show_progress: function (instance_id, text) {
+    var $row = gridcentric.row(instance_id),
+        $progress = $row.find('.gc-progress');
+    if (!$progress.length) {
+      $progress = $('<span class="gc-progress label"></span>');
+      $row.find('td').first().append(' ').append($progress);
+    }
+    $progress.text(text);
+  },
+
+  submit: function ($link) {
+    var instance_id = $link.closest('tr').attr('data-object-id');
+    gridcentric.show_progress(instance_id, 'Submitting...');
+    $.ajax({
+      url: $link.attr('href'),
+      type: 'POST',
+      dataType: 'json',
+      headers: {'X-CSRFToken': gridcentric.csrf_token()},
+      success: function (data) {
+        gridcentric.poll(data.url);
+      },
+      error: function () {
+        gridcentric.show_progress(instance_id, 'Failed');
+      }
+    });
+  },
+
+  poll: function (url) {
+    $.ajax({
+      url: url,
+      dataType: 'json',
+      success: function (job) {
+        var reload = false;
+        $.each(job.items, function (index, item) {
+          if (item.state === 'error') {
+            gridcentric.show_progress(item.id, item.message || 'Failed');
+          } else if (job.state === 'done') {
+            var status = (job.statuses || {})[item.id];
+            gridcentric.show_progress(item.id, status ? status.status : 'Submitted');
+            // Launched instances are not in the table yet.
+            reload = reload || item.servers.length > 0;
+          } else {
+            gridcentric.show_progress(item.id, 'Working...');
+          }
+        });
+        if (job.state !== 'done') {
+          setTimeout(function () { gridcentric.poll(url); }, gridcentric.poll_interval);
+        } else if (reload) {
+          window.location.reload();
+        } else {
+          // Let the status polling pick up the new states.
+          $.each(job.items, function (index, item) {
+            gridcentric.row(item.id).addClass('status_unknown');
+          });
+        }
+      }
+    });
+  },
+
+  claim_rows: function () {
+    // Take the rows out of Horizon's per-row updates.
+    $('table#instances tr.ajax-update').each(function () {
+      var $row = $(this);
+      $row.attr('data-gc-update-url', $row.attr('data-update-url'));
+      $row.removeClass('ajax-update');
+    });
+  },
+
+  update_row: function ($row) {
+    $.ajax({
+      url: $row.attr('data-gc-update-url'),
+      success: function (html) {
+        $row.replaceWith(html);
+        gridcentric.claim_rows();
+      }
+    });
+  },
+
+  poll_statuses: function () {
+    var schedule = function () {
+          setTimeout(gridcentric.poll_statuses, gridcentric.poll_interval);
+        },
+        $rows, ids;
+
+    gridcentric.claim_rows();
+    $rows = $('table#instances tr.status_unknown[data-gc-update-url]');
+    if (!gridcentric.statuses_url || !$rows.length) {
+      schedule();
+      return;
+    }
+    ids = $rows.map(function () { return $(this).attr('data-object-id'); }).get();
+    $.ajax({
+      url: gridcentric.statuses_url,
+      data: {ids: ids.join(',')},
+      dataType: 'json',
+      success: function (data) {
+        $rows.each(function () {
+          var $row = $(this),
+              status = data.instances[$row.attr('data-object-id')];
+          // Instances that are gone are rendered (and removed) by the row update.
+          if (!status || status.final) {
+            gridcentric.update_row($row);
+          }
+        });
+      },
+      complete: schedule
+    });
+  }
+};
+
+gridcentric.claim_rows();
+
+$(function () {
+  $(document).on('click', 'a.ajax-gridcentric', function (evt) {
+    evt.preventDefault();
+    gridcentric.submit($(this));
+  });
+  gridcentric.poll_statuses();
+});
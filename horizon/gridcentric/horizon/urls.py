@@ -16,11 +16,13 @@
 from django.conf.urls.defaults import *
 
 from horizon.dashboards.nova.instances_and_volumes.instances import urls as instance_urls
-from .views import GridcentricIndexView, bless, launch, discard
+from .views import GridcentricIndexView, bless, launch, discard, statuses, job
 
 
 urlpatterns = patterns('gridcentric.horizon.views',
     url(r'^$', GridcentricIndexView.as_view(), name='index'),
+    url(r'^statuses/$', statuses, name='statuses'),
+    url(r'^jobs/(?P<job_id>[^/]+)/$', job, name='job'),
     url(r'^instances/', include(instance_urls, namespace='instances')),
     url(instance_urls.INSTANCES % 'bless', bless, name="bless"),
     url(instance_urls.INSTANCES % 'launch', launch, name="launch"),
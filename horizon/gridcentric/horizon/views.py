@@ -16,21 +16,31 @@
 """
 Views for Instances and Volumes.
 """
+import collections
+import json
 import logging
+import threading
 
+from django import http
 from django import shortcuts
+from django.contrib import messages
+from django.core.urlresolvers import reverse
 from django.utils.translation import ugettext_lazy as _
 from django.template.defaultfilters import title
 
 
 from gridcentric.nova.client.client import NovaClient
 
+from horizon import api
+from horizon import exceptions
 import horizon.api.base as api_base
 import horizon.tables.base as base_tables
 import horizon.dashboards.nova.instances_and_volumes.views as views
 import horizon.dashboards.nova.instances_and_volumes.instances.tables as tables
 import horizon.dashboards.nova.instances_and_volumes.instances.urls as instance_urls
 
+from . import jobs
+from . import snapshots
 
 LOG = logging.getLogger(__name__)
 
@@ -38,7 +48,7 @@ class BlessInstance(base_tables.LinkAction):
     name = "gc_bless"
     verbose_name = _("Bless Instance")
     url = "horizon:nova:gridcentric:bless"
-    classes = ("btn-launch",)
+    classes = ("btn-launch", "ajax-gridcentric")
 
     def allowed(self, request, instance=None):
         metadata = instance.metadata
@@ -48,7 +58,7 @@ class LaunchInstance(base_tables.LinkAction):
     name = "gc_launch"
     verbose_name = _("Launch Instance")
     url = "horizon:nova:gridcentric:launch"
-    classes = ("btn-launch",)
+    classes = ("btn-launch", "ajax-gridcentric")
 
     def allowed(self, request, instance=None):
         return instance.status in ["BLESSED"]
@@ -57,11 +67,48 @@ class DiscardInstance(base_tables.LinkAction):
     name = "gc_discard"
     verbose_name = _("Discard Instance")
     url = "horizon:nova:gridcentric:discard"
-    classes = ("btn-terminate", "btn-danger")
+    classes = ("btn-terminate", "btn-danger", "ajax-gridcentric")
 
     def allowed(self, request, instance=None):
-        return instance.status in ["BLESSED"]
+        if instance.status not in ["BLESSED"]:
+            return False
+        # Blessed instances with launched instances cannot be discarded.
+        snapshot = getattr(self.table, 'snapshot', None)
+        return snapshot == None or not snapshot.has_launched(instance.id)
+
+
+class GcBatchAction(base_tables.BatchAction):
+    """
+    Runs a gridcentric action on the selected instances as a background job
+    rather than one call at a time within the request.
+    """
+    gc_action = None
+    data_type_singular = _("Instance")
+    data_type_plural = _("Instances")
+
+    def handle(self, table, request, obj_ids):
+        submit_job(request, self.gc_action, obj_ids)
+        return shortcuts.redirect(self.get_success_url(request))
+
+class BulkLaunchInstances(GcBatchAction):
+    name = "gc_bulk_launch"
+    gc_action = "gc_launch"
+    action_present = _("Launch")
+    action_past = _("Launched")
+    classes = ("btn-launch",)
+
+    def allowed(self, request, instance=None):
+        return instance == None or instance.status in ["BLESSED"]
 
+class BulkDiscardInstances(GcBatchAction):
+    name = "gc_bulk_discard"
+    gc_action = "gc_discard"
+    action_present = _("Discard")
+    action_past = _("Discarded")
+    classes = ("btn-danger",)
+
+    def allowed(self, request, instance=None):
+        return instance == None or instance.status in ["BLESSED"]
 
 class GcTerminateInstance(tables.TerminateInstance):
     name = "gc_terminate"
@@ -71,6 +118,21 @@ class GcTerminateInstance(tables.TerminateInstance):
                 return False
         return super(GcTerminateInstance, self).allowed(request, instance)
 
+class GcUpdateRow(tables.UpdateRow):
+    """
+    Renders a single row. The page polls the statuses of all its rows at
+    once (see statuses) and only asks for a row once its instance is done
+    changing, so the instance is fetched fresh, with the lineage and flavors
+    taken from the tenant's snapshot.
+    """
+
+    def get_data(self, request, instance_id):
+        snapshot = snapshots.get(request)
+        instance = api.server_get(request, instance_id)
+        snapshot.add_flavor(instance)
+        self.table.snapshot = snapshot
+        return instance
+
 class GridcentricInstancesTable(tables.InstancesTable):
 
     STATUS_CHOICES = (
@@ -88,13 +150,15 @@ class GridcentricInstancesTable(tables.InstancesTable):
 
     def __init__(self, *args, **kwargs):
         super(GridcentricInstancesTable, self).__init__(*args, **kwargs)
+        self.snapshot = None
 
     class Meta:
         name = "instances"
         verbose_name = _("Instances")
         status_columns = ["status", "task"]
-        row_class = tables.UpdateRow
-        table_actions = (tables.LaunchLink, tables.TerminateInstance)
+        row_class = GcUpdateRow
+        table_actions = (tables.LaunchLink, BulkLaunchInstances, BulkDiscardInstances,
+                         tables.TerminateInstance)
         row_actions = (BlessInstance, LaunchInstance, DiscardInstance, GcTerminateInstance)
 
         #row_actions = (tables.SnapshotLink, tables.EditInstance, tables.ConsoleLink,
@@ -103,8 +167,48 @@ class GridcentricInstancesTable(tables.InstancesTable):
 
 class GridcentricIndexView(views.IndexView):
     table_classes = (GridcentricInstancesTable,)
-    template_name = "nova/instances_and_volumes/index.html"
-
+    template_name = "gridcentric/index.html"
+
+    def get_instances_data(self):
+        # The instances, their lineage and their flavors all come from one
+        # server list and one flavor list.
+        try:
+            snapshot = snapshots.load(self.request)
+        except:
+            exceptions.handle(self.request, _('Unable to retrieve instances.'))
+            return []
+        self.get_tables()['instances'].snapshot = snapshot
+        return snapshot.instances.values()
+
+# The statuses that a row stops being polled in.
+FINAL_STATUSES = [status for status, final in GridcentricInstancesTable.STATUS_CHOICES]
+
+def statuses(request):
+    """
+    Returns the status and task of the tenant's instances (or only of the
+    instances given by ?ids=<id>,<id>...) as JSON, so that a page can refresh
+    all of its rows with one request. Each instance is also marked final once
+    it is no longer changing.
+    """
+    ids = request.GET.get('ids')
+    if ids:
+        ids = [instance_id for instance_id in ids.split(',') if instance_id]
+    try:
+        result = snapshots.get(request).statuses(ids or None)
+    except:
+        LOG.exception("Unable to retrieve the instance statuses.")
+        return http.HttpResponse(status=503)
+    for status in result.values():
+        status['final'] = (status['status'] or '').lower() in FINAL_STATUSES and \
+                          status['task'] in (None, 'none')
+    return http.HttpResponse(json.dumps({'instances': result}),
+                             mimetype='application/json')
+
+# The clients of the recent users, by token. The clients are thread-safe,
+# so they are shared by all the requests of a user.
+CLIENT_CACHE_SIZE = 100
+_clients = collections.OrderedDict()
+_clients_lock = threading.Lock()
 
 def get_client(request):
     user_id = request.user.id
@@ -112,30 +216,66 @@ def get_client(request):
     auth_token = request.user.token
     management_url = api_base.url_for(request, 'compute')
 
-    client = NovaClient(None, user_id, None, tenant_id)
-    client.auth_token = auth_token
-    client.management_url = management_url
+    key = (user_id, tenant_id, auth_token, management_url)
+    with _clients_lock:
+        client = _clients.pop(key, None)
+        if client == None:
+            client = NovaClient(None, user_id, None, tenant_id)
+            client.auth_token = auth_token
+            client.management_url = management_url
+            if len(_clients) >= CLIENT_CACHE_SIZE:
+                _clients.popitem(last=False)
+        # Keep the most recently used clients at the end.
+        _clients[key] = client
 
     return client
 
-def bless(request, instance_id):
-
-    gc_nova = get_client(request)
-    gc_nova.bless_instance(instance_id)
-
+def submit_job(request, action, instance_ids):
+    job = jobs.submit(request, get_client(request), action, instance_ids)
+    snapshots.invalidate(request)
+    return job
+
+def _submit(request, action, instance_id):
+    """
+    Submits the action as a background job. AJAX requests get the job's URL
+    back, the others are redirected to the index right away.
+    """
+    job = submit_job(request, action, [instance_id])
+    if request.is_ajax():
+        return http.HttpResponse(json.dumps({'job': job.id,
+                                             'url': reverse("horizon:nova:gridcentric:job",
+                                                            args=[job.id])}),
+                                 mimetype='application/json')
+    messages.info(request, _("Submitted the request for instance %s.") % instance_id)
     return shortcuts.redirect("horizon:nova:gridcentric:index")
 
-def launch(request, instance_id):
-
-    gc_nova = get_client(request)
-    gc_nova.launch_instance(instance_id)
+def bless(request, instance_id):
+    return _submit(request, "gc_bless", instance_id)
 
-    return shortcuts.redirect("horizon:nova:gridcentric:index")
+def launch(request, instance_id):
+    return _submit(request, "gc_launch", instance_id)
 
 def discard(request, instance_id):
-
-    gc_nova = get_client(request)
-    gc_nova.discard_instance(instance_id)
-
-    return shortcuts.redirect("horizon:nova:gridcentric:index")
-
+    return _submit(request, "gc_discard", instance_id)
+
+def job(request, job_id):
+    """
+    Returns the progress of a job as JSON: the result of the action for each
+    instance, and the current status of the instances involved.
+    """
+    gc_job = jobs.get(request, job_id)
+    if gc_job == None:
+        raise http.Http404()
+    result = gc_job.to_dict()
+    if gc_job.state == 'done':
+        if not gc_job.reported:
+            # The snapshot may predate the job's changes.
+            gc_job.reported = True
+            gc_job.save()
+            snapshots.invalidate(request)
+        try:
+            result['statuses'] = snapshots.get(request).statuses(gc_job.instance_ids())
+        except:
+            LOG.exception("Unable to retrieve the instance statuses.")
+            result['statuses'] = {}
+    return http.HttpResponse(json.dumps(result), mimetype='application/json')
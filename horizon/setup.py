@@ -21,4 +21,6 @@ setup(name='horizon-gridcentric',
       author='GridCentric',
       author_email='support@gridcentric.com',
       url='http://www.gridcentric.com/',
-      packages=['gridcentric.horizon'])
+      packages=['gridcentric.horizon'],
+      package_data={'gridcentric.horizon': ['templates/gridcentric/*.html',
+                                            'static/gridcentric/js/*.js']})
@@ -16,6 +16,7 @@
 
 """Handles all requests relating to GridCentric functionality."""
 import random
+import time
 
 from nova import compute
 from nova.compute import vm_states
@@ -29,22 +30,41 @@ from nova.openstack.common import rpc
 from nova.openstack.common import cfg
 from nova import utils
 
-
 LOG = logging.getLogger('nova.gridcentric.api')
 FLAGS = flags.FLAGS
 
 gridcentric_api_opts = [
                cfg.StrOpt('gridcentric_topic',
                default='gridcentric',
-               help='the topic gridcentric nodes listen on') ]
+               help='the topic gridcentric nodes listen on'),
+
+               cfg.IntOpt('gridcentric_memory_server_min_launches',
+               default=0,
+               help='Batches of at least this many launches of one blessed instance share '
+                    'a single memory server instead of each reading the memory from the '
+                    'files. Set to 0 to disable shared memory servers. This needs a '
+                    'version of vms that can serve memory (vms serve); hosts without it '
+                    'are not asked again for gridcentric_memory_server_retry seconds.'),
+
+               cfg.IntOpt('gridcentric_memory_server_retry',
+               default=600,
+               help='The number of seconds before asking a host that could not start a '
+                    'memory server for one again.') ]
 FLAGS.register_opts(gridcentric_api_opts)
 
+QUOTAS = quota.QUOTAS
+
+# The actions that can be run through API.bulk_action().
+BULK_ACTIONS = ('gc_bless', 'gc_launch', 'gc_discard', 'delete')
+
 class API(base.Base):
     """API for interacting with the gridcentric manager."""
 
     def __init__(self, **kwargs):
         super(API, self).__init__(**kwargs)
         self.compute_api = compute.API()
+        # The hosts that could not start a memory server, and when.
+        self.no_memory_server = {}
 
     def get(self, context, instance_uuid):
         """Get a single instance with the given instance_uuid."""
@@ -74,19 +94,19 @@ class API(base.Base):
         kwargs = {'method': method, 'args': params}
         rpc.cast(context, queue, kwargs)
 
-    def _check_quota(self, context, instance_uuid):
-        # Check the quota to see if we can launch a new instance.
+    def _check_quota(self, context, instance_uuid, count=1, memory_mb=None):
+        # Check the quota to see if we can launch count new instances, each
+        # charged memory_mb (by default the memory of the instance type).
         instance = self.get(context, instance_uuid)
         instance_type = instance['instance_type']
-        metadata = instance['metadata']
-
-        req_cores = instance_type['vcpus']
-        req_ram = instance_type['memory_mb']
+        if memory_mb != None:
+            instance_type = dict(instance_type)
+            instance_type['memory_mb'] = memory_mb
 
         max_count, reservations = self.compute_api._check_num_instances_quota(context,
                                                                               instance_type,
-                                                                              1,
-                                                                              1)
+                                                                              count,
+                                                                              count)
 
         # check against metadata
         metadata = self.db.instance_metadata_get(context, instance_uuid)
@@ -190,17 +210,14 @@ class API(base.Base):
                 hosts.append(srv['host'])
         return hosts
 
-    def bless_instance(self, context, instance_uuid):
-        # Setup the DB representation for the new VM.
-        instance_ref = self.get(context, instance_uuid)
-
-        is_blessed = self._is_instance_blessed(context, instance_uuid)
-        is_launched = self._is_instance_launched(context, instance_uuid)
-        if is_blessed:
+    def _prepare_bless(self, context, instance_ref, metadata):
+        """ Checks that instance_ref can be blessed and creates the blessed instance. """
+        instance_uuid = instance_ref['uuid']
+        if 'blessed_from' in metadata:
             # The instance is already blessed. We can't rebless it.
             raise exception.NovaException(_(("Instance %s is already blessed. " +
                                      "Cannot rebless an instance.") % instance_uuid))
-        elif is_launched:
+        elif 'launched_from' in metadata:
             # The instance is a launched one. We cannot bless launched instances.
             raise exception.NovaException(_(("Instance %s has been launched. " +
                                      "Cannot bless a launched instance.") % instance_uuid))
@@ -210,7 +227,13 @@ class API(base.Base):
                                       "Cannot bless a non-active instance.") % instance_uuid))
 
         clonenum = self._next_clone_num(context, instance_uuid)
-        new_instance_ref = self._copy_instance(context, instance_uuid, str(clonenum), launch=False)
+        return self._copy_instance(context, instance_uuid, str(clonenum), launch=False)
+
+    def bless_instance(self, context, instance_uuid):
+        # Setup the DB representation for the new VM.
+        instance_ref = self.get(context, instance_uuid)
+        new_instance_ref = self._prepare_bless(context, instance_ref,
+                                               self._instance_metadata(context, instance_uuid))
 
         LOG.debug(_("Casting gridcentric message for bless_instance") % locals())
         self._cast_gridcentric_message('bless_instance', context, new_instance_ref['uuid'],
@@ -220,10 +243,9 @@ class API(base.Base):
         # did).
         return self.get(context, new_instance_ref['uuid'])
 
-    def discard_instance(self, context, instance_uuid):
-        LOG.debug(_("Casting gridcentric message for discard_instance") % locals())
-
-        if not self._is_instance_blessed(context, instance_uuid):
+    def _check_discard(self, context, instance_uuid, metadata):
+        """ Checks that the instance instance_uuid can be discarded. """
+        if 'blessed_from' not in metadata:
             # The instance is not blessed. We can't discard it.
             raise exception.NovaException(_(("Instance %s is not blessed. " +
                                      "Cannot discard an non-blessed instance.") % instance_uuid))
@@ -233,36 +255,99 @@ class API(base.Base):
                                      "Cannot discard an instance with remaining launched ones.") %
                                      instance_uuid))
 
+    def discard_instance(self, context, instance_uuid):
+        LOG.debug(_("Casting gridcentric message for discard_instance") % locals())
+        self._check_discard(context, instance_uuid,
+                            self._instance_metadata(context, instance_uuid))
         self._cast_gridcentric_message('discard_instance', context, instance_uuid)
 
     def launch_instance(self, context, instance_uuid, params={}):
+        return self.launch_instances(context, instance_uuid, 1, params=params)[0]
+
+    def _start_memory_server(self, context, instance_uuid, count):
+        """
+        Asks the host of the blessed instance to serve its memory to a batch
+        of count launches. Returns None if the batch should not use a memory
+        server.
+        """
+        metadata = self._instance_metadata(context, instance_uuid)
+        try:
+            host = self.get(context, metadata['blessed_from'])['host']
+        except (KeyError, novaexc.NotFound):
+            return None
+        if not host:
+            return None
+        # Hosts that cannot serve memory (e.g. with a vms that has no serve)
+        # are not asked for every batch.
+        failed_at = self.no_memory_server.get(host)
+        if failed_at != None and time.time() - failed_at < FLAGS.gridcentric_memory_server_retry:
+            return None
+
+        memory_url = rpc.call(context,
+                              self.db.queue_get_for(context, FLAGS.gridcentric_topic, host),
+                              {"method": "start_memory_server",
+                               "args": {"instance_uuid": instance_uuid,
+                                        "clients": count}})
+        if memory_url == None:
+            self.no_memory_server[host] = time.time()
+            return None
+        self.no_memory_server.pop(host, None)
+        return {'url': memory_url, 'host': host}
+
+    def launch_instances(self, context, instance_uuid, count, params={}):
+        """
+        Launches count new instances from the blessed instance instance_uuid.
+        Large batches share a single memory server on the host of the blessed
+        instance (see gridcentric_memory_server_min_launches).
+        """
         pid = context.project_id
         uid = context.user_id
 
-        # TODO(dscannell): Need to figure out how these quota reservations work and what
-        # we need to do with them.
-        num_instances, reservations = self._check_quota(context, instance_uuid)
-        instance = self.get(context, instance_uuid)
-
         if not(self._is_instance_blessed(context, instance_uuid)):
             # The instance is not blessed. We can't launch new instances from it.
             raise exception.NovaException(
                   _(("Instance %s is not blessed. " +
                      "Please bless the instance before launching from it.") % instance_uuid))
 
-        # Create a new launched instance.
-        new_instance_ref = self._copy_instance(context, instance_uuid, "clone", launch=True)
-
-        LOG.debug(_("Casting to scheduler for %(pid)s/%(uid)s's"
-                    " instance %(instance_uuid)s") % locals())
-        rpc.cast(context,
-                     FLAGS.scheduler_topic,
-                     {"method": "launch_instance",
-                      "args": {"topic": FLAGS.gridcentric_topic,
-                               "instance_uuid": new_instance_ref['uuid'],
-                               "params": params}})
-
-        return self.get(context, new_instance_ref['uuid'])
+        # Each clone is charged the memory of its guest until it has been
+        # launched on a host, which then lowers the charge to what the quota
+        # mode asks for (see gridcentric_quota_mode). A clone that never makes
+        # it to a host is thus released in full by nova, as it was charged.
+        num_instances, reservations = self._check_quota(context, instance_uuid, count)
+
+        # Create the new launched instances.
+        new_instance_refs = []
+        try:
+            for i in range(count):
+                new_instance_refs.append(self._copy_instance(context, instance_uuid, "clone",
+                                                             launch=True))
+        except:
+            QUOTAS.rollback(context, reservations)
+            raise
+        QUOTAS.commit(context, reservations)
+
+        memory_server = None
+        if FLAGS.gridcentric_memory_server_min_launches > 0 and \
+           count >= FLAGS.gridcentric_memory_server_min_launches:
+            memory_server = self._start_memory_server(context, instance_uuid, count)
+
+        launched = []
+        for new_instance_ref in new_instance_refs:
+            args = {"topic": FLAGS.gridcentric_topic,
+                    "instance_uuid": new_instance_ref['uuid'],
+                    "params": params}
+            if memory_server:
+                args["memory_server"] = memory_server
+
+            LOG.debug(_("Casting to scheduler for %(pid)s/%(uid)s's"
+                        " instance %(instance_uuid)s") % locals())
+            rpc.cast(context,
+                         FLAGS.scheduler_topic,
+                         {"method": "launch_instance",
+                          "args": args})
+
+            launched.append(self.get(context, new_instance_ref['uuid']))
+        return launched
 
     def migrate_instance(self, context, instance_uuid, dest):
         # Grab the DB representation for the VM.
@@ -280,6 +365,90 @@ class API(base.Base):
                                        instance_ref['uuid'], host=instance_ref['host'],
                                        params={"dest" : dest})
 
+    def _get_instances(self, context, instance_uuids):
+        """ Looks up all of the given instances (by uuid) with a single query. """
+        filters = {'uuid': instance_uuids, 'deleted': False}
+        if not context.is_admin:
+            filters['project_id'] = context.project_id
+        instances = self.db.instance_get_all_by_filters(context, filters)
+        return dict([(instance['uuid'], instance) for instance in instances])
+
+    def _gridcentric_queue(self, context, host):
+        if not host:
+            return FLAGS.gridcentric_topic
+        return self.db.queue_get_for(context, FLAGS.gridcentric_topic, host)
+
+    def bulk_action(self, context, actions):
+        """
+        Runs a list of actions, each a dictionary with the server 'id', the
+        'action' (one of BULK_ACTIONS) and optional 'params'. The instances
+        are looked up together and the messages for each gridcentric host are
+        sent as a single cast. Returns a result for every action, in order,
+        with its 'status' ('ok' or 'error') and the affected 'servers'.
+        """
+        instances = self._get_instances(context,
+                                        list(set([action.get('id') for action in actions])))
+
+        # The casts for each gridcentric queue, in order.
+        casts = {}
+        def cast(queue, method, args):
+            casts.setdefault(queue, []).append({'method': method, 'args': args})
+
+        results = []
+        for action in actions:
+            instance_uuid = action.get('id')
+            name = action.get('action')
+            params = action.get('params') or {}
+            result = {'id': instance_uuid, 'action': name, 'status': 'ok', 'servers': []}
+            results.append(result)
+            try:
+                if name not in BULK_ACTIONS:
+                    raise exception.NovaException(_("Unknown action %s.") % name)
+                instance = instances.get(instance_uuid)
+                if instance == None:
+                    raise novaexc.InstanceNotFound(instance_id=instance_uuid)
+                metadata = dict([(item['key'], item['value'])
+                                 for item in instance['metadata']])
+
+                if name == 'gc_bless':
+                    new_instance_ref = self._prepare_bless(context, instance, metadata)
+                    cast(self._gridcentric_queue(context, instance['host']), 'bless_instance',
+                         {'instance_uuid': new_instance_ref['uuid']})
+                    result['servers'].append(self.get(context, new_instance_ref['uuid']))
+
+                elif name == 'gc_discard':
+                    self._check_discard(context, instance_uuid, metadata)
+                    cast(self._gridcentric_queue(context, instance['host']), 'discard_instance',
+                         {'instance_uuid': instance_uuid})
+
+                elif name == 'gc_launch':
+                    params = dict(params)
+                    count = int(params.pop('count', 1))
+                    result['servers'].extend(self.launch_instances(context, instance_uuid,
+                                                                   count, params=params))
+
+                elif name == 'delete':
+                    self.compute_api.delete(context, instance)
+
+            except Exception, e:
+                LOG.debug(_("Bulk %s of %s failed: %s"), name, instance_uuid, str(e))
+                if isinstance(e, novaexc.NotFound):
+                    code = 404
+                elif isinstance(e, novaexc.QuotaError):
+                    code = 413
+                else:
+                    code = 400
+                result['status'] = 'error'
+                result['error'] = {'code': code, 'message': unicode(e)}
+
+        for queue, calls in casts.items():
+            if len(calls) == 1:
+                rpc.cast(context, queue, calls[0])
+            else:
+                rpc.cast(context, queue, {'method': 'run_batch', 'args': {'calls': calls}})
+
+        return results
+
     def list_launched_instances(self, context, instance_uuid):
         filter = {
                   'metadata':{'launched_from':'%s' % instance_uuid},
@@ -11,20 +11,276 @@
 The client connector used to interface with the nova api.
 """
 
+import calendar
+import email.utils
+import fcntl
+import hashlib
 import httplib2
 import json
+import os
+import Queue
+import random
+import threading
+import time
 import urlparse
 import logging
 
 import gridcentric.nova.client.exceptions as exceptions
 
-class NovaClient(httplib2.Http):
+# The lifetime of tokens that do not come with an expiry (i.e. v1 tokens).
+DEFAULT_TOKEN_TTL = 3600
+# Tokens are considered expired this many seconds early.
+TOKEN_EXPIRY_MARGIN = 60
+
+class ConnectionPool(object):
+    """
+    A bounded pool of httplib2.Http objects. Each one keeps its connections
+    alive between requests and is only used by one thread at a time.
+    """
+
+    def __init__(self, size=10, timeout=None):
+        self.size = size
+        self.timeout = timeout
+        self.pool = Queue.Queue()
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def _create(self):
+        http = httplib2.Http(timeout=self.timeout)
+        # Need to set for the httplib2 library.
+        http.force_exception_to_status_code = True
+        return http
 
-    USER_AGENT = "gridcentric-novaclient"
+    def get(self):
+        try:
+            return self.pool.get_nowait()
+        except Queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                return self._create()
+        # Wait for another thread to give its connection back.
+        return self.pool.get()
+
+    def put(self, http):
+        self.pool.put(http)
+
+class TokenCache(object):
+    """
+    Caches auth tokens, and the management url that goes with them, until
+    they expire. The cache is shared by every client in the process that uses
+    the same path. If path is given, the tokens are also stored in that file
+    so that other processes can use them.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.tokens = {}
+        self.lock = threading.Lock()
+        self.auth_locks = {}
+
+    def lock_for(self, key):
+        """ Returns the lock serializing the authentications for key. """
+        with self.lock:
+            return self.auth_locks.setdefault(key, threading.Lock())
+
+    def _read(self, cache_file):
+        cache_file.seek(0)
+        try:
+            return json.loads(cache_file.read() or '{}')
+        except ValueError:
+            return {}
+
+    def _update_file(self, fn):
+        """ Applies fn to the tokens stored in the file, under an exclusive lock. """
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+        with os.fdopen(fd, 'r+') as cache_file:
+            fcntl.flock(cache_file, fcntl.LOCK_EX)
+            tokens = self._read(cache_file)
+            if fn(tokens):
+                cache_file.seek(0)
+                cache_file.truncate()
+                cache_file.write(json.dumps(tokens))
+            return tokens
+
+    def get(self, key):
+        """ Returns the (unexpired) token entry for key, or None. """
+        with self.lock:
+            entry = self.tokens.get(key)
+        if entry == None and self.path and os.path.exists(self.path):
+            with open(self.path) as cache_file:
+                fcntl.flock(cache_file, fcntl.LOCK_SH)
+                entry = self._read(cache_file).get(key)
+        if entry == None or entry['expires'] <= time.time():
+            return None
+        with self.lock:
+            self.tokens[key] = entry
+        return entry
+
+    def put(self, key, token, management_url, expires):
+        entry = {'token': token, 'management_url': management_url, 'expires': expires}
+        with self.lock:
+            self.tokens[key] = entry
+        if self.path:
+            now = time.time()
+            def store(tokens):
+                for other_key, other_entry in tokens.items():
+                    if other_entry.get('expires', 0) <= now:
+                        del tokens[other_key]
+                tokens[key] = entry
+                return True
+            self._update_file(store)
+
+    def invalidate(self, key, token):
+        """ Forgets the token for key (if it is still token). """
+        with self.lock:
+            if self.tokens.get(key, {}).get('token') == token:
+                del self.tokens[key]
+        if self.path and os.path.exists(self.path):
+            def remove(tokens):
+                if tokens.get(key, {}).get('token') == token:
+                    del tokens[key]
+                    return True
+                return False
+            self._update_file(remove)
+
+_token_caches = {}
+_token_caches_lock = threading.Lock()
+
+def get_token_cache(path=None):
+    """ Returns the token cache shared by the clients using path. """
+    with _token_caches_lock:
+        if path not in _token_caches:
+            _token_caches[path] = TokenCache(path)
+        return _token_caches[path]
+
+def parse_retry_after(value):
+    """ Returns the delay (in seconds) given by a Retry-After header, or None. """
+    if value == None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        date = email.utils.parsedate(value)
+        if date == None:
+            return None
+        return max(0.0, calendar.timegm(date) - time.time())
+
+class RetryPolicy(object):
+    """
+    Decides which failed requests are retried and how long to wait first.
+
+    Idempotent requests (e.g. listing or deleting) are retried on overload,
+    server errors and timeouts. Other requests (e.g. launching) are only
+    retried when the server refused them outright, so that they are never
+    done twice. The delay is the server's Retry-After if there is one, and an
+    exponential backoff with jitter otherwise.
+
+    Nova answers 413 both when a request is rate limited and when it is over
+    quota, which does not go away by waiting. Only the former gives a positive
+    Retry-After, so the delayed_codes are only retried when there is one.
+
+    Every retry (or hedged request) spends a token from a budget that only
+    grows by budget_ratio per request, which keeps the retries of a client
+    to a fraction of its traffic when the server is struggling.
+    """
+
+    IDEMPOTENT_METHODS = ('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS')
+
+    def __init__(self, max_retries=3, backoff=0.5, max_backoff=30.0, jitter=0.5,
+                 max_retry_after=120.0, budget_ratio=0.1, budget_max=10.0,
+                 idempotent_codes=(408, 413, 429, 500, 502, 503, 504),
+                 unsafe_codes=(413, 429, 503), delayed_codes=(413,), hedge_after=None):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.max_retry_after = max_retry_after
+        self.budget_ratio = budget_ratio
+        self.budget_max = budget_max
+        self.idempotent_codes = idempotent_codes
+        self.unsafe_codes = unsafe_codes
+        self.delayed_codes = delayed_codes
+        self.hedge_after = hedge_after
+
+        self.budget = budget_max
+        self.lock = threading.Lock()
+
+    def record_request(self):
+        with self.lock:
+            self.budget = min(self.budget_max, self.budget + self.budget_ratio)
+
+    def spend(self):
+        """ Takes a token from the retry budget. Returns False if there is none left. """
+        with self.lock:
+            if self.budget < 1.0:
+                return False
+            self.budget -= 1.0
+            return True
+
+    def is_idempotent(self, method):
+        return method.upper() in self.IDEMPOTENT_METHODS
+
+    def should_retry(self, error, attempt, idempotent):
+        if attempt >= self.max_retries:
+            return False
+        if idempotent:
+            retryable = error.code in self.idempotent_codes
+        else:
+            retryable = error.code in self.unsafe_codes
+        if retryable and error.code in self.delayed_codes:
+            retry_after = parse_retry_after(getattr(error, 'retry_after', None))
+            retryable = retry_after != None and retry_after > 0
+        return retryable and self.spend()
+
+    def delay(self, error, attempt):
+        retry_after = parse_retry_after(getattr(error, 'retry_after', None))
+        if retry_after != None:
+            return min(retry_after, self.max_retry_after)
+        delay = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return delay * (1.0 - self.jitter * random.random())
+
+class BatchResult(object):
+    """
+    The outcome of a batch of client calls. results has, for each call in
+    order, its return value (or None if it failed), and errors has the
+    (index, exception) of every call that failed.
+    """
+
+    def __init__(self, count):
+        self.results = [None] * count
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def _set(self, index, result):
+        self.results[index] = result
+
+    def _fail(self, index, error):
+        with self.lock:
+            self.errors.append((index, error))
+
+    def ok(self):
+        return len(self.errors) == 0
+
+    def __len__(self):
+        return len(self.results)
+
+    def __iter__(self):
+        return iter(self.results)
+
+class NovaClient(object):
+    """
+    A client for the gridcentric nova api. A client can be used by many
+    threads at once: requests go through a bounded pool of persistent
+    connections, and the auth token is shared with the other clients of the
+    same user (see TokenCache).
+    """
 
-    def __init__(self, auth_url, user, apikey, project=None, default_version='v1.0', region=None):
-        super(NovaClient, self).__init__()
+    USER_AGENT = "gridcentric-novaclient"
 
+    def __init__(self, auth_url, user, apikey, project=None, default_version='v1.0', region=None,
+                 pool_size=10, timeout=None, token_cache_path=None, retry_policy=None):
         self.auth_url = auth_url
         self.user = user
         self.apikey = apikey
@@ -34,10 +290,15 @@ class NovaClient(httplib2.Http):
         self.version = None
         self.default_version = 'v1.0'
         self.auth_token = None
+        self.token_expires = None
         self.management_url = None
 
-        # Need to set for the httplib2 library.
-        self.force_exception_to_status_code = True
+        self.pool = ConnectionPool(size=pool_size, timeout=timeout)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.token_cache = get_token_cache(token_cache_path)
+
+        # The ETag and body of the last response of each conditional request.
+        self.etag_cache = {}
 
     def bless_instance(self, instance_id):
         resp, body = self.authenticated_request('/servers/%s/action' % instance_id,
@@ -64,64 +325,251 @@ class NovaClient(httplib2.Http):
         return body
 
     def list_launched_instances(self, instance_id):
-        resp, body = self.authenticated_request('/servers/%s/action' % instance_id,
-                                                'POST', body={'gc_list_launched':{}})
-        return body
+        return self.conditional_request('/gcservers/%s/launched' % instance_id, 'GET')
 
     def list_blessed_instances(self, instance_id):
-        resp, body = self.authenticated_request('/servers/%s/action' % instance_id,
-                                                'POST', body={'gc_list_blessed':{}})
-        return body
+        return self.conditional_request('/gcservers/%s/blessed' % instance_id, 'GET')
+
+    def bulk_action(self, actions, view=None):
+        """
+        Runs a list of actions (dictionaries with the server 'id', the 'action'
+        and its 'params') through the bulk endpoint in a single request.
+        """
+        body = {'actions': actions}
+        if view:
+            body['view'] = view
+        resp, body = self.authenticated_request('/gcservers/action', 'POST', body=body)
+        return body['results']
+
+    # The methods that can be run through map_actions.
+    BATCH_METHODS = ('bless_instance', 'launch_instance', 'migrate_instance',
+                     'delete_instance', 'discard_instance',
+                     'list_launched_instances', 'list_blessed_instances')
+
+    def map_actions(self, actions, concurrency=None):
+        """
+        Runs the actions, each a tuple of a method name (see BATCH_METHODS)
+        and its arguments, with at most concurrency of them in flight. The
+        calls share the pooled connections and a single auth token. Returns
+        a BatchResult.
+        """
+        for action in actions:
+            if action[0] not in self.BATCH_METHODS:
+                raise ValueError("Unknown action %s." % action[0])
+        if concurrency == None:
+            concurrency = self.pool.size
+        concurrency = max(1, min(concurrency, len(actions)))
+
+        # Authenticate once up front rather than in every thread.
+        if actions and self.auth_url and not self.management_url:
+            self.ensure_authenticated()
+
+        result = BatchResult(len(actions))
+        work = Queue.Queue()
+        for index, action in enumerate(actions):
+            work.put((index, action))
+
+        def worker():
+            while True:
+                try:
+                    index, action = work.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    result._set(index, getattr(self, action[0])(*action[1:]))
+                except Exception, e:
+                    logging.debug("Batched %s failed: %s" % (action[0], str(e)))
+                    result._fail(index, e)
+
+        threads = [threading.Thread(target=worker) for i in range(concurrency)]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return result
+
+    def launch_many(self, blessed_instance_id, count, params={}, concurrency=None):
+        """ Launches count instances of a blessed instance concurrently. """
+        return self.map_actions([('launch_instance', blessed_instance_id, params)] * count,
+                                concurrency=concurrency)
+
+    def conditional_request(self, url, method, body=None):
+        """
+        Sends the request with the ETag of the last response (if any) and
+        returns the cached body if the server replies that it has not changed.
+        """
+        key = (url, method, json.dumps(body, sort_keys=True))
+        cached = self.etag_cache.get(key)
+        headers = {}
+        if cached:
+            headers['If-None-Match'] = cached[0]
+
+        resp, response_body = self.authenticated_request(url, method, body=body,
+                                                         headers=headers, idempotent=True)
+        if resp.status == 304 and cached:
+            return cached[1]
+
+        etag = resp.get('etag')
+        if etag:
+            self.etag_cache[key] = (etag, response_body)
+        else:
+            self.etag_cache.pop(key, None)
+        return response_body
+
+    def _token_key(self):
+        """
+        The key of the client's token in the token cache. It includes a hash
+        of the apikey (salted with the rest of the key), so that a token is
+        only reused by clients holding the same credentials.
+        """
+        identity = '|'.join([str(self.auth_url), str(self.user), str(self.project),
+                             str(self.region)])
+        secret = hashlib.sha256('%s|%s' % (identity, self.apikey)).hexdigest()
+        return '%s|%s' % (identity, secret)
+
+    def ensure_authenticated(self, stale_token=None):
+        """
+        Makes sure the client has a valid token. Only one thread (per user) at
+        a time authenticates, and the others reuse the token that it got. If
+        stale_token is given, it has been refused and will not be reused.
+        """
+        key = self._token_key()
+        with self.token_cache.lock_for(key):
+            if stale_token != None:
+                self.token_cache.invalidate(key, stale_token)
+            entry = self.token_cache.get(key)
+            if entry != None:
+                self.auth_token = entry['token']
+                self.management_url = entry['management_url']
+                self.token_expires = entry['expires']
+                return
 
-    def authenticated_request(self, url, method, **kwargs):
-        if not self.management_url:
             self._authenticate()
+            if self.token_expires == None:
+                self.token_expires = time.time() + DEFAULT_TOKEN_TTL
+            self.token_cache.put(key, self.auth_token, self.management_url,
+                                 self.token_expires - TOKEN_EXPIRY_MARGIN)
+
+    def _send(self, url, method, token, **kwargs):
+        headers = dict(kwargs.get('headers') or {})
+        headers['X-Auth-Token'] = token
+        if self.project:
+            headers['X-Auth-Project-Id'] = self.project
+        kwargs['headers'] = headers
+
+        logging.debug("Sending request to %s (body=%s)" % (url, kwargs.get('body', '')))
+        resp, body = self.request(self.management_url + url, method, **kwargs)
+        logging.debug("Response from %s (body=%s)" % (url, body))
+        return resp, body
+
+    def authenticated_request(self, url, method, idempotent=None, **kwargs):
+        """
+        Sends a request to the nova api, retrying it according to the retry
+        policy. By default, only the requests with an idempotent method are
+        treated as idempotent.
+        """
+        policy = self.retry_policy
+        if idempotent == None:
+            idempotent = policy.is_idempotent(method)
+
+        attempt = 0
+        while True:
+            policy.record_request()
+            try:
+                if idempotent and policy.hedge_after != None:
+                    return self._hedged_request(url, method, **kwargs)
+                return self._authenticated_request(url, method, **kwargs)
+            except exceptions.HttpException, ex:
+                if not policy.should_retry(ex, attempt, idempotent):
+                    raise
+                delay = policy.delay(ex, attempt)
+                logging.debug("Retrying request to %s in %.2fs after HTTP %s" %
+                              (url, delay, ex.code))
+                time.sleep(delay)
+                attempt += 1
+
+    def _hedged_request(self, url, method, **kwargs):
+        """
+        Sends the request and, if there is no response after hedge_after
+        seconds (and the retry budget allows it), sends it a second time.
+        Returns the first successful response.
+        """
+        responses = Queue.Queue()
+        def send():
+            try:
+                responses.put((True, self._authenticated_request(url, method, **kwargs)))
+            except Exception, e:
+                responses.put((False, e))
+        def start():
+            thread = threading.Thread(target=send)
+            thread.daemon = True
+            thread.start()
+
+        start()
+        pending = 1
+        try:
+            success, value = responses.get(timeout=self.retry_policy.hedge_after)
+            pending -= 1
+        except Queue.Empty:
+            if self.retry_policy.spend():
+                logging.debug("Hedging request to %s" % (url))
+                start()
+                pending += 1
+            success, value = responses.get()
+            pending -= 1
+        while not success and pending > 0:
+            success, value = responses.get()
+            pending -= 1
+        if not success:
+            raise value
+        return value
+
+    def _authenticated_request(self, url, method, **kwargs):
+        if not self.management_url or \
+           (self.token_expires != None and self.token_expires <= time.time()):
+            self.ensure_authenticated()
 
         # Perform the request once. If we get a 401 back then it
         # might be because the auth token expired, so try to
         # re-authenticate and try again. If it still fails, bail.
+        token = self.auth_token
         try:
-            kwargs.setdefault('headers', {})['X-Auth-Token'] = self.auth_token
-            if self.project:
-                kwargs['headers']['X-Auth-Project-Id'] = self.project
-
-            logging.debug("Sending request to %s (body=%s)" % (url, kwargs.get('body', '')))
-            resp, body = self.request(self.management_url + url, method,
-                                      **kwargs)
-            logging.debug("Response from %s (body=%s)" % (url, body))
-            return resp, body
+            return self._send(url, method, token, **kwargs)
         except exceptions.HttpException, ex:
-            if ex.code == 401:
+            if ex.code == 401 and self.auth_url:
                 """
                 This is an unauthorized exception. Reauthenticate and try again
                 """
-                self._authenticate()
-                logging.debug("Sending request to %s (body=%s) [REAUTHENTICATED]" % (url, kwargs['body']))
-                resp, body = self.request(self.management_url + url, method,
-                                          **kwargs)
-                return resp, body
+                self.ensure_authenticated(stale_token=token)
+                logging.debug("Retrying request to %s [REAUTHENTICATED]" % (url))
+                return self._send(url, method, self.auth_token, **kwargs)
             else:
                 raise ex
 
-    def request(self, *args, **kwargs):
-        kwargs.setdefault('headers', kwargs.get('headers', {}))
-        kwargs['headers']['User-Agent'] = self.USER_AGENT
-        if 'body' in kwargs:
-            kwargs['headers']['Content-Type'] = 'application/json'
-            kwargs['body'] = json.dumps(kwargs['body'])
+    def request(self, uri, method='GET', body=None, headers=None):
+        headers = dict(headers or {})
+        headers['User-Agent'] = self.USER_AGENT
+        if body != None:
+            headers['Content-Type'] = 'application/json'
+            body = json.dumps(body)
 
-        resp, body = super(NovaClient, self).request(*args, **kwargs)
+        http = self.pool.get()
+        try:
+            resp, body = http.request(uri, method, body=body, headers=headers)
+        finally:
+            self.pool.put(http)
 
         if body:
             try:
                 body = json.loads(body)
             except ValueError, e:
-                logging.warn("Request (%s) body failed to be parsed as json: body='%s'" % (args[0], body))
+                logging.warn("Request (%s) body failed to be parsed as json: body='%s'" % (uri, body))
                 pass
         else:
             body = None
 
-        if resp.status in (400, 401, 403, 404, 408, 413, 500, 501):
+        if resp.status in (400, 401, 403, 404, 408, 413, 429, 500, 501, 502, 503, 504):
             raise create_exception_from_response(resp, body)
 
         return resp, body
@@ -172,6 +620,7 @@ class NovaClient(httplib2.Http):
             try:
                 self.management_url = resp['x-server-management-url']
                 self.auth_token = resp['x-auth-token']
+                self.token_expires = None
                 self.auth_url = url
             except KeyError:
                 raise exceptions.AuthorizationFailure()
@@ -203,6 +652,7 @@ class NovaClient(httplib2.Http):
                 self.auth_url = url
                 service_catalog = ServiceCatalog(body)
                 self.auth_token = service_catalog.get_token()
+                self.token_expires = service_catalog.get_expiry()
 
                 self.management_url = service_catalog.url_for(
                                            attr='region',
@@ -227,7 +677,8 @@ def create_exception_from_response(resp, body):
         message = error.get('message', None)
         details = error.get('details', None)
 
-    return exceptions.HttpException(code=resp.status, message=message, details=details)
+    return exceptions.HttpException(code=resp.status, message=message, details=details,
+                                    retry_after=resp.get('retry-after'))
 
 class ServiceCatalog:
     """Helper methods for dealing with a Keystone Service Catalog."""
@@ -238,6 +689,16 @@ class ServiceCatalog:
     def get_token(self):
         return self.catalog['access']['token']['id']
 
+    def get_expiry(self):
+        """ Returns when the token expires (in seconds since the epoch), if known. """
+        expires = self.catalog['access']['token'].get('expires')
+        if not expires:
+            return None
+        try:
+            return calendar.timegm(time.strptime(expires[:19], '%Y-%m-%dT%H:%M:%S'))
+        except ValueError:
+            return None
+
     def url_for(self, attr=None, filter_value=None):
         """Fetch the public URL from the Compute service for
         a particular endpoint attribute. If none given, return
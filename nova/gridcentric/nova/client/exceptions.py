@@ -25,10 +25,11 @@ class EndpointNotFound(Exception):
     pass
 
 class HttpException(Exception):
-    def __init__(self, code, message=None, details=None):
+    def __init__(self, code, message=None, details=None, retry_after=None):
         self.code = code
         self.message = message or ''
         self.deatils = details
+        self.retry_after = retry_after
 
     def __str__(self):
         return "(HTTP %s) %s)" % (self.code, self.message)
@@ -0,0 +1,274 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Peer-to-peer distribution of blessed artifacts.
+
+When the image service is used, every gridcentric host keeps the artifacts it
+downloaded in its local cache. Each host serves that cache over HTTP to the
+other gridcentric hosts, so that a host launching a clone can get the
+artifacts from a peer and only falls back to the image service when no peer
+has them. The cache holds the images of every tenant, so the server only runs
+with a shared secret, and each request carries a short-lived token signed
+with it.
+"""
+
+import hashlib
+import hmac
+import os
+import random
+import threading
+import time
+import urllib
+import urllib2
+
+from nova import exception
+from nova import flags
+from nova.openstack.common import cfg
+from nova.openstack.common import log as logging
+LOG = logging.getLogger('nova.gridcentric.artifacts')
+FLAGS = flags.FLAGS
+artifact_opts = [
+               cfg.IntOpt('gridcentric_artifact_port',
+               default=None,
+               help='The port used to serve cached artifacts to the other gridcentric '
+                    'hosts. Peer-to-peer distribution is disabled when this is not set.'),
+
+               cfg.StrOpt('gridcentric_artifact_listen',
+               default=None,
+               help='The address the artifact server listens on. By default this is the '
+                    'management address of the host (my_ip).'),
+
+               cfg.StrOpt('gridcentric_artifact_secret',
+               default=None,
+               help='A secret shared by the gridcentric hosts that is used to sign artifact '
+                    'requests. The artifact server does not start without it.'),
+
+               cfg.IntOpt('gridcentric_artifact_token_ttl',
+               default=60,
+               help='The number of seconds an artifact request token is valid for.'),
+
+               cfg.IntOpt('gridcentric_artifact_peer_attempts',
+               default=3,
+               help='The number of peers to try before falling back to the image service.'),
+
+               cfg.FloatOpt('gridcentric_artifact_peer_timeout',
+               default=10.0,
+               help='The socket timeout (in seconds) when downloading from a peer.')]
+FLAGS.register_opts(artifact_opts)
+
+import eventlet
+import eventlet.wsgi
+
+CHUNK_SIZE = 1 << 20
+
+def _sign(name, expires, nonce):
+    return hmac.new(FLAGS.gridcentric_artifact_secret,
+                    '%s\n%d\n%s' % (name, expires, nonce), hashlib.sha256).hexdigest()
+
+def _equals(a, b):
+    """ Compares two strings in a time that does not depend on where they differ. """
+    if len(a) != len(b):
+        return False
+    result = 0
+    for x, y in zip(a, b):
+        result |= ord(x) ^ ord(y)
+    return result == 0
+
+def artifact_token(name, now=None):
+    """
+    Returns a token for a single request of the artifact name, valid for
+    gridcentric_artifact_token_ttl seconds, or None without a secret.
+    """
+    if not FLAGS.gridcentric_artifact_secret:
+        return None
+    expires = int(now or time.time()) + FLAGS.gridcentric_artifact_token_ttl
+    nonce = '%016x' % random.SystemRandom().getrandbits(64)
+    return '%d:%s:%s' % (expires, nonce, _sign(name, expires, nonce))
+
+class ArtifactServer(object):
+    """ Serves the files of a local artifact cache over HTTP. """
+
+    def __init__(self, path, listen=None, port=None):
+        self.path = path
+        self.listen = listen or FLAGS.gridcentric_artifact_listen
+        self.port = port or FLAGS.gridcentric_artifact_port
+        # The nonces of the tokens already used, with their expiry, so that
+        # a token cannot be replayed.
+        self.used_nonces = {}
+        self.lock = threading.Lock()
+
+    def start(self):
+        if not FLAGS.gridcentric_artifact_secret:
+            raise exception.NovaException(_("The artifact server requires "
+                                            "gridcentric_artifact_secret to be set."))
+        if not self.listen:
+            self.listen = FLAGS.my_ip
+        LOG.info(_("Serving artifacts from %s on %s:%s"), self.path, self.listen, self.port)
+        sock = eventlet.listen((self.listen, self.port))
+        return eventlet.spawn(eventlet.wsgi.server, sock, self, log=NullLog())
+
+    def check_token(self, name, token, now=None):
+        """ Returns True if token is a valid, unexpired and unused token for name. """
+        if not FLAGS.gridcentric_artifact_secret or not token:
+            return False
+        try:
+            expires, nonce, digest = token.split(':', 2)
+            expires = int(expires)
+        except ValueError:
+            return False
+        now = now or time.time()
+        if expires < now or expires > now + FLAGS.gridcentric_artifact_token_ttl:
+            return False
+        if not _equals(digest, _sign(name, expires, nonce)):
+            return False
+        with self.lock:
+            for used, used_expires in self.used_nonces.items():
+                if used_expires < now:
+                    del self.used_nonces[used]
+            if nonce in self.used_nonces:
+                return False
+            self.used_nonces[nonce] = expires
+        return True
+
+    def __call__(self, environ, start_response):
+        name = urllib.unquote(environ.get('PATH_INFO', '').lstrip('/'))
+        method = environ.get('REQUEST_METHOD')
+
+        if method not in ('GET', 'HEAD'):
+            start_response('405 Method Not Allowed', [('Content-Length', '0')])
+            return []
+        # Only plain file names from the cache directory can be served.
+        if not name or name.startswith('.') or os.path.basename(name) != name:
+            start_response('404 Not Found', [('Content-Length', '0')])
+            return []
+        if not self.check_token(name, environ.get('HTTP_X_GRIDCENTRIC_ARTIFACT_TOKEN')):
+            start_response('403 Forbidden', [('Content-Length', '0')])
+            return []
+
+        path = os.path.join(self.path, name)
+        try:
+            artifact = open(path, 'rb')
+        except IOError:
+            start_response('404 Not Found', [('Content-Length', '0')])
+            return []
+
+        size = os.fstat(artifact.fileno()).st_size
+        start_response('200 OK', [('Content-Type', 'application/octet-stream'),
+                                  ('Content-Length', str(size))])
+        if method == 'HEAD':
+            artifact.close()
+            return []
+        return FileIterator(artifact)
+
+class FileIterator(object):
+
+    def __init__(self, artifact):
+        self.artifact = artifact
+
+    def __iter__(self):
+        try:
+            while True:
+                chunk = self.artifact.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            self.artifact.close()
+
+class NullLog(object):
+    """ Keeps the artifact requests out of the service log. """
+
+    def write(self, message):
+        pass
+
+def fetch_from_peer(peer, name, target, size=None, checksum=None):
+    """
+    Downloads the artifact name from peer into target. Returns True if the
+    download succeeded and matches the expected size and (md5) checksum.
+    """
+    url = 'http://%s:%s/%s' % (peer, FLAGS.gridcentric_artifact_port, urllib.quote(name))
+    request = urllib2.Request(url)
+    request.add_header('X-Gridcentric-Artifact-Token', artifact_token(name))
+
+    digest = hashlib.md5()
+    received = 0
+    try:
+        response = urllib2.urlopen(request, timeout=FLAGS.gridcentric_artifact_peer_timeout)
+        with open(target, 'wb') as target_file:
+            while True:
+                chunk = response.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                received += len(chunk)
+                target_file.write(chunk)
+    except (IOError, OSError), e:
+        LOG.debug(_("Unable to fetch %s from %s: %s"), name, peer, str(e))
+        return False
+
+    if size != None and received != int(size):
+        LOG.warn(_("Artifact %s from %s has size %d (expected %s)."), name, peer, received, size)
+        return False
+    if checksum != None and digest.hexdigest() != checksum:
+        LOG.warn(_("Artifact %s from %s does not match its checksum."), name, peer)
+        return False
+    return True
+
+def fetch_from_peers(peers, name, target, size=None, checksum=None):
+    """
+    Tries to download the artifact from (at most gridcentric_artifact_peer_attempts)
+    peers, in order. Returns the peer that served the artifact, or None.
+    """
+    if not FLAGS.gridcentric_artifact_port or not FLAGS.gridcentric_artifact_secret:
+        return None
+    for peer in peers[:FLAGS.gridcentric_artifact_peer_attempts]:
+        if fetch_from_peer(peer, name, target, size=size, checksum=checksum):
+            LOG.debug(_("Fetched artifact %s from peer %s."), name, peer)
+            return peer
+    return None
+
+def cached_blessed_instances(path):
+    """
+    Returns the blessed instances that have artifacts in the cache at path,
+    with the size (in bytes) of their artifacts. The artifacts are named
+    after their blessed instance (e.g. instance-0000000a.0.gc).
+    """
+    cached = {}
+    try:
+        names = os.listdir(path)
+    except OSError:
+        return cached
+    for name in names:
+        if '.' not in name or name.startswith('tmp'):
+            # The base images of nova and the downloads in progress.
+            continue
+        try:
+            size = os.path.getsize(os.path.join(path, name))
+        except OSError:
+            continue
+        blessed_name = name.split('.', 1)[0]
+        cached[blessed_name] = cached.get(blessed_name, 0) + size
+    return cached
+
+def order_peers(likely_peers, other_peers):
+    """
+    Returns the peers to try: the ones likely to have the artifacts first,
+    then the others in a random order so that the load is spread out.
+    """
+    peers = list(likely_peers)
+    others = [peer for peer in other_peers if peer not in peers]
+    random.shuffle(others)
+    return peers + others
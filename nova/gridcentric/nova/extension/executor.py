@@ -0,0 +1,346 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Runs the (blocking) vms commands outside of the eventlet hub.
+
+Each type of command runs on its own pool of native threads, sized by its
+concurrency limit, so that, for instance, a burst of launches cannot starve
+the discards. The pools are separate from the global eventlet tpool, which
+is also used by nova (e.g. the libvirt driver of the compute manager). The
+executor keeps track of the queue depth, wait time and run time of every
+type of command.
+
+CPU heavy commands can be sent on to a pool of worker processes instead, so
+that they do not hold the GIL of the service. Only functions that can be
+pickled (i.e. module-level functions such as the vms commands) can run
+there; the others stay on the command's threads.
+"""
+
+import collections
+import cPickle
+import fcntl
+import multiprocessing
+import os
+import sys
+import time
+
+from nova import flags
+from nova.openstack.common import cfg
+from nova.openstack.common import log as logging
+LOG = logging.getLogger('nova.gridcentric.executor')
+FLAGS = flags.FLAGS
+executor_opts = [
+               cfg.ListOpt('gridcentric_vms_concurrency',
+               default=['bless:4', 'launch:16', 'discard:4', 'replug:16'],
+               help='The maximum number of concurrent vms commands, per command, given '
+                    'as a list of <command>:<limit>. Each command runs on its own pool '
+                    'of that many threads. Commands that are not listed are limited by '
+                    'gridcentric_vms_default_concurrency.'),
+
+               cfg.IntOpt('gridcentric_vms_default_concurrency',
+               default=8,
+               help='The maximum number of concurrent vms commands for commands that '
+                    'are not listed in gridcentric_vms_concurrency.'),
+
+               cfg.ListOpt('gridcentric_vms_process_commands',
+               default=[],
+               help='The vms commands (e.g. bless) that should be run in a pool of '
+                    'worker processes instead of a thread. This is useful for CPU heavy '
+                    'commands that would otherwise hold the GIL.'),
+
+               cfg.IntOpt('gridcentric_vms_processes',
+               default=None,
+               help='The number of worker processes used for the commands listed in '
+                    'gridcentric_vms_process_commands. By default this is the number '
+                    'of CPUs.')]
+FLAGS.register_opts(executor_opts)
+
+from eventlet import event
+from eventlet import greenthread
+from eventlet import hubs
+from eventlet import patcher
+from eventlet import semaphore
+
+_threading = patcher.original('threading')
+_Queue = patcher.original('Queue')
+
+def parse_limits(limits):
+    """ Parses a list of <command>:<limit> strings into a dictionary. """
+    result = {}
+    for limit in limits:
+        try:
+            command, value = limit.split(':')
+            result[command.strip()] = int(value)
+        except ValueError:
+            raise ValueError('Invalid vms concurrency limit %s.' % limit)
+    return result
+
+class CommandStats(object):
+    """ The statistics for one type of vms command. """
+
+    def __init__(self):
+        self.queued = 0
+        self.running = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.run_time = 0.0
+        self.max_run_time = 0.0
+
+    def to_dict(self):
+        count = self.completed + self.failed
+        return {'queued': self.queued,
+                'running': self.running,
+                'completed': self.completed,
+                'failed': self.failed,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+                'avg_wait_time': count and self.wait_time / count or 0.0,
+                'run_time': self.run_time,
+                'max_run_time': self.max_run_time,
+                'avg_run_time': count and self.run_time / count or 0.0}
+
+class ThreadPool(object):
+    """
+    A pool of native threads for one type of vms command. The results are
+    handed back to the waiting green threads through a pipe watched by the
+    hub, the same way the eventlet tpool does it.
+    """
+
+    def __init__(self, name, size):
+        self.name = name
+        self.size = max(1, size)
+        self.requests = _Queue.Queue()
+        self.responses = collections.deque()
+        self.threads = []
+        self.rfd = None
+        self.wfd = None
+
+    def _start(self):
+        self.rfd, self.wfd = os.pipe()
+        flags = fcntl.fcntl(self.rfd, fcntl.F_GETFL)
+        fcntl.fcntl(self.rfd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        greenthread.spawn_n(self._dispatch)
+        for i in range(self.size):
+            thread = _threading.Thread(target=self._work, name='vms-%s-%d' % (self.name, i))
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def _work(self):
+        while True:
+            done, fn, args, kwargs = self.requests.get()
+            try:
+                response = (done, (True, fn(*args, **kwargs)))
+            except:
+                response = (done, (False, sys.exc_info()))
+            self.responses.append(response)
+            os.write(self.wfd, ' ')
+
+    def _dispatch(self):
+        while True:
+            hubs.trampoline(self.rfd, read=True)
+            try:
+                os.read(self.rfd, 4096)
+            except OSError:
+                pass
+            while self.responses:
+                done, result = self.responses.popleft()
+                done.send(result)
+
+    def execute(self, fn, *args, **kwargs):
+        """ Runs fn(*args, **kwargs) on one of the threads and returns its result. """
+        if not self.threads:
+            self._start()
+        done = event.Event()
+        self.requests.put((done, fn, args, kwargs))
+        ok, result = done.wait()
+        if not ok:
+            raise result[0], result[1], result[2]
+        return result
+
+def _serve(conn):
+    """ The loop of a worker process: runs the calls it is sent, one at a time. """
+    while True:
+        try:
+            fn, args, kwargs = conn.recv()
+        except EOFError:
+            return
+        try:
+            response = (True, fn(*args, **kwargs))
+        except Exception, e:
+            response = (False, e)
+        try:
+            conn.send(response)
+        except Exception, e:
+            # The result (or exception) cannot be pickled.
+            conn.send((False, Exception(str(e))))
+
+class ProcessPool(object):
+    """
+    A pool of worker processes. apply() blocks until a worker is free and
+    has run the call, so it is meant to be called from a command's native
+    threads (not from a green thread). The workers are started on demand.
+    """
+
+    def __init__(self, size=None):
+        self.size = size or multiprocessing.cpu_count()
+        self.idle = _Queue.Queue()
+        self.lock = _threading.Lock()
+        self.workers = []
+
+    def _worker(self):
+        with self.lock:
+            if len(self.workers) < self.size:
+                conn, child_conn = multiprocessing.Pipe()
+                process = multiprocessing.Process(target=_serve, args=(child_conn,),
+                                                  name='vms-worker-%d' % len(self.workers))
+                process.daemon = True
+                process.start()
+                child_conn.close()
+                self.workers.append((process, conn))
+                return (process, conn)
+        return self.idle.get()
+
+    def apply(self, fn, args, kwargs):
+        process, conn = self._worker()
+        try:
+            conn.send((fn, args, kwargs))
+            ok, result = conn.recv()
+        except (EOFError, IOError):
+            # The worker is gone: replace it the next time one is needed.
+            with self.lock:
+                self.workers.remove((process, conn))
+            process.join(0)
+            raise
+        self.idle.put((process, conn))
+        if not ok:
+            raise result
+        return result
+
+def picklable(fn):
+    """ Returns True if fn can be sent to a worker process. """
+    try:
+        cPickle.dumps(fn, cPickle.HIGHEST_PROTOCOL)
+        return True
+    except Exception:
+        return False
+
+class VmsExecutor(object):
+
+    def __init__(self, limits=None, default_limit=None, process_commands=None,
+                 processes=None):
+        if limits == None:
+            limits = parse_limits(FLAGS.gridcentric_vms_concurrency)
+        if default_limit == None:
+            default_limit = FLAGS.gridcentric_vms_default_concurrency
+        if process_commands == None:
+            process_commands = FLAGS.gridcentric_vms_process_commands
+        if processes == None:
+            processes = FLAGS.gridcentric_vms_processes
+
+        self.limits = limits
+        self.default_limit = default_limit
+        self.process_commands = process_commands
+        self.processes = processes
+        self.process_pool = None
+        self.semaphores = {}
+        self.pools = {}
+        self.command_stats = {}
+
+    def _limit(self, command):
+        return self.limits.get(command, self.default_limit)
+
+    def _semaphore(self, command):
+        if command not in self.semaphores:
+            self.semaphores[command] = semaphore.Semaphore(self._limit(command))
+        return self.semaphores[command]
+
+    def _pool(self, command):
+        if command not in self.pools:
+            self.pools[command] = ThreadPool(command, self._limit(command))
+        return self.pools[command]
+
+    def _get_process_pool(self):
+        if self.process_pool == None:
+            self.process_pool = ProcessPool(self.processes)
+        return self.process_pool
+
+    def _in_process(self, command, fn):
+        if command not in self.process_commands:
+            return False
+        if not picklable(fn):
+            LOG.debug(_("vms %s cannot run in a worker process (%s cannot be pickled)."),
+                      command, fn)
+            return False
+        return True
+
+    def _stats(self, command):
+        if command not in self.command_stats:
+            self.command_stats[command] = CommandStats()
+        return self.command_stats[command]
+
+    def execute(self, command, fn, *args, **kwargs):
+        """
+        Runs fn(*args, **kwargs) on the threads of command (or, for the
+        process commands, in a worker process) once one of them is available,
+        and returns its result.
+        """
+        stats = self._stats(command)
+        lock = self._semaphore(command)
+
+        submitted = time.time()
+        stats.queued += 1
+        lock.acquire()
+        try:
+            stats.queued -= 1
+            started = time.time()
+            wait_time = started - submitted
+            stats.wait_time += wait_time
+            stats.max_wait_time = max(stats.max_wait_time, wait_time)
+            stats.running += 1
+            try:
+                if self._in_process(command, fn):
+                    result = self._pool(command).execute(self._get_process_pool().apply,
+                                                         fn, args, kwargs)
+                else:
+                    result = self._pool(command).execute(fn, *args, **kwargs)
+                stats.completed += 1
+                return result
+            except:
+                stats.failed += 1
+                raise
+            finally:
+                run_time = time.time() - started
+                stats.running -= 1
+                stats.run_time += run_time
+                stats.max_run_time = max(stats.max_run_time, run_time)
+                LOG.debug(_("vms %s waited %.3fs and ran for %.3fs"),
+                          command, wait_time, run_time)
+        finally:
+            lock.release()
+
+    def queue_depth(self, command=None):
+        """ Returns the number of commands (of the given type) waiting to run. """
+        if command != None:
+            return self._stats(command).queued
+        return sum([stats.queued for stats in self.command_stats.values()])
+
+    def stats(self):
+        """ Returns the statistics of every type of command, keyed by command. """
+        return dict([(command, stats.to_dict())
+                     for command, stats in self.command_stats.items()])
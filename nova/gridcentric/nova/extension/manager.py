@@ -20,13 +20,15 @@ The :py:class:`GridCentricManager` class is a :py:class:`nova.manager.Manager` t
 handles RPC calls relating to GridCentric functionality creating instances.
 """
 
+import datetime
 import time
 import traceback
 import os
-import re
 import socket
 import subprocess
 
+import eventlet
+
 from nova import exception
 from nova import flags
 from nova.openstack.common import cfg
@@ -55,10 +57,42 @@ gridcentric_opts = [
                      'mutliple launches on the same host will be processed synchronously. '
                      'This timeout can be raised to ensure that launch waits long enough '
                      'for nova-compute to process its request. By default this uses the '
-                     'standard nova-wide rpc timeout.')]
+                     'standard nova-wide rpc timeout.'),
+
+                cfg.ListOpt('gridcentric_prefetch_hosts',
+                default=[],
+                help='Hosts that should download the artifacts of every new blessed instance '
+                     'as soon as it is blessed. Only used with gridcentric_use_image_service.'),
+
+                cfg.IntOpt('gridcentric_prefetch_lineage_hosts',
+                default=4,
+                help='The number of hosts, taken from the most recent launches of earlier '
+                     'blessed instances of the same instance, that should download the '
+                     'artifacts of a new blessed instance as soon as it is blessed. Only used '
+                     'with gridcentric_use_image_service.'),
+
+                cfg.StrOpt('gridcentric_memory_server_address',
+                default=None,
+                help='The address (or interface) that the memory servers shared by a batch '
+                     'of launches listen on. By default this is the outgoing migration '
+                     'address, or the host ip.'),
+
+                cfg.IntOpt('gridcentric_memory_server_ttl',
+                default=1800,
+                help='The number of seconds after which the memory server shared by a batch '
+                     'of launches is killed, even if some of the launches have not reported '
+                     'back.'),
+
+                cfg.IntOpt('gridcentric_artifact_peers_ttl',
+                default=60,
+                help='The number of seconds the hosts running the clones of a blessed '
+                     'instance are remembered for, when looking for artifact peers or '
+                     'for the hosts to prefetch a new blessed instance on.')]
 FLAGS.register_opts(gridcentric_opts)
 
+from nova import context as nova_context
 from nova import manager
+from nova import quota
 from nova import utils
 from nova.openstack.common import rpc
 from nova import network
@@ -78,23 +112,18 @@ from nova.notifier import api as notifier
 
 from gridcentric.nova.api import API
 import gridcentric.nova.extension.vmsconn as vmsconn
+import gridcentric.nova.extension.artifacts as artifacts
+# Also used through manager.memory_string_to_pages by older callers.
+from gridcentric.nova.memory import memory_string_to_pages
+import gridcentric.nova.memory as memory
 
-def memory_string_to_pages(mem):
-    mem = mem.lower()
-    units = { '^(\d+)tb$' : 40,
-              '^(\d+)gb$' : 30,
-              '^(\d+)mb$' : 20,
-              '^(\d+)kb$' : 10,
-              '^(\d+)b$' : 0,
-              '^(\d+)$' : 0 }
-    for (pattern, shift) in units.items():
-        m = re.match(pattern, mem)
-        if m is not None:
-            val = long(m.group(1))
-            memory = val << shift
-            # Shift to obtain pages, at least one
-            return max(1, memory >> 12)
-    raise ValueError('Invalid target string %s.' % mem)
+QUOTAS = quota.QUOTAS
+
+# How far back (in seconds) to look for deleted clones the first time.
+DELETED_CHARGES_WINDOW = 86400
+
+# The methods that can be cast to a host through run_batch.
+BATCH_METHODS = ('bless_instance', 'discard_instance')
 
 class GridCentricManager(manager.SchedulerDependentManager):
 
@@ -104,7 +133,17 @@ class GridCentricManager(manager.SchedulerDependentManager):
         self.network_api = network.API()
         self.gridcentric_api = API()
         self.compute_manager = compute_manager.ComputeManager()
+        # The hosts running the clones of each blessed instance, and when they
+        # were looked up.
+        self.clone_hosts = {}
+        # When the charges of the deleted clones were last settled. This is
+        # kept on disk so that no deletion is missed across a restart.
+        self.charges_settled_at = None
+        # The blessed instance and the guest memory of each clone running on
+        # this host, by name. Loaded from the database on first use.
+        self.clones = None
         super(GridCentricManager, self).__init__(service_name="gridcentric", *args, **kwargs)
+        self._init_artifact_server()
 
     def _init_vms(self):
         """ Initializes the hypervisor options depending on the openstack connection type. """
@@ -112,6 +151,54 @@ class GridCentricManager(manager.SchedulerDependentManager):
         self.vms_conn = vmsconn.get_vms_connection(connection_type)
         self.vms_conn.configure()
 
+    def _init_artifact_server(self):
+        """ Serves the local artifact cache to the other gridcentric hosts. """
+        self.artifact_server = None
+        if FLAGS.gridcentric_use_image_service and FLAGS.gridcentric_artifact_port:
+            if not FLAGS.gridcentric_artifact_secret:
+                LOG.error(_("Not serving the artifact cache: gridcentric_artifact_secret "
+                            "is not set."))
+                return
+            self.artifact_server = artifacts.ArtifactServer(
+                                        os.path.join(FLAGS.instances_path, '_base'))
+            self.artifact_server.start()
+
+    def get_vms_stats(self, context):
+        """ Returns the queue depth, wait and run times of the vms commands on this host. """
+        return self.vms_conn.executor.stats()
+
+    def run_batch(self, context, calls):
+        """
+        Runs a batch of calls (each a method and its args) that were cast to
+        this host in a single message. The calls run concurrently.
+        """
+        for call in calls:
+            method = call.get('method')
+            if method not in BATCH_METHODS:
+                LOG.warn(_("Ignoring batched call to %s."), method)
+                continue
+            eventlet.spawn_n(self._run_batch_call, context, method, call.get('args', {}))
+
+    def _run_batch_call(self, context, method, args):
+        try:
+            getattr(self, method)(context, **args)
+        except Exception, e:
+            LOG.debug(_("Error during batched %s: %s"), method, traceback.format_exc())
+
+    def _notify(self, context, instance_ref, event_type, metadata=None, network_info=None):
+        """
+        Sends a gridcentric notification about instance_ref, including its
+        parent (taken from metadata, or from the metadata loaded with
+        instance_ref). The API resolves the rest of the lineage.
+        """
+        usage_info = utils.usage_from_instance(instance_ref, network_info=network_info)
+        if metadata == None:
+            metadata = dict([(item['key'], item['value'])
+                             for item in instance_ref['metadata']])
+        usage_info['parent_id'] = metadata.get('launched_from') or \
+                                  metadata.get('blessed_from')
+        notifier.notify('gridcentric.%s' % self.host, event_type, notifier.INFO, usage_info)
+
     def _instance_update(self, context, instance_uuid, **kwargs):
         """Update an instance in the database using kwargs as value."""
         return self.db.instance_update(context, instance_uuid, kwargs)
@@ -163,10 +250,7 @@ class GridCentricManager(manager.SchedulerDependentManager):
             source_instance_ref = instance_ref
             migration = True
         else:
-            usage_info = utils.usage_from_instance(instance_ref)
-            notifier.notify('gridcentric.%s' % self.host,
-                            'gridcentric.instance.bless.start',
-                            notifier.INFO, usage_info)
+            self._notify(context, instance_ref, 'gridcentric.instance.bless.start')
             source_instance_ref = self._get_source_instance(context, instance_uuid)
             migration = False
 
@@ -179,10 +263,7 @@ class GridCentricManager(manager.SchedulerDependentManager):
                                                 migration_url=migration_url,
                                                 use_image_service=FLAGS.gridcentric_use_image_service)
             if not(migration):
-                usage_info = utils.usage_from_instance(instance_ref)
-                notifier.notify('gridcentric.%s' % self.host,
-                                'gridcentric.instance.bless.end',
-                                notifier.INFO, usage_info)
+                self._notify(context, instance_ref, 'gridcentric.instance.bless.end')
                 self._instance_update(context, instance_ref.id,
                                   vm_state="blessed", task_state=None,
                                   launched_at=utils.utcnow())
@@ -201,9 +282,108 @@ class GridCentricManager(manager.SchedulerDependentManager):
             metadata['blessed'] = True
         self._instance_metadata_update(context, instance_ref['uuid'], metadata)
 
+        if not(migration) and FLAGS.gridcentric_use_image_service:
+            # Warm up the hosts that are likely to launch this instance.
+            try:
+                self._prefetch_instance_on_hosts(context, instance_ref, source_instance_ref)
+            except Exception, e:
+                LOG.debug(_("Error while starting the prefetch of %s: %s"), instance_uuid, str(e))
+
         # Return the memory URL (will be None for a normal bless).
         return migration_url
 
+    def _prefetch_hosts(self, context, source_instance_ref):
+        """
+        Returns the hosts that are likely to launch a new blessed instance of
+        source_instance_ref: the configured hosts, followed by the hosts that
+        most recently launched from earlier blessed instances of it.
+        """
+        admin_context = context.elevated(read_deleted='yes')
+        live_hosts = self._live_hosts(admin_context)
+
+        hosts = [host for host in FLAGS.gridcentric_prefetch_hosts if host in live_hosts]
+        max_hosts = len(hosts) + FLAGS.gridcentric_prefetch_lineage_hosts
+        if FLAGS.gridcentric_prefetch_lineage_hosts <= 0:
+            return hosts
+
+        # The instances are returned newest first. The hosts of the clones of
+        # each sibling are cached, so that a bless does not look up the clones
+        # of every earlier blessed instance again.
+        siblings = self.db.instance_get_all_by_filters(admin_context,
+                        {'metadata': {'blessed_from': source_instance_ref['uuid']}})
+        for sibling in siblings:
+            for host in self._clone_hosts(admin_context, sibling['uuid']):
+                if host in live_hosts and host not in hosts:
+                    hosts.append(host)
+                    if len(hosts) >= max_hosts:
+                        return hosts
+        return hosts
+
+    def _live_hosts(self, context):
+        return [service['host'] for service in
+                    self.db.service_get_all_by_topic(context, FLAGS.gridcentric_topic)
+                    if utils.service_is_up(service)]
+
+    def _clone_hosts(self, context, blessed_uuid):
+        """ Returns the hosts running clones of blessed_uuid (cached for a while). """
+        hosts, looked_up = self.clone_hosts.get(blessed_uuid, (None, 0))
+        now = time.time()
+        if hosts == None or now - looked_up > FLAGS.gridcentric_artifact_peers_ttl:
+            hosts = []
+            for instance in self.db.instance_get_all_by_filters(context,
+                                {'metadata': {'launched_from': blessed_uuid}}):
+                if instance['host'] and instance['host'] not in hosts:
+                    hosts.append(instance['host'])
+            for uuid, (cached, looked_up) in self.clone_hosts.items():
+                if now - looked_up > FLAGS.gridcentric_artifact_peers_ttl:
+                    del self.clone_hosts[uuid]
+            self.clone_hosts[blessed_uuid] = (hosts, now)
+        return hosts
+
+    def _artifact_peers(self, context, instance_ref):
+        """
+        Returns a function giving the gridcentric hosts to ask for the
+        artifacts of the blessed instance_ref: the hosts running its clones
+        (which have the artifacts cached) first, then the other live hosts.
+        The hosts are only looked up when an artifact has to be downloaded.
+        """
+        def peers():
+            if not FLAGS.gridcentric_artifact_port:
+                return []
+            admin_context = context.elevated()
+            live_hosts = [host for host in self._live_hosts(admin_context) if host != self.host]
+            likely_hosts = [host for host in self._clone_hosts(admin_context, instance_ref['uuid'])
+                            if host in live_hosts]
+            return artifacts.order_peers(likely_hosts, live_hosts)
+        return peers
+
+    def _prefetch_instance_on_hosts(self, context, instance_ref, source_instance_ref):
+        for host in self._prefetch_hosts(context, source_instance_ref):
+            LOG.debug(_("Asking %s to prefetch the artifacts of %s"), host, instance_ref['uuid'])
+            rpc.cast(context,
+                     self.db.queue_get_for(context, FLAGS.gridcentric_topic, host),
+                     {"method": "prefetch_instance",
+                      "args": {'instance_uuid': instance_ref['uuid']}})
+
+    def prefetch_instance(self, context, instance_uuid):
+        """
+        Downloads the artifacts of a blessed instance into the local cache so
+        that the first launch on this host does not have to wait for them.
+        """
+        LOG.debug(_("prefetch instance called: instance_uuid=%s"), instance_uuid)
+        if not FLAGS.gridcentric_use_image_service:
+            return
+
+        instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
+        metadata = self._instance_metadata(context, instance_uuid)
+        image_refs = self._extract_image_refs(metadata)
+        try:
+            self.vms_conn.prefetch(context, instance_ref, image_refs,
+                                   artifact_peers=self._artifact_peers(context, instance_ref))
+        except Exception, e:
+            # This is only an optimization, the launch will fetch the artifacts itself.
+            LOG.debug(_("Error during prefetch %s: %s"), str(e), traceback.format_exc())
+
     def migrate_instance(self, context, instance_uuid, dest):
         """
         Migrates an instance, dealing with special streaming cases as necessary.
@@ -361,12 +541,10 @@ class GridCentricManager(manager.SchedulerDependentManager):
 
         # Grab the DB representation for the VM.
         instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
-        usage_info = utils.usage_from_instance(instance_ref)
-        notifier.notify('gridcentric.%s' % self.host,
-                        'gridcentric.instance.discard.start',
-                        notifier.INFO, usage_info)
-
         metadata = self._instance_metadata(context, instance_uuid)
+        self._notify(context, instance_ref, 'gridcentric.instance.discard.start',
+                     metadata=metadata)
+
         image_refs = self._extract_image_refs(metadata)
         # Call discard in the backend.
         self.vms_conn.discard(context, instance_ref.name,
@@ -384,18 +562,279 @@ class GridCentricManager(manager.SchedulerDependentManager):
                               task_state=None,
                               terminated_at=timeutils.utcnow())
         self.db.instance_destroy(context, instance_uuid)
-        usage_info = utils.usage_from_instance(instance_ref)
-        notifier.notify('gridcentric.%s' % self.host,
-                        'gridcentric.instance.discard.end',
-                        notifier.INFO, usage_info)
+        self._notify(context, instance_ref, 'gridcentric.instance.discard.end',
+                     metadata=metadata)
 
-    def launch_instance(self, context, instance_uuid, params={}, migration_url=None):
+    def start_memory_server(self, context, instance_uuid, clients):
+        """
+        Starts a memory server for the blessed instance instance_uuid that is
+        shared by a batch of clients launches. Returns the url of the server,
+        or None if the clones should read the memory from the files instead.
+        """
+        LOG.debug(_("start memory server called: instance_uuid=%s, clients=%s"),
+                    instance_uuid, clients)
+        if not self.vms_conn.can_serve():
+            return None
+        instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
+
+        address = FLAGS.gridcentric_memory_server_address
+        if address == None:
+            address = FLAGS.gridcentric_outgoing_migration_address or FLAGS.my_ip
+        try:
+            memory_url = self.vms_conn.serve(context, instance_ref['name'], "mcdist://%s" % address)
+        except Exception, e:
+            LOG.warn(_("Unable to start a memory server for %s: %s"), instance_uuid, str(e))
+            return None
+
+        self.vms_conn.memory_servers.hold(memory_url, clients, FLAGS.gridcentric_memory_server_ttl)
+        return memory_url
+
+    def release_memory_server(self, context, memory_url):
+        """ Called by each clone of a batch once it no longer needs the memory server. """
+        if self.vms_conn.memory_servers.release(memory_url):
+            LOG.debug(_("Launch batch using %s is done."), memory_url)
+            self.vms_conn.stop_serving(memory_url)
+
+    @manager.periodic_task
+    def _reap_memory_servers(self, context):
+        """ Kills the memory servers of batches that have not completed in time. """
+        for memory_url in self.vms_conn.memory_servers.expired():
+            LOG.warn(_("Launch batch using %s has expired."), memory_url)
+            self.vms_conn.stop_serving(memory_url)
+
+    def _project_context(self, instance):
+        """ Returns an admin context in the project of instance, for its quota. """
+        return nova_context.RequestContext(instance['user_id'], instance['project_id'],
+                                           is_admin=True)
+
+    @manager.periodic_task
+    def _update_working_sets(self, context):
+        """
+        Charges each running clone on this host the unique memory it uses (at
+        most the memory of its instance type), in the working_set quota mode.
+        """
+        if FLAGS.gridcentric_quota_mode != 'working_set':
+            return
+        for instance in self.db.instance_get_all_by_host(context, self.host):
+            metadata = dict([(item['key'], item['value']) for item in instance['metadata']])
+            if not metadata.get('launched_from') or instance['vm_state'] != vm_states.ACTIVE:
+                continue
+            measured = self.vms_conn.working_set_mb(instance['name'])
+            if measured == None:
+                continue
+            guest_mb = memory.guest_memory_mb(instance)
+            previous = memory.recorded_charge_mb(instance)
+            if previous == None:
+                previous = guest_mb
+            charged = min(guest_mb, max(1, measured))
+            delta = charged - previous
+            if abs(delta) < FLAGS.gridcentric_working_set_min_delta_mb:
+                continue
+
+            project_context = self._project_context(instance)
+            try:
+                reservations = QUOTAS.reserve(project_context, ram=delta)
+            except exception.OverQuota:
+                LOG.warn(_("Working set of %s has grown to %dMB, over the ram quota of "
+                           "project %s."), instance['uuid'], charged, instance['project_id'])
+                continue
+            try:
+                self.db.instance_system_metadata_update(context, instance['uuid'],
+                                                        {memory.CHARGE_KEY: str(charged)},
+                                                        False)
+            except:
+                QUOTAS.rollback(project_context, reservations)
+                raise
+            QUOTAS.commit(project_context, reservations)
+            LOG.debug(_("Charging %dMB for %s (was %dMB)."), charged, instance['uuid'],
+                      previous)
+
+    def _charge_launched(self, context, instance_ref, params):
+        """
+        Lowers the charge of a clone that has just been launched on this host
+        from the memory of its guest to what the quota mode asks for.
+        """
+        if FLAGS.gridcentric_quota_mode == 'full':
+            return
+        guest_mb = memory.guest_memory_mb(instance_ref)
+        charged = memory.charged_memory_mb(guest_mb, params.get('target'))
+        project_context = self._project_context(instance_ref)
+        try:
+            reservations = QUOTAS.reserve(project_context, ram=charged - guest_mb)
+            try:
+                self.db.instance_system_metadata_update(context, instance_ref['uuid'],
+                                                        {memory.CHARGE_KEY: str(charged)},
+                                                        False)
+            except:
+                QUOTAS.rollback(project_context, reservations)
+                raise
+            QUOTAS.commit(project_context, reservations)
+        except Exception, e:
+            # The clone simply stays charged the memory of its guest.
+            LOG.warn(_("Unable to lower the memory charged for %s: %s"),
+                     instance_ref['uuid'], str(e))
+
+    def _charges_state_path(self):
+        return os.path.join(FLAGS.state_path, 'gridcentric-charges-%s' % self.host)
+
+    def _load_charges_settled_at(self):
+        try:
+            with open(self._charges_state_path()) as state:
+                return float(state.read().strip())
+        except (IOError, ValueError):
+            return None
+
+    def _save_charges_settled_at(self, settled_at):
+        path = self._charges_state_path()
+        try:
+            with open(path + '.tmp', 'w') as state:
+                state.write('%f' % settled_at)
+            os.rename(path + '.tmp', path)
+        except (IOError, OSError), e:
+            LOG.warn(_("Unable to save the time the charges were settled: %s"), str(e))
+
+    @manager.periodic_task
+    def _settle_deleted_charges(self, context):
+        """
+        Corrects the ram usage of the projects of the clones deleted on this
+        host: nova released the memory of their guest, which is more than
+        they were charged. Only clones launched on a host have a lower charge
+        recorded, so the others need no correction.
+        """
+        now = time.time()
+        if self.charges_settled_at == None:
+            self.charges_settled_at = self._load_charges_settled_at()
+        since = self.charges_settled_at or now - DELETED_CHARGES_WINDOW
+        admin_context = context.elevated(read_deleted='yes')
+        deleted = self.db.instance_get_all_by_filters(admin_context,
+                        {'host': self.host, 'deleted': True,
+                         'changes-since': datetime.datetime.utcfromtimestamp(since - 60)})
+        for instance in deleted:
+            charged = memory.recorded_charge_mb(instance)
+            if charged == None:
+                continue
+            overreleased = memory.guest_memory_mb(instance) - charged
+            # Clear the charge first, so that the correction is never made twice.
+            system_metadata = memory.system_metadata(instance)
+            del system_metadata[memory.CHARGE_KEY]
+            self.db.instance_system_metadata_update(admin_context, instance['uuid'],
+                                                    system_metadata, True)
+            if overreleased <= 0:
+                continue
+            project_context = self._project_context(instance)
+            try:
+                reservations = QUOTAS.reserve(project_context, ram=overreleased)
+                QUOTAS.commit(project_context, reservations)
+            except Exception, e:
+                LOG.warn(_("Unable to settle the memory charged for %s: %s"),
+                         instance['uuid'], str(e))
+                self.db.instance_system_metadata_update(admin_context, instance['uuid'],
+                                                        {memory.CHARGE_KEY: str(charged)},
+                                                        False)
+        self.charges_settled_at = now
+        self._save_charges_settled_at(now)
+
+    def _record_clone(self, instance_ref):
+        metadata = dict([(item['key'], item['value']) for item in instance_ref['metadata']])
+        if self.clones != None and metadata.get('launched_from'):
+            self.clones[instance_ref['name']] = (metadata['launched_from'],
+                                                 memory.guest_memory_mb(instance_ref))
+
+    def _running_clones(self, context):
+        """
+        Returns the clones running on this host, by name, as (blessed uuid,
+        guest memory) pairs.
+        """
+        if self.clones == None:
+            clones = {}
+            for instance in self.db.instance_get_all_by_host(context, self.host):
+                metadata = dict([(item['key'], item['value']) for item in instance['metadata']])
+                if metadata.get('launched_from'):
+                    clones[instance['name']] = (metadata['launched_from'],
+                                                memory.guest_memory_mb(instance))
+            self.clones = clones
+        running = set(self.vms_conn.list_instances())
+        for name in self.clones.keys():
+            if name not in running:
+                del self.clones[name]
+        return self.clones
+
+    def _clone_counts(self, context):
+        """ Returns the number of clones of each blessed instance on this host. """
+        clones = {}
+        for blessed_uuid, guest_mb in self._running_clones(context).values():
+            clones[blessed_uuid] = clones.get(blessed_uuid, 0) + 1
+        return clones
+
+    def _sharing(self, context):
+        """
+        Returns the fraction of the memory of the clones of each blessed
+        instance that is shared, as measured on one of its clones.
+        """
+        sharing = {}
+        for name, (blessed_uuid, guest_mb) in self._running_clones(context).items():
+            if blessed_uuid in sharing or not guest_mb:
+                continue
+            unique_mb = self.vms_conn.working_set_mb(name)
+            if unique_mb != None:
+                sharing[blessed_uuid] = round(max(0.0, 1.0 - float(unique_mb) / guest_mb), 2)
+        return sharing
+
+    def get_capabilities(self, context):
+        """
+        Returns the state of vms on this host: its memory, the memory servers,
+        the blessed instances cached locally, the vms command queue, and the
+        clones of each blessed instance with the fraction of their memory
+        that is shared.
+        """
+        capabilities = {}
+        sources = [('memory', self.vms_conn.host_memory_stats),
+                   ('memory_servers', self.vms_conn.count_memory_servers),
+                   ('clones', lambda: self._clone_counts(context)),
+                   ('sharing', lambda: self._sharing(context))]
+        if FLAGS.gridcentric_use_image_service:
+            sources.append(('cached_blessed', lambda: artifacts.cached_blessed_instances(
+                                                os.path.join(FLAGS.instances_path, '_base'))))
+        for name, source in sources:
+            try:
+                capabilities[name] = source()
+            except Exception, e:
+                LOG.warn(_("Unable to get the %s capability: %s"), name, str(e))
+        capabilities['queue_depth'] = self.vms_conn.executor.queue_depth()
+        capabilities['launch_queue_depth'] = self.vms_conn.executor.queue_depth('launch')
+        return capabilities
+
+    @manager.periodic_task
+    def _report_capabilities(self, context):
+        """ Sends the state of vms on this host to the schedulers. """
+        self.update_service_capabilities(self.get_capabilities(context))
+
+    def launch_instance(self, context, instance_uuid, params={}, migration_url=None,
+                        memory_server=None):
         """
         Construct the launched instance, with uuid instance_uuid. If migration_url is not none then 
-        the instance will be launched using the memory server at the migration_url
+        the instance will be launched using the memory server at the migration_url. If
+        memory_server is given, the instance is part of a batch sharing the memory server
+        memory_server['url'] on memory_server['host'].
         """
-        LOG.debug(_("Launching new instance: instance_uuid=%s, migration_url=%s"),
-                    instance_uuid, migration_url)
+        memory_url = memory_server and memory_server['url']
+        try:
+            self._launch_instance(context, instance_uuid, params=params,
+                                  migration_url=migration_url, memory_url=memory_url)
+        finally:
+            if memory_server:
+                # The launch returns once the memory has been fetched, so
+                # the server is no longer needed by this clone.
+                rpc.cast(context,
+                         self.db.queue_get_for(context, FLAGS.gridcentric_topic,
+                                               memory_server['host']),
+                         {"method": "release_memory_server",
+                          "args": {'memory_url': memory_url}})
+
+    def _launch_instance(self, context, instance_uuid, params={}, migration_url=None,
+                         memory_url=None):
+        LOG.debug(_("Launching new instance: instance_uuid=%s, migration_url=%s, memory_url=%s"),
+                    instance_uuid, migration_url, memory_url)
 
         # Grab the DB representation for the VM.
         instance_ref = self.db.instance_get_by_uuid(context, instance_uuid)
@@ -416,10 +855,7 @@ class GridCentricManager(manager.SchedulerDependentManager):
                                   host=self.host)
             instance_ref['host'] = self.host
         else:
-            usage_info = utils.usage_from_instance(instance_ref)
-            notifier.notify('gridcentric.%s' % self.host,
-                            'gridcentric.instance.launch.start',
-                            notifier.INFO, usage_info)
+            self._notify(context, instance_ref, 'gridcentric.instance.launch.start')
             # Create a new launched instance.
             source_instance_ref = self._get_source_instance(context, instance_uuid)
 
@@ -474,6 +910,9 @@ class GridCentricManager(manager.SchedulerDependentManager):
         # Extract out the image ids from the source instance's metadata. 
         metadata = self.db.instance_metadata_get(context, source_instance_ref['id'])
         image_refs = self._extract_image_refs(metadata)
+        artifact_peers = []
+        if FLAGS.gridcentric_use_image_service and migration_url == None:
+            artifact_peers = self._artifact_peers(context, source_instance_ref)
         try:
             # The main goal is to have the nova-compute process take ownership of setting up
             # the networking for the launched instance. This ensures that later changes to the
@@ -501,14 +940,16 @@ class GridCentricManager(manager.SchedulerDependentManager):
                                  migration_url=migration_url,
                                  use_image_service=FLAGS.gridcentric_use_image_service,
                                  image_refs=image_refs,
-                                 params=params)
+                                 params=params,
+                                 artifact_peers=artifact_peers,
+                                 memory_url=memory_url)
+            self._record_clone(instance_ref)
 
             # Perform our database update.
             if migration_url == None:
-                usage_info = utils.usage_from_instance(instance_ref, network_info=network_info)
-                notifier.notify('gridcentric.%s' % self.host,
-                                'gridcentric.instance.launch.end',
-                                notifier.INFO, usage_info)
+                self._charge_launched(context, instance_ref, params)
+                self._notify(context, instance_ref, 'gridcentric.instance.launch.end',
+                             network_info=network_info)
                 self._instance_update(context,
                                   instance_ref['uuid'],
                                   vm_state=vm_states.ACTIVE,
@@ -18,12 +18,19 @@ Interfaces that configure vms and perform hypervisor specific operations.
 """
 
 import os
+import re
 import pwd
+import random
 import stat
+import shutil
 import time
 import glob
+import errno
+import ctypes
+import ctypes.util
 import threading
 import tempfile
+from xml.etree import ElementTree
 
 import nova
 from nova import exception
@@ -41,10 +48,82 @@ vmsconn_opts = [
 
                cfg.StrOpt('openstack_user',
                default='',
-               help='The openstack user')]
+               help='The openstack user'),
+
+               cfg.BoolOpt('gridcentric_cache_domain_templates',
+               default=True,
+               help='Cache the libvirt domain xml and working directory of the first '
+                    'instance launched from a blessed instance, and patch them for '
+                    'subsequent launches instead of regenerating them.'),
+
+               cfg.StrOpt('gridcentric_libvirt_pid_path',
+               default='/var/run/libvirt/qemu',
+               help='The directory where libvirt writes the pid file of each qemu '
+                    'process. Used to find the memory servers of migrations and to measure '
+                    'the working set of launched instances.'),
+
+               cfg.BoolOpt('gridcentric_simulate',
+               default=False,
+               help='Use a simulated hypervisor instead of vms. This is meant for load '
+                    'and latency testing without a hypervisor.')]
 FLAGS.register_opts(vmsconn_opts)
 
-from eventlet import tpool
+simulation_opts = [
+               cfg.ListOpt('gridcentric_sim_latency',
+               default=['bless:lognormal:0.5:0.4', 'launch:lognormal:0.0:0.5',
+                        'discard:uniform:0.1:0.5', 'replug:uniform:0.05:0.2',
+                        'fetch:lognormal:0.0:0.5', 'domain:lognormal:-1.5:0.5',
+                        'template:uniform:0.005:0.02'],
+               help='The latency distribution, in seconds, of each simulated command, '
+                    'given as a list of <command>:<distribution>:<parameters>. The '
+                    'distributions are fixed:<value>, uniform:<min>:<max>, '
+                    'normal:<mean>:<stddev>, lognormal:<mu>:<sigma> and '
+                    'exponential:<mean>. Besides the vms commands, the launches '
+                    'simulate fetching the artifacts of a blessed instance (fetch), '
+                    'generating a domain (domain) and patching a cached domain '
+                    'template (template).'),
+
+               cfg.ListOpt('gridcentric_sim_failure_rate',
+               default=[],
+               help='The probability that a simulated command fails, given as a list of '
+                    '<command>:<probability>.'),
+
+               cfg.IntOpt('gridcentric_sim_host_memory_mb',
+               default=16384,
+               help='The memory available to simulated instances on this host.'),
+
+               cfg.FloatOpt('gridcentric_sim_shared_ratio',
+               default=0.8,
+               help='The fraction of a simulated clone\'s memory that is shared with '
+                    'its blessed instance (when it is launched without a target).'),
+
+               cfg.FloatOpt('gridcentric_sim_memory_image_ratio',
+               default=1.0,
+               help='The size of the simulated memory image written by bless, as a '
+                    'fraction of the instance\'s memory.'),
+
+               cfg.IntOpt('gridcentric_sim_descriptor_kb',
+               default=64,
+               help='The size of the simulated descriptor written by bless.'),
+
+               cfg.BoolOpt('gridcentric_sim_sparse_artifacts',
+               default=True,
+               help='Write the simulated artifacts as sparse files. When false the '
+                    'artifacts are filled in, which also simulates the disk load.'),
+
+               cfg.StrOpt('gridcentric_sim_path',
+               default=None,
+               help='The directory the simulated artifacts are written to. By default a '
+                    'temporary directory is used.'),
+
+               cfg.IntOpt('gridcentric_sim_seed',
+               default=None,
+               help='The random seed for the simulation.')]
+FLAGS.register_opts(simulation_opts)
+
+from gridcentric.nova.extension import artifacts
+from gridcentric.nova.extension import executor
+import gridcentric.nova.memory as memory
 
 import vms.commands as commands
 import vms.logger as logger
@@ -60,6 +139,253 @@ def mkdir_as(path, uid):
 def touch_as(path, uid):
     utilities.check_command(['sudo', '-u', '#%d' % uid, 'touch', path])
 
+def fsync_path(path):
+    """ Flushes the given file (or directory) to disk. """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+_libc = None
+
+def syncfs_path(path):
+    """
+    Flushes the filesystem that contains path to disk. This is the fallback
+    when the files cannot be flushed individually, and is still much cheaper
+    than a global sync() on a host with many other VMs.
+    """
+    global _libc
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if not hasattr(_libc, 'syncfs'):
+        raise OSError(errno.ENOSYS, "syncfs is not available")
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        if _libc.syncfs(fd) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+    finally:
+        os.close(fd)
+
+def domain_disk_paths(libvirt_file):
+    """ Returns the paths of the file backed disks in the libvirt xml file. """
+    try:
+        tree = ElementTree.parse(libvirt_file)
+    except (IOError, SyntaxError):
+        return []
+    paths = []
+    for source in tree.findall('devices/disk/source'):
+        path = source.get('file')
+        if path:
+            paths.append(path)
+    return paths
+
+def network_tokens(network_info):
+    """
+    Returns, for each vif in network_info, the values that are unique to the
+    instance owning it (i.e. the mac address and the assigned ips).
+    """
+    tokens = []
+    for vif in network_info or []:
+        if isinstance(vif, tuple):
+            # The legacy network info format.
+            network_ref, mapping = vif
+            mac = mapping['mac']
+            ips = [ip['ip'] for ip in mapping.get('ips', []) + mapping.get('ip6s', [])]
+        else:
+            mac = vif['address']
+            ips = [ip['address'] for subnet in vif['network']['subnets']
+                                 for ip in subnet['ips']]
+        # The firewall filter names use the mac address without the colons.
+        tokens.append([mac, mac.replace(':', '')] + ips)
+    return tokens
+
+def network_shape(network_info):
+    """ Returns the parts of network_info that are shared between siblings. """
+    shape = []
+    for vif in network_info or []:
+        if isinstance(vif, tuple):
+            network_ref, mapping = vif
+            bridge = network_ref.get('bridge')
+            num_ips = len(mapping.get('ips', [])) + len(mapping.get('ip6s', []))
+        else:
+            bridge = vif['network']['bridge']
+            num_ips = sum([len(subnet['ips']) for subnet in vif['network']['subnets']])
+        shape.append((bridge, num_ips))
+    return tuple(shape)
+
+# The files of a working directory that are never part of a template: the
+# root disk is replaced by vms and the rest are written per instance.
+TEMPLATE_SKIPPED_FILES = ("disk", "libvirt.xml", "console.log")
+
+def instance_artifact(path):
+    """
+    Returns True if path (in a working directory) is generated for its
+    instance alone (e.g. the config drive, the kernel and ramdisk or the
+    ephemeral disks), so that a template cannot stand in for it.
+    """
+    return path in ("disk.config", "disk.local", "disk.swap", "kernel", "ramdisk") or \
+           path.startswith("disk.eph")
+
+def _token_pattern(token):
+    return re.compile(r'(?<![\w.:])%s(?![\w.:])' % re.escape(token))
+
+class DomainTemplate(object):
+    """
+    The libvirt domain xml and working directory skeleton of an instance
+    launched from a blessed instance. Siblings launched from the same blessed
+    instance only differ in their name, uuid, mac addresses and ips (and the
+    paths derived from those), so the template is patched instead of asking
+    libvirt to regenerate everything.
+    """
+
+    def __init__(self, xml, instance_ref, network_info, skeleton_dir):
+        self.xml = xml
+        self.skeleton_dir = skeleton_dir
+        self.tokens = [instance_ref['name'], instance_ref['uuid']]
+        for vif_tokens in network_tokens(network_info):
+            self.tokens += vif_tokens
+
+    def render(self, instance_ref, network_info):
+        """
+        Returns the domain xml for instance_ref, or None if the template
+        cannot be safely patched for this instance.
+        """
+        new_tokens = [instance_ref['name'], instance_ref['uuid']]
+        for vif_tokens in network_tokens(network_info):
+            new_tokens += vif_tokens
+        if len(new_tokens) != len(self.tokens):
+            return None
+
+        xml = self.xml
+        replacements = [(old, new) for (old, new) in zip(self.tokens, new_tokens) if old != new]
+        # Replace the longest values first so that a value is never clobbered
+        # by a replacement of one of its prefixes.
+        replacements.sort(key=lambda pair: len(pair[0]), reverse=True)
+        for old, new in replacements:
+            xml = _token_pattern(old).sub(new, xml)
+
+        # Make sure that nothing from the template instance has leaked through.
+        for old, new in replacements:
+            if old not in new_tokens and _token_pattern(old).search(xml):
+                return None
+        return xml
+
+    def populate(self, working_dir):
+        """ Copies the working directory skeleton into working_dir. """
+        for root, dirs, files in os.walk(self.skeleton_dir):
+            target_root = os.path.join(working_dir, os.path.relpath(root, self.skeleton_dir))
+            for path in dirs:
+                target = os.path.join(target_root, path)
+                if not os.path.exists(target):
+                    os.mkdir(target)
+            for path in files:
+                shutil.copyfile(os.path.join(root, path), os.path.join(target_root, path))
+
+    def exists(self):
+        return os.path.isdir(self.skeleton_dir)
+
+    def remove(self):
+        shutil.rmtree(self.skeleton_dir, ignore_errors=True)
+
+def memory_server_address(url):
+    """ Returns the address part of a memory server url (e.g. mcdist://host:port). """
+    return url and url.split('://', 1)[-1]
+
+def control_for_pid(pid):
+    """ Returns the vms control of the process pid, or None if it has none. """
+    try:
+        return control.Control(pid)
+    except control.ControlException:
+        return None
+
+class MemoryServerRegistry(object):
+    """
+    Keeps track of the memory servers started on this host, indexed by the
+    url that they serve. The control of a server is recorded when it is
+    started, so that it can be killed directly once it is no longer needed.
+    Only the servers started before a restart have to be found by probing
+    every vms control endpoint on the host.
+
+    Memory servers that are shared by a batch of launches also carry a
+    reference count and a deadline, so that they can be torn down once every
+    clone is done with them (or once the batch has taken too long).
+    """
+
+    def __init__(self):
+        self.servers = {}
+        self.references = {}
+        self.deadlines = {}
+        self.lock = threading.Lock()
+
+    def _find(self, url):
+        address = memory_server_address(url)
+        for ctrl in control.probe():
+            try:
+                if memory_server_address(ctrl.get("network")) == address:
+                    return ctrl
+            except control.ControlException:
+                pass
+        return None
+
+    def register(self, url, ctrl):
+        """ Records the control of the memory server that has just been started for url. """
+        with self.lock:
+            self.servers[memory_server_address(url)] = ctrl
+
+    def lookup(self, url):
+        with self.lock:
+            return self.servers.get(memory_server_address(url))
+
+    def hold(self, url, references, ttl):
+        """ Adds references to the server for url, for at most ttl seconds. """
+        address = memory_server_address(url)
+        with self.lock:
+            self.references[address] = self.references.get(address, 0) + references
+            self.deadlines[address] = time.time() + ttl
+
+    def release(self, url):
+        """
+        Drops a reference to the server for url. Returns True if this was the
+        last reference, in which case the server should be killed.
+        """
+        address = memory_server_address(url)
+        with self.lock:
+            if address not in self.references:
+                return False
+            self.references[address] -= 1
+            if self.references[address] > 0:
+                return False
+            del self.references[address]
+            del self.deadlines[address]
+            return True
+
+    def expired(self):
+        """ Returns (and forgets the references of) the servers past their deadline. """
+        now = time.time()
+        with self.lock:
+            expired = [address for address, deadline in self.deadlines.items()
+                       if deadline <= now]
+            for address in expired:
+                del self.references[address]
+                del self.deadlines[address]
+        return expired
+
+    def kill(self, url, timeout=1.0):
+        """ Kills the memory server for url (if there is one). """
+        with self.lock:
+            ctrl = self.servers.pop(memory_server_address(url), None)
+        if ctrl == None:
+            # We may have been restarted since the server was started, so look
+            # for it the hard way.
+            ctrl = self._find(url)
+        if ctrl != None:
+            try:
+                ctrl.kill(timeout=timeout)
+            except control.ControlException:
+                pass
+
 class AttribDictionary(dict):
     """ A subclass of the python Dictionary that will allow us to add attribute. """
     def __init__(self, base):
@@ -70,7 +396,9 @@ class AttribDictionary(dict):
 def get_vms_connection(connection_type):
     # Configure the logger regardless of the type of connection that will be used.
     logger.setup_for_library()
-    if connection_type == 'xenapi':
+    if FLAGS.gridcentric_simulate:
+        return SimulatedConnection()
+    elif connection_type == 'xenapi':
         return XenApiConnection()
     elif connection_type == 'libvirt':
         return LibvirtConnection()
@@ -86,6 +414,10 @@ def select_hypervisor(hypervisor):
     LOG.debug(_("Virt initialized as auto=%s"), virt.AUTO)
 
 class VmsConnection:
+    def __init__(self):
+        self.memory_servers = MemoryServerRegistry()
+        self.executor = executor.VmsExecutor()
+
     def configure(self):
         """
         Configures vms for this type of connection.
@@ -101,13 +433,17 @@ class VmsConnection:
         new_instance_name = new_instance_ref['name']
         LOG.debug(_("Calling commands.bless with name=%s, new_name=%s, migration_url=%s"),
                     instance_name, new_instance_name, str(migration_url))
-        (newname, network, blessed_files) = tpool.execute(commands.bless,
+        (newname, network, blessed_files) = self.executor.execute('bless', commands.bless,
                                instance_name,
                                new_instance_name,
                                mem_url=migration_url,
                                migration=(migration_url and True))
         LOG.debug(_("Called commands.bless with name=%s, new_name=%s, migration_url=%s"),
                     instance_name, new_instance_name, str(migration_url))
+        if migration_url:
+            # Remember the memory server so that it can be cleaned up directly
+            # once the migration is done. It is served by the (paused) domain.
+            self._register_memory_server(network, self._domain_pid(instance_name))
         if use_image_service:
             blessed_files = self.upload_files(context, new_instance_ref, blessed_files)
         return (newname, network, blessed_files)
@@ -121,7 +457,7 @@ class VmsConnection:
         Dicard all of the vms artifacts associated with a blessed instance
         """
         LOG.debug(_("Calling commands.discard with name=%s"), instance_name)
-        result = tpool.execute(commands.discard, instance_name)
+        result = self.executor.execute('discard', commands.discard, instance_name)
         LOG.debug(_("Called commands.discard with name=%s"), instance_name)
         if use_image_service:
             self._delete_images(context, image_refs)
@@ -144,14 +480,19 @@ class VmsConnection:
 
     def launch(self, context, instance_name, mem_target,
                new_instance_ref, network_info, migration_url=None,
-               use_image_service=False, image_refs=[], params={}):
+               use_image_service=False, image_refs=[], params={}, artifact_peers=[],
+               memory_url=None):
         """
-        Launch a blessed instance
+        Launch a blessed instance. If memory_url is given, the memory of the
+        blessed instance is streamed from the memory server at that url
+        instead of being read from the local files.
         """
         newname, path = self.pre_launch(context, new_instance_ref, network_info,
                                   migration=(migration_url and True),
                                   use_image_service=use_image_service,
-                                  image_refs=image_refs)
+                                  image_refs=image_refs,
+                                  blessed_name=instance_name,
+                                  artifact_peers=artifact_peers)
 
         vmsargs = vmsrun.Arguments()
         for key, value in params.get('guest', {}).iteritems():
@@ -159,16 +500,16 @@ class VmsConnection:
 
         # Launch the new VM.
         LOG.debug(_("Calling vms.launch with name=%s, new_name=%s, target=%s, "
-                    "migration_url=%s, vmsargs=%s"),
+                    "migration_url=%s, memory_url=%s, vmsargs=%s"),
                   instance_name, newname, mem_target, str(migration_url),
-                  str(vmsargs.jsonize()))
+                  str(memory_url), str(vmsargs.jsonize()))
 
-        result = tpool.execute(commands.launch,
+        result = self.executor.execute('launch', commands.launch,
                                instance_name,
                                newname,
                                str(mem_target),
                                path=path,
-                               mem_url=migration_url,
+                               mem_url=(migration_url or memory_url),
                                migration=(migration_url and True),
                                vmsargs=vmsargs)
 
@@ -184,6 +525,94 @@ class VmsConnection:
                          migration=(migration_url and True))
         return result
 
+    def can_serve(self):
+        """ Returns True if vms can serve the memory of a blessed instance (see serve). """
+        return hasattr(commands, 'serve')
+
+    def serve(self, context, instance_name, memory_url):
+        """
+        Starts a memory server for the blessed instance instance_name, so that
+        a batch of clones can stream its memory from a single source. Returns
+        the url of the memory server.
+        """
+        if not self.can_serve():
+            raise exception.Error(_("This version of vms is unable to serve the memory "
+                                    "of a blessed instance."))
+        LOG.debug(_("Calling vms.serve with name=%s, memory_url=%s"), instance_name, memory_url)
+        result = self.executor.execute('serve', commands.serve, instance_name,
+                                       mem_url=memory_url)
+        LOG.debug(_("Called vms.serve with name=%s, memory_url=%s"), instance_name, memory_url)
+        # vms gives back the url of the server and the pid that serves it.
+        network, pid = result
+        memory_url = network or memory_url
+        self._register_memory_server(memory_url, pid)
+        return memory_url
+
+    def _domain_pid(self, instance_name):
+        """ Returns the pid of the process running instance_name, or None. """
+        return None
+
+    def _register_memory_server(self, url, pid):
+        ctrl = None
+        if pid:
+            ctrl = control_for_pid(pid)
+        try:
+            if ctrl != None and \
+               memory_server_address(ctrl.get("network")) != memory_server_address(url):
+                ctrl = None
+        except control.ControlException:
+            ctrl = None
+        if ctrl == None:
+            # It will be found by probing when it is killed.
+            LOG.warn(_("Unable to find the control of the memory server for %s."), url)
+        else:
+            self.memory_servers.register(url, ctrl)
+
+    def stop_serving(self, memory_url):
+        """ Kills the memory server started by serve(). """
+        LOG.debug(_("Stopping the memory server at %s"), memory_url)
+        self.executor.execute('probe', self.memory_servers.kill, memory_url)
+
+    def _count_memory_servers(self):
+        count = 0
+        for ctrl in control.probe():
+            try:
+                if ctrl.get("network"):
+                    count += 1
+            except control.ControlException:
+                pass
+        return count
+
+    def count_memory_servers(self):
+        """ Returns the number of memory servers running on this host. """
+        return self.executor.execute('probe', self._count_memory_servers)
+
+    def host_memory_stats(self):
+        """
+        Returns the total and free memory of the host in MB. The free memory
+        includes the page cache, which is given back on demand.
+        """
+        meminfo = {}
+        with open('/proc/meminfo') as meminfo_file:
+            for line in meminfo_file:
+                fields = line.split()
+                if len(fields) >= 2:
+                    meminfo[fields[0].rstrip(':')] = long(fields[1])
+        free = meminfo.get('MemFree', 0) + meminfo.get('Buffers', 0) + meminfo.get('Cached', 0)
+        return {'total_mb': meminfo.get('MemTotal', 0) >> 10,
+                'free_mb': free >> 10}
+
+    def list_instances(self):
+        """ Returns the names of the instances running on this host. """
+        return []
+
+    def working_set_mb(self, instance_name):
+        """
+        Returns the memory (in MB) used by the instance that is not shared with
+        any other process, or None if it cannot be measured.
+        """
+        return None
+
     def replug(self, instance_name, mac_addresses):
         """
         Replugs the network interfaces on the instance
@@ -191,7 +620,7 @@ class VmsConnection:
         # We want to unplug the vifs before adding the new ones so that we do
         # not mess around with the interfaces exposed inside the guest.
         LOG.debug(_("Calling vms.replug with name=%s"), instance_name)
-        result = tpool.execute(commands.replug,
+        result = self.executor.execute('replug', commands.replug,
                                instance_name,
                                plugin_first=False,
                                mac_addresses=mac_addresses)
@@ -203,9 +632,15 @@ class VmsConnection:
                    block_device_info=None,
                    migration=False,
                    use_image_service=False,
-                   image_refs=[]):
+                   image_refs=[],
+                   blessed_name=None,
+                   artifact_peers=[]):
         return (new_instance_ref.name, None)
 
+    def prefetch(self, context, instance_ref, image_refs, artifact_peers=[]):
+        """ Brings the artifacts of a blessed instance into the local cache. """
+        pass
+
     def post_launch(self, context,
                     new_instance_ref,
                     network_info=None,
@@ -226,6 +661,302 @@ class DummyConnection(VmsConnection):
     def configure(self):
         select_hypervisor('dummy')
 
+def parse_distribution(spec, rng):
+    """
+    Returns a function that samples the distribution given by spec (e.g.
+    uniform:0.1:0.5). Negative samples are clipped to 0.
+    """
+    parts = spec.split(':')
+    name = parts[0]
+    try:
+        args = [float(arg) for arg in parts[1:]]
+    except ValueError:
+        raise ValueError('Invalid distribution %s.' % spec)
+    distributions = {'fixed': (1, lambda value: value),
+                     'uniform': (2, rng.uniform),
+                     'normal': (2, rng.normalvariate),
+                     'lognormal': (2, rng.lognormvariate),
+                     'exponential': (1, lambda mean: rng.expovariate(1.0 / mean))}
+    if name not in distributions or len(args) != distributions[name][0]:
+        raise ValueError('Invalid distribution %s.' % spec)
+    sample = distributions[name][1]
+    return lambda: max(0.0, sample(*args))
+
+class SimulatedConnection(VmsConnection):
+    """
+    A connection that simulates vms without a hypervisor. Every command takes
+    a random amount of time (drawn from the configured distributions), bless
+    writes artifacts of realistic sizes and launched instances use up the
+    host's memory. Failures can be injected either randomly or explicitly
+    with inject_failure().
+
+    Instances are deleted through nova-compute, so a load test should call
+    destroy() for the clones that it deletes to give their memory back.
+    """
+
+    def configure(self):
+        self.random = random.Random(FLAGS.gridcentric_sim_seed)
+        self.latencies = {}
+        for spec in FLAGS.gridcentric_sim_latency:
+            command, distribution = spec.split(':', 1)
+            self.latencies[command] = parse_distribution(distribution, self.random)
+        self.failure_rates = {}
+        for spec in FLAGS.gridcentric_sim_failure_rate:
+            command, rate = spec.split(':')
+            self.failure_rates[command] = float(rate)
+        self.injected_failures = {}
+
+        self.path = FLAGS.gridcentric_sim_path
+        if self.path == None:
+            self.path = tempfile.mkdtemp(prefix='gridcentric-sim-')
+        elif not os.path.exists(self.path):
+            os.makedirs(self.path)
+
+        self.lock = threading.Lock()
+        self.memory_total = FLAGS.gridcentric_sim_host_memory_mb
+        # The memory used by each running instance, and the memory shared by
+        # the clones of each blessed instance (which is only counted once).
+        self.instance_memory = {}
+        self.shared_memory = {}
+        self.lineage = {}
+        # The blessed instance served by each memory server.
+        self.served = {}
+        # The blessed instances whose artifacts have been fetched, and those
+        # with a cached domain template.
+        self.fetched = set()
+        self.templates = set()
+
+    def inject_failure(self, command, count=1, error=None):
+        """ Makes the next count calls of command fail with error. """
+        if error == None:
+            error = exception.Error(_("Injected %s failure.") % command)
+        self.injected_failures.setdefault(command, []).extend([error] * count)
+
+    def memory_used(self):
+        with self.lock:
+            return sum(self.instance_memory.values()) + sum(self.shared_memory.values())
+
+    def memory_free(self):
+        return self.memory_total - self.memory_used()
+
+    def _simulate(self, command):
+        """ Waits for the latency of command and raises any failure. """
+        latency = self.latencies.get(command)
+        if latency != None:
+            time.sleep(latency())
+        injected = self.injected_failures.get(command)
+        if injected:
+            raise injected.pop(0)
+        if self.random.random() < self.failure_rates.get(command, 0.0):
+            raise exception.Error(_("Simulated %s failure.") % command)
+
+    def _write_artifact(self, path, size):
+        with open(path, 'wb') as artifact:
+            if FLAGS.gridcentric_sim_sparse_artifacts:
+                artifact.truncate(size)
+            else:
+                chunk = '\0' * (1 << 20)
+                while size > 0:
+                    artifact.write(chunk[:size])
+                    size -= len(chunk)
+
+    def _bless(self, instance_name, new_instance_name, memory_mb, migration_url):
+        self._simulate('bless')
+        artifact_dir = os.path.join(self.path, new_instance_name)
+        if not os.path.exists(artifact_dir):
+            os.makedirs(artifact_dir)
+        descriptor = os.path.join(artifact_dir, 'descriptor')
+        memory = os.path.join(artifact_dir, 'memory')
+        self._write_artifact(descriptor, FLAGS.gridcentric_sim_descriptor_kb << 10)
+        self._write_artifact(memory,
+                             int(memory_mb * FLAGS.gridcentric_sim_memory_image_ratio) << 20)
+        return (new_instance_name, migration_url, [descriptor, memory])
+
+    def bless(self, context, instance_name, new_instance_ref,
+              migration_url=None, use_image_service=False):
+        new_instance_name = new_instance_ref['name']
+        LOG.debug(_("Simulating bless with name=%s, new_name=%s, migration_url=%s"),
+                  instance_name, new_instance_name, str(migration_url))
+        # The simulated artifacts are never uploaded to the image service.
+        return self.executor.execute('bless', self._bless, instance_name, new_instance_name,
+                                     new_instance_ref['memory_mb'], migration_url)
+
+    def _discard(self, instance_name):
+        self._simulate('discard')
+        shutil.rmtree(os.path.join(self.path, instance_name), ignore_errors=True)
+        with self.lock:
+            self.fetched.discard(instance_name)
+            self.templates.discard(instance_name)
+
+    def discard(self, context, instance_name, use_image_service=False, image_refs=[]):
+        LOG.debug(_("Simulating discard with name=%s"), instance_name)
+        self.executor.execute('discard', self._discard, instance_name)
+
+    def _launch(self, instance_name, newname, memory_mb, mem_target, migration):
+        self._simulate('launch')
+        with self.lock:
+            if migration:
+                shared = 0
+                unique = memory_mb
+            else:
+                shared = 0
+                if instance_name not in self.shared_memory:
+                    shared = int(memory_mb * FLAGS.gridcentric_sim_shared_ratio)
+                unique = memory_mb - int(memory_mb * FLAGS.gridcentric_sim_shared_ratio)
+                if int(mem_target) > 0:
+                    unique = min(memory_mb, (int(mem_target) << 12) >> 20)
+
+            used = sum(self.instance_memory.values()) + sum(self.shared_memory.values())
+            if used + shared + unique > self.memory_total:
+                raise exception.Error(_("Not enough memory to launch %s (%dMB used of %dMB).")
+                                      % (newname, used, self.memory_total))
+            if shared:
+                self.shared_memory[instance_name] = shared
+            self.instance_memory[newname] = unique
+            if not(migration):
+                self.lineage[newname] = instance_name
+        return newname
+
+    def _fetch(self, blessed_name):
+        with self.lock:
+            if blessed_name in self.fetched:
+                return
+        self._simulate('fetch')
+        with self.lock:
+            self.fetched.add(blessed_name)
+
+    def prefetch(self, context, instance_ref, image_refs, artifact_peers=[]):
+        LOG.debug(_("Simulating prefetch of %s."), instance_ref['name'])
+        self._fetch(instance_ref['name'])
+
+    def pre_launch(self, context,
+                   new_instance_ref,
+                   network_info=None,
+                   block_device_info=None,
+                   migration=False,
+                   use_image_service=False,
+                   image_refs=[],
+                   blessed_name=None,
+                   artifact_peers=[]):
+        image_base_path = None
+        if use_image_service:
+            image_base_path = self.path
+            if not(migration) and blessed_name != None:
+                self._fetch(blessed_name)
+
+        # As with libvirt, only the first clone of a blessed instance (and
+        # migrations) pays for generating the domain.
+        cache = not(migration) and blessed_name != None and \
+                FLAGS.gridcentric_cache_domain_templates
+        with self.lock:
+            cached = cache and blessed_name in self.templates
+        self._simulate(cached and 'template' or 'domain')
+        if cache:
+            with self.lock:
+                self.templates.add(blessed_name)
+
+        working_dir = os.path.join(self.path, 'instances', new_instance_ref['name'])
+        if not os.path.exists(working_dir):
+            os.makedirs(working_dir)
+        libvirt_file = os.path.join(working_dir, 'libvirt.xml')
+        with open(libvirt_file, 'w') as xml_file:
+            xml_file.write('<domain><name>%s</name></domain>' % new_instance_ref['name'])
+        return (libvirt_file, image_base_path)
+
+    def post_launch(self, context,
+                    new_instance_ref,
+                    network_info=None,
+                    block_device_info=None,
+                    migration=False):
+        if network_info:
+            self.replug(new_instance_ref['name'], self.extract_mac_addresses(network_info))
+
+    def launch(self, context, instance_name, mem_target,
+               new_instance_ref, network_info, migration_url=None,
+               use_image_service=False, image_refs=[], params={}, artifact_peers=[],
+               memory_url=None):
+        newname = new_instance_ref['name']
+        if memory_url != None and memory_url not in self.served:
+            raise exception.Error(_("No memory server at %s.") % memory_url)
+        self.pre_launch(context, new_instance_ref, network_info,
+                        migration=(migration_url and True),
+                        use_image_service=use_image_service,
+                        image_refs=image_refs,
+                        blessed_name=instance_name,
+                        artifact_peers=artifact_peers)
+        LOG.debug(_("Simulating launch with name=%s, new_name=%s, target=%s, migration_url=%s"),
+                  instance_name, newname, mem_target, str(migration_url))
+        result = self.executor.execute('launch', self._launch, instance_name, newname,
+                                       memory.guest_memory_mb(new_instance_ref), mem_target,
+                                       migration_url and True)
+        self.post_launch(context, new_instance_ref, network_info,
+                         migration=(migration_url and True))
+        return result
+
+    def _serve(self, instance_name, memory_url):
+        self._simulate('serve')
+        memory_url = '%s/%s' % (memory_url, instance_name)
+        with self.lock:
+            self.served[memory_url] = instance_name
+        return memory_url
+
+    def can_serve(self):
+        return True
+
+    def serve(self, context, instance_name, memory_url):
+        LOG.debug(_("Simulating serve with name=%s, memory_url=%s"), instance_name, memory_url)
+        return self.executor.execute('serve', self._serve, instance_name, memory_url)
+
+    def stop_serving(self, memory_url):
+        LOG.debug(_("Simulating the end of the memory server at %s"), memory_url)
+        with self.lock:
+            self.served.pop(memory_url, None)
+
+    def count_memory_servers(self):
+        with self.lock:
+            return len(self.served)
+
+    def host_memory_stats(self):
+        with self.lock:
+            shared = sum(self.shared_memory.values())
+            used = sum(self.instance_memory.values()) + shared
+        return {'total_mb': self.memory_total,
+                'free_mb': self.memory_total - used}
+
+    def list_instances(self):
+        with self.lock:
+            return self.instance_memory.keys()
+
+    def working_set_mb(self, instance_name):
+        with self.lock:
+            return self.instance_memory.get(instance_name)
+
+    def replug(self, instance_name, mac_addresses):
+        LOG.debug(_("Simulating replug with name=%s"), instance_name)
+        self.executor.execute('replug', self._simulate, 'replug')
+
+    def _release(self, instance_name):
+        self.instance_memory.pop(instance_name, None)
+        blessed_name = self.lineage.pop(instance_name, None)
+        if blessed_name != None and blessed_name not in self.lineage.values():
+            # This was the last clone, so the shared memory is gone too.
+            self.shared_memory.pop(blessed_name, None)
+
+    def destroy(self, instance_name):
+        """ Gives back the memory used by a (simulated) running instance. """
+        with self.lock:
+            self._release(instance_name)
+        shutil.rmtree(os.path.join(self.path, 'instances', instance_name), ignore_errors=True)
+
+    def pre_migration(self, context, instance_ref, network_info, migration_url):
+        pass
+
+    def post_migration(self, context, instance_ref, network_info, migration_url,
+                       use_image_service=False, image_refs=[]):
+        # The migrated instance no longer runs on this host.
+        self.discard(context, instance_ref['name'])
+        self.destroy(instance_ref['name'])
+
 class XenApiConnection(VmsConnection):
     """
     VMS connection for XenAPI
@@ -275,6 +1006,8 @@ class LibvirtConnection(VmsConnection):
         config.MANAGEMENT['connection_url'] = self.libvirt_conn.uri
         select_hypervisor('libvirt')
 
+        self._reset_domain_templates()
+
     def determine_openstack_user(self):
 
         # The user can specify an openstack_user using the flags, or they can leave it blank
@@ -394,43 +1127,15 @@ class LibvirtConnection(VmsConnection):
                    block_device_info=None,
                    migration=False,
                    use_image_service=False,
-                   image_refs=[]):
+                   image_refs=[],
+                   blessed_name=None,
+                   artifact_peers=[]):
 
         image_base_path = None
         if use_image_service:
-            # We need to first download the descriptor and the disk files
-            # from the image service.
-            LOG.debug("Downloading images %s from the image service." % (image_refs))
-            image_base_path = os.path.join(FLAGS.instances_path, '_base')
-            if not os.path.exists(image_base_path):
-                LOG.debug('Base path %s does not exist. It will be created now.', image_base_path)
-                mkdir_as(image_base_path, self.openstack_uid)
-            image_service = nova.image.get_default_image_service()
-            for image_ref in image_refs:
-                image = image_service.show(context, image_ref)
-                target = os.path.join(image_base_path, image['name'])
-                if migration or not os.path.exists(target):
-                    # If the path does not exist fetch the data from the image
-                    # service.  NOTE: We always fetch in the case of a
-                    # migration, as the descriptor may have changed from its
-                    # previous state. Migrating VMs are the only case where a
-                    # descriptor for an instance will not be a fixed constant.
-                    # We download to a temporary location so we can make the
-                    # file appear atomically from the right user.
-                    fd, temp_target = tempfile.mkstemp(dir=image_base_path)
-                    try:
-                        os.close(fd)
-                        images.fetch(context,
-                                     image_ref,
-                                     temp_target,
-                                     new_instance_ref['user_id'],
-                                     new_instance_ref['project_id'])
-                        os.chown(temp_target, self.openstack_uid, self.openstack_gid)
-                        os.chmod(temp_target, 0644)
-                        os.rename(temp_target, target)
-                    except:
-                        os.unlink(temp_target)
-                        raise
+            image_base_path = self._fetch_images(context, new_instance_ref, image_refs,
+                                                 migration=migration,
+                                                 artifact_peers=artifact_peers)
 
         # (dscannell) Check to see if we need to convert the network_info
         # object into the legacy format.
@@ -440,12 +1145,118 @@ class LibvirtConnection(VmsConnection):
         # We need to create the libvirt xml, and associated files. Pass back
         # the path to the libvirt.xml file.
         working_dir = os.path.join(FLAGS.instances_path, new_instance_ref['name'])
-        disk_file = os.path.join(working_dir, "disk")
         libvirt_file = os.path.join(working_dir, "libvirt.xml")
 
         # Make sure that our working directory exists.
         mkdir_as(working_dir, self.openstack_uid)
 
+        # Clones of the same blessed instance are identical except for a handful
+        # of fields, so we reuse the domain we generated for the first one. We
+        # never do this for migrations since the working directory is already
+        # in place.
+        template_key = None
+        template = None
+        if not(migration) and blessed_name and FLAGS.gridcentric_cache_domain_templates:
+            template_key = (blessed_name, network_shape(network_info))
+            template = self.domain_templates.get(template_key)
+            if template and not(template.exists()):
+                LOG.warn(_("The domain template for %s has disappeared."), blessed_name)
+                self.domain_templates.pop(template_key, None)
+                template = None
+
+        xml = None
+        if template:
+            xml = template.render(new_instance_ref, network_info)
+            if xml == None:
+                LOG.debug(_("Unable to reuse the domain template for %s."), blessed_name)
+
+        if xml != None:
+            template.populate(working_dir)
+            with open(libvirt_file, 'w') as xml_file:
+                xml_file.write(xml)
+        else:
+            self._create_domain(context, new_instance_ref, network_info, block_device_info,
+                                migration, template_key)
+
+        # Fix up the permissions on the files that we created so that they are owned by the
+        # openstack user.
+        utilities.check_command(['chown', '-R', '-L',
+                                 '%d:%d' % (self.openstack_uid, self.openstack_gid),
+                                 working_dir])
+
+        # Return the libvirt file, this will be passed in as the name. This
+        # parameter is overloaded in the management interface as a libvirt
+        # special case.
+        return (libvirt_file, image_base_path)
+
+    def _fetch_images(self, context, instance_ref, image_refs, migration=False,
+                      artifact_peers=[]):
+        """
+        Downloads the images (descriptor and disk files) of a blessed instance
+        into the local cache and returns the path of that cache. The images are
+        taken from the artifact_peers when possible. artifact_peers is either
+        a list of hosts or a function returning one, which is only called if
+        an artifact is missing from the cache.
+        """
+        # We need to first download the descriptor and the disk files
+        # from the image service.
+        LOG.debug("Downloading images %s from the image service." % (image_refs))
+        image_base_path = os.path.join(FLAGS.instances_path, '_base')
+        if not os.path.exists(image_base_path):
+            LOG.debug('Base path %s does not exist. It will be created now.', image_base_path)
+            mkdir_as(image_base_path, self.openstack_uid)
+        image_service = nova.image.get_default_image_service()
+        for image_ref in image_refs:
+            image = image_service.show(context, image_ref)
+            target = os.path.join(image_base_path, image['name'])
+            if migration or not os.path.exists(target):
+                # If the path does not exist fetch the data from the image
+                # service.  NOTE: We always fetch in the case of a
+                # migration, as the descriptor may have changed from its
+                # previous state. Migrating VMs are the only case where a
+                # descriptor for an instance will not be a fixed constant.
+                # We download to a temporary location so we can make the
+                # file appear atomically from the right user.
+                fd, temp_target = tempfile.mkstemp(dir=image_base_path)
+                try:
+                    os.close(fd)
+                    peer = None
+                    if not(migration):
+                        if callable(artifact_peers):
+                            artifact_peers = artifact_peers()
+                        peer = artifacts.fetch_from_peers(artifact_peers, image['name'],
+                                                          temp_target,
+                                                          size=image.get('size'),
+                                                          checksum=image.get('checksum'))
+                    if peer == None:
+                        images.fetch(context,
+                                     image_ref,
+                                     temp_target,
+                                     instance_ref['user_id'],
+                                     instance_ref['project_id'])
+                    os.chown(temp_target, self.openstack_uid, self.openstack_gid)
+                    os.chmod(temp_target, 0644)
+                    os.rename(temp_target, target)
+                except:
+                    os.unlink(temp_target)
+                    raise
+        return image_base_path
+
+    def prefetch(self, context, instance_ref, image_refs, artifact_peers=[]):
+        LOG.debug(_("Prefetching images %s for %s."), image_refs, instance_ref['name'])
+        self._fetch_images(context, instance_ref, image_refs, artifact_peers=artifact_peers)
+
+    def _create_domain(self, context, new_instance_ref, network_info, block_device_info,
+                       migration, template_key):
+        """
+        Has libvirt generate the domain xml and the files in the working
+        directory. If template_key is given, the result is cached so that
+        siblings can skip this step.
+        """
+        working_dir = os.path.join(FLAGS.instances_path, new_instance_ref['name'])
+        disk_file = os.path.join(working_dir, "disk")
+        libvirt_file = os.path.join(working_dir, "libvirt.xml")
+
         if not(os.path.exists(disk_file)):
             # (dscannell) We will write out a stub 'disk' file so that we don't
             # end up copying this file when setting up everything for libvirt.
@@ -481,17 +1292,96 @@ class LibvirtConnection(VmsConnection):
             # (dscannell) Remove the fake disk file (if created).
             os.remove(disk_file)
 
-        # Fix up the permissions on the files that we created so that they are owned by the
-        # openstack user.
-        for root, dirs, files in os.walk(working_dir, followlinks=True):
-            for path in dirs + files:
-                LOG.debug("chowning path=%s to openstack user %s" % (os.path.join(root, path), self.openstack_uid))
-                os.chown(os.path.join(root, path), self.openstack_uid, self.openstack_gid)
+        if template_key != None:
+            self._save_domain_template(template_key, xml, new_instance_ref,
+                                       network_info, working_dir)
+
+    def _template_root(self):
+        """ The directory holding this host's domain template skeletons. """
+        return os.path.join(FLAGS.instances_path, '_templates', FLAGS.host)
+
+    def _reset_domain_templates(self):
+        # Any templates left over from a previous run are stale. The instances
+        # path may be shared with other hosts, so only ours are removed.
+        self.domain_templates = {}
+        shutil.rmtree(self._template_root(), ignore_errors=True)
+
+    def _save_domain_template(self, template_key, xml, instance_ref, network_info, working_dir):
+        """ Caches the domain of a freshly launched instance for its siblings. """
+        own_files = [path for path in os.listdir(working_dir) if instance_artifact(path)]
+        if own_files:
+            # The siblings need their own, so libvirt has to generate them.
+            LOG.debug(_("Not caching the domain template for %s (it has %s)."),
+                      template_key[0], ", ".join(own_files))
+            return
+
+        template_root = self._template_root()
+        if not os.path.exists(template_root):
+            utilities.make_directories(template_root)
+
+        skeleton_dir = tempfile.mkdtemp(prefix=template_key[0] + '.', dir=template_root)
+        try:
+            for root, dirs, files in os.walk(working_dir):
+                target_root = os.path.join(skeleton_dir, os.path.relpath(root, working_dir))
+                for path in dirs:
+                    os.mkdir(os.path.join(target_root, path))
+                for path in files:
+                    if root == working_dir and path in TEMPLATE_SKIPPED_FILES:
+                        continue
+                    shutil.copyfile(os.path.join(root, path), os.path.join(target_root, path))
+        except (IOError, OSError), e:
+            LOG.debug(_("Unable to save the domain template for %s: %s"), template_key[0], str(e))
+            shutil.rmtree(skeleton_dir, ignore_errors=True)
+            return
+
+        template = DomainTemplate(xml, instance_ref, network_info, skeleton_dir)
+        previous = self.domain_templates.setdefault(template_key, template)
+        if previous is not template:
+            # Another launch beat us to it.
+            template.remove()
+
+    def _drop_domain_templates(self, blessed_name):
+        for key in self.domain_templates.keys():
+            if key[0] == blessed_name:
+                template = self.domain_templates.pop(key, None)
+                if template:
+                    template.remove()
 
-        # Return the libvirt file, this will be passed in as the name. This
-        # parameter is overloaded in the management interface as a libvirt
-        # special case.
-        return (libvirt_file, image_base_path)
+    def discard(self, context, instance_name, use_image_service=False, image_refs=[]):
+        self._drop_domain_templates(instance_name)
+        VmsConnection.discard(self, context, instance_name,
+                              use_image_service=use_image_service,
+                              image_refs=image_refs)
+
+    def list_instances(self):
+        return self.libvirt_conn.list_instances()
+
+    def _domain_pid(self, instance_name):
+        try:
+            pid_file = os.path.join(FLAGS.gridcentric_libvirt_pid_path, '%s.pid' % instance_name)
+            with open(pid_file) as pid:
+                return int(pid.read().strip())
+        except (IOError, ValueError), e:
+            LOG.debug(_("Unable to read the pid of %s: %s"), instance_name, str(e))
+            return None
+
+    def working_set_mb(self, instance_name):
+        # The private pages of the qemu process are the ones that are not
+        # shared with the other clones (or the page cache).
+        pid = self._domain_pid(instance_name)
+        if pid == None:
+            return None
+        try:
+            smaps = '/proc/%d/smaps' % pid
+            private_kb = 0
+            with open(smaps) as smaps_file:
+                for line in smaps_file:
+                    if line.startswith('Private_Clean:') or line.startswith('Private_Dirty:'):
+                        private_kb += long(line.split()[1])
+            return int(private_kb >> 10)
+        except (IOError, ValueError), e:
+            LOG.debug(_("Unable to measure the working set of %s: %s"), instance_name, str(e))
+            return None
 
     def post_launch(self, context,
                     new_instance_ref,
@@ -502,10 +1392,32 @@ class LibvirtConnection(VmsConnection):
         self.libvirt_conn.firewall_driver.apply_instance_filter(new_instance_ref, network_info)
 
     def pre_migration(self, context, instance_ref, network_info, migration_url):
-        # Make sure that the disk reflects all current state for this VM.
-        # It's times like these that I wish there was a way to do this on a
-        # per-file basis, but we have no choice here but to sync() globally.
-        utilities.call_command(["sync"])
+        # Make sure that the disk reflects all current state for this VM. We
+        # only flush the files that belong to this instance (its working
+        # directory and disks) so that we don't force out the dirty pages of
+        # every other VM on the host.
+        working_dir = os.path.join(FLAGS.instances_path, instance_ref['name'])
+        paths = []
+        for root, dirs, files in os.walk(working_dir, followlinks=True):
+            for path in files:
+                paths.append(os.path.join(root, path))
+        for path in domain_disk_paths(os.path.join(working_dir, "libvirt.xml")):
+            if path not in paths:
+                paths.append(path)
+
+        try:
+            for path in paths:
+                fsync_path(path)
+            fsync_path(working_dir)
+        except (IOError, OSError), e:
+            LOG.debug(_("Unable to flush the files for %s individually (%s), "
+                        "syncing its filesystem instead."), instance_ref['name'], str(e))
+            try:
+                syncfs_path(working_dir)
+            except (IOError, OSError), e:
+                LOG.warn(_("Unable to syncfs %s (%s), falling back to a global sync."),
+                         working_dir, str(e))
+                utilities.call_command(["sync"])
 
     def post_migration(self, context, instance_ref, network_info, migration_url,
                        use_image_service=False, image_refs=[]):
@@ -514,18 +1426,12 @@ class LibvirtConnection(VmsConnection):
         self.discard(context, instance_ref.name, use_image_service=use_image_service,
                      image_refs=image_refs)
 
-        # We make sure that all the memory servers are gone that need it.
-        # This looks for any servers that are providing the migration_url we
-        # used above -- since we no longer need it. This is done this way
-        # because the domain has already been destroyed and wiped away.  In
-        # fact, we don't even know it's old PID and a new domain might have
-        # appeared at the same PID in the meantime.
-        for ctrl in control.probe():
-            try:
-                if ctrl.get("network") in migration_url:
-                    ctrl.kill(timeout=1.0)
-            except control.ControlException:
-                pass
+        # We make sure that the memory server providing the migration_url we
+        # used above is gone -- since we no longer need it. We use the handle
+        # recorded at bless time because the domain has already been destroyed
+        # and wiped away. In fact, we don't even know it's old PID and a new
+        # domain might have appeared at the same PID in the meantime.
+        self.memory_servers.kill(migration_url)
 
     def create_image(self, context, image_service, instance_ref, image_name):
         # Create the image in the image_service.
@@ -0,0 +1,109 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Memory sizes and the memory charged to the quota of launched instances.
+
+The memory_mb of a launched instance stays the memory of its guest, which is
+what the resource tracker and the schedulers count on the host. The memory
+charged to the ram quota of the project is kept in the system metadata of
+the instance (under CHARGE_KEY) once the host has launched it; until then it
+is charged the memory of its guest. Since nova releases memory_mb when the
+instance is deleted, the difference is given back to the project then.
+"""
+
+import re
+
+from nova import flags
+from nova.openstack.common import cfg
+
+FLAGS = flags.FLAGS
+memory_opts = [
+               cfg.StrOpt('gridcentric_quota_mode',
+               default='full',
+               help='How launched instances are charged against the ram quota: "full" '
+                    'charges the memory of the instance type, "target" charges the memory '
+                    'target of the launch and "working_set" starts from the target and '
+                    'then follows the unique memory measured on the host.'),
+
+               cfg.IntOpt('gridcentric_working_set_min_delta_mb',
+               default=64,
+               help='The smallest change (in MB) of the working set of a launched instance '
+                    'that updates the memory charged for it. Only used with the '
+                    '"working_set" quota mode.')]
+FLAGS.register_opts(memory_opts)
+
+QUOTA_MODES = ('full', 'target', 'working_set')
+
+# The system metadata key holding the memory charged for a launched instance.
+CHARGE_KEY = 'gridcentric_charged_mb'
+
+def memory_string_to_pages(mem):
+    mem = mem.lower()
+    units = { '^(\d+)tb$' : 40,
+              '^(\d+)gb$' : 30,
+              '^(\d+)mb$' : 20,
+              '^(\d+)kb$' : 10,
+              '^(\d+)b$' : 0,
+              '^(\d+)$' : 0 }
+    for (pattern, shift) in units.items():
+        m = re.match(pattern, mem)
+        if m is not None:
+            val = long(m.group(1))
+            memory = val << shift
+            # Shift to obtain pages, at least one
+            return max(1, memory >> 12)
+    raise ValueError('Invalid target string %s.' % mem)
+
+def guest_memory_mb(instance_ref):
+    """ Returns the memory of the guest, which is given by its instance type. """
+    instance_type = instance_ref.get('instance_type')
+    if instance_type:
+        return instance_type['memory_mb']
+    return instance_ref['memory_mb']
+
+def system_metadata(instance_ref):
+    """ Returns the system metadata of the instance as a dictionary. """
+    items = instance_ref.get('system_metadata') or []
+    if isinstance(items, dict):
+        return dict(items)
+    return dict([(item['key'], item['value']) for item in items])
+
+def recorded_charge_mb(instance_ref):
+    """
+    Returns the memory charged for the instance, or None if it is charged
+    the memory of its guest (as nova does).
+    """
+    charged = system_metadata(instance_ref).get(CHARGE_KEY)
+    if charged in (None, ''):
+        return None
+    return int(charged)
+
+def charged_memory_mb(guest_mb, target=None, mode=None):
+    """
+    Returns the memory (in MB) charged for launching an instance of guest_mb
+    with the given memory target (as passed in the launch params).
+    """
+    mode = mode or FLAGS.gridcentric_quota_mode
+    if mode not in QUOTA_MODES:
+        raise ValueError('Invalid quota mode %s.' % mode)
+    if mode == 'full' or target in (None, '', '0'):
+        return guest_mb
+    try:
+        pages = memory_string_to_pages(str(target))
+    except ValueError:
+        return guest_mb
+    # Round up to the next MB.
+    return max(1, min(guest_mb, int((pages + 255) >> 8)))
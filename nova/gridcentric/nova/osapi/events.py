@@ -0,0 +1,249 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Relays the gridcentric instance notifications to streaming API clients.
+
+The gridcentric managers send gridcentric.instance.* notifications. The API
+consumes them from the notification topics and publishes them on the event
+hub, which hands them to every matching subscription. This module is also a
+notifier driver (notification_driver=gridcentric.nova.osapi.events), which
+publishes the notifications of the local process directly.
+
+The notifications only carry the parent of the instance, so that the
+managers do not have to look up its ancestors. The hub resolves the rest of
+the lineage, and remembers the parent of each instance it has looked up.
+"""
+
+import collections
+import functools
+import json
+import uuid
+
+from eventlet import queue
+
+from nova import context
+from nova import db
+from nova import flags
+from nova.openstack.common import cfg
+from nova.openstack.common import log as logging
+from nova.openstack.common import rpc
+
+LOG = logging.getLogger('nova.gridcentric.events')
+FLAGS = flags.FLAGS
+events_opts = [
+               cfg.BoolOpt('gridcentric_events_consume',
+               default=True,
+               help='Consume the notification topics to relay the gridcentric '
+                    'notifications sent by the gridcentric hosts.'),
+
+               cfg.IntOpt('gridcentric_events_queue_size',
+               default=1000,
+               help='The number of events buffered for each subscriber. A subscriber '
+                    'that falls further behind gets an overflow event.'),
+
+               cfg.IntOpt('gridcentric_events_keepalive',
+               default=15,
+               help='The number of seconds between keepalives on an idle event stream.')]
+FLAGS.register_opts(events_opts)
+
+EVENT_PREFIX = 'gridcentric.instance.'
+
+# The number of instance parents the hub remembers (the least recently used
+# are forgotten first).
+MAX_PARENTS = 10000
+
+# The state of the instance once each transition is done.
+EVENT_STATES = {'gridcentric.instance.bless.start': 'BUILD',
+                'gridcentric.instance.bless.end': 'BLESSED',
+                'gridcentric.instance.launch.start': 'BUILD',
+                'gridcentric.instance.launch.end': 'ACTIVE',
+                'gridcentric.instance.discard.start': 'DELETING',
+                'gridcentric.instance.discard.end': 'DELETED'}
+
+def event_from_notification(message):
+    """ Converts a gridcentric notification into an event (or None). """
+    event_type = message.get('event_type', '')
+    if not event_type.startswith(EVENT_PREFIX):
+        return None
+    payload = message.get('payload') or {}
+    return {'id': message.get('message_id'),
+            'event': event_type,
+            'timestamp': str(message.get('timestamp')),
+            'instance_id': payload.get('instance_id'),
+            'tenant_id': payload.get('tenant_id'),
+            'display_name': payload.get('display_name'),
+            'status': EVENT_STATES.get(event_type),
+            'lineage': payload.get('lineage') or []}
+
+class Subscription(object):
+    """ The events for one client, filtered by tenant and/or lineage. """
+
+    def __init__(self, hub, tenant_id=None, lineage=None, queue_size=None):
+        self.hub = hub
+        self.tenant_id = tenant_id
+        self.lineage = lineage
+        self.queue = queue.LightQueue(queue_size or FLAGS.gridcentric_events_queue_size)
+        self.overflowed = False
+
+    def matches(self, event):
+        if self.tenant_id != None and event['tenant_id'] != self.tenant_id:
+            return False
+        if self.lineage != None and self.lineage != event['instance_id'] and \
+           self.lineage not in event['lineage']:
+            return False
+        return True
+
+    def put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            self.overflowed = True
+
+    def get(self, timeout=None):
+        """ Returns the next event, or None if there was none within timeout. """
+        try:
+            return self.queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def close(self):
+        self.hub.unsubscribe(self)
+
+class EventHub(object):
+
+    def __init__(self):
+        self.subscriptions = set()
+        self.consumer = None
+        # The parent (blessed or original instance) of the recently seen
+        # instances, least recently used first.
+        self.parents = collections.OrderedDict()
+
+    def subscribe(self, tenant_id=None, lineage=None):
+        if FLAGS.gridcentric_events_consume and self.consumer == None:
+            self.start_consumer()
+        subscription = Subscription(self, tenant_id=tenant_id, lineage=lineage)
+        self.subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        self.subscriptions.discard(subscription)
+
+    def publish(self, event):
+        for subscription in list(self.subscriptions):
+            if subscription.matches(event):
+                subscription.put(event)
+
+    def _remember_parent(self, instance_id, parent_id):
+        """ Records the parent of instance_id, forgetting the least recently used. """
+        self.parents.pop(instance_id, None)
+        self.parents[instance_id] = parent_id
+        while len(self.parents) > MAX_PARENTS:
+            self.parents.popitem(last=False)
+
+    def _parent(self, instance_id):
+        if instance_id in self.parents:
+            parent_id = self.parents.pop(instance_id)
+        else:
+            try:
+                metadata = db.instance_metadata_get(
+                                context.get_admin_context(read_deleted='yes'), instance_id)
+            except Exception, e:
+                LOG.debug(_("Unable to look up the parent of %s: %s"), instance_id, str(e))
+                return None
+            parent_id = metadata.get('launched_from') or metadata.get('blessed_from')
+        self._remember_parent(instance_id, parent_id)
+        return parent_id
+
+    def lineage(self, parent_id):
+        """ Returns the uuids of parent_id and of its ancestors, nearest first. """
+        lineage = []
+        while parent_id and parent_id not in lineage:
+            lineage.append(parent_id)
+            parent_id = self._parent(parent_id)
+        return lineage
+
+    def publish_notification(self, message):
+        if not self.subscriptions:
+            return
+        event = event_from_notification(message)
+        if event == None:
+            return
+        payload = message.get('payload') or {}
+        if 'parent_id' in payload:
+            self._remember_parent(event['instance_id'], payload['parent_id'])
+            event['lineage'] = self.lineage(payload['parent_id'])
+        self.publish(event)
+
+    def start_consumer(self):
+        """
+        Starts consuming the notification topics on a queue of our own, so
+        that every API process sees every notification. The queue is
+        exclusive to this process and is removed by the broker once the
+        process goes away.
+        """
+        self.consumer = rpc.create_connection(new=True)
+        queue_name = 'gridcentric-events-%s' % uuid.uuid4().hex
+        if FLAGS.rpc_backend.endswith('impl_kombu'):
+            # The topic consumers of the kombu backend declare durable queues
+            # that outlive the process, so the queue is declared here.
+            from nova.openstack.common.rpc import impl_kombu
+            consumer_cls = functools.partial(impl_kombu.TopicConsumer, name=queue_name,
+                                             durable=False, auto_delete=True,
+                                             exclusive=True)
+            for topic in FLAGS.notification_topics:
+                self.consumer.declare_consumer(consumer_cls, '%s.info' % topic,
+                                               self.publish_notification)
+        elif FLAGS.rpc_backend.endswith('impl_qpid'):
+            # The qpid backend declares auto-delete queues.
+            for topic in FLAGS.notification_topics:
+                self.consumer.declare_topic_consumer(topic='%s.info' % topic,
+                                                     callback=self.publish_notification,
+                                                     queue_name=queue_name)
+        else:
+            LOG.warn(_("The rpc backend cannot consume notifications, only local "
+                       "gridcentric events will be streamed."))
+            return
+        self.consumer.consume_in_thread()
+
+HUB = EventHub()
+
+def notify(context, message):
+    """ Notifier driver that publishes the notifications of this process. """
+    HUB.publish_notification(message)
+
+def format_event(event):
+    """ Formats an event as a server-sent event. """
+    return 'id: %s\nevent: %s\ndata: %s\n\n' % (event['id'], event['event'], json.dumps(event))
+
+def stream(subscription, keepalive=None):
+    """ Yields the server-sent events of subscription until the client goes away. """
+    if keepalive == None:
+        keepalive = FLAGS.gridcentric_events_keepalive
+    try:
+        # Tells the client how long to wait before reconnecting.
+        yield 'retry: %d\n\n' % (keepalive * 1000)
+        while True:
+            event = subscription.get(timeout=keepalive)
+            if subscription.overflowed:
+                # Events were dropped, so the client has to resynchronize.
+                subscription.overflowed = False
+                yield 'event: overflow\ndata: {}\n\n'
+            if event == None:
+                yield ': keepalive\n\n'
+            else:
+                yield format_event(event)
+    finally:
+        subscription.close()
@@ -13,6 +13,7 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import hashlib
 import json
 import webob
 from webob import exc
@@ -28,6 +29,7 @@ from nova.api.openstack.compute.views import servers as views_servers
 import nova.api.openstack.common as common
 
 from gridcentric.nova.api import API
+from gridcentric.nova.osapi import events
 
 LOG = logging.getLogger("nova.api.extensions.gridcentric")
 
@@ -43,6 +45,60 @@ def convert_exception(action):
     fn.__name__ = action.__name__
     return fn
 
+def summary_view(context, instance):
+    """
+    Builds the summary view of an instance: only the fields that are stored
+    on the instance itself, so no flavor, image or network lookups.
+    """
+    host = instance.get('host')
+    host_id = ''
+    if host:
+        host_id = hashlib.sha224(str(instance['project_id']) + str(host)).hexdigest()
+    view = {'id': instance['uuid'],
+            'name': instance['display_name'],
+            'status': common.status_from_state(instance.get('vm_state'),
+                                               instance.get('task_state')),
+            'hostId': host_id}
+    if context.is_admin:
+        view['host'] = host
+    return view
+
+def build_views(req, instances, view, view_builder):
+    """ Builds the views of instances in the given mode ('summary' or 'detail'). """
+    if view == 'summary':
+        context = req.environ["nova.context"]
+        return [summary_view(context, instance) for instance in instances]
+    elif view == 'detail':
+        return view_builder.detail(req, instances)['servers']
+    raise exc.HTTPBadRequest(explanation=_("Unknown view %s.") % view)
+
+def requested_view(req, params, default):
+    """ Returns the view mode requested by the 'view' parameter (body or query). """
+    return (params or {}).get('view') or req.GET.get('view') or default
+
+def list_etag(instances, view):
+    """
+    Returns the ETag of a list of instances rendered in the given view. It
+    changes whenever an instance is added, removed or updated.
+    """
+    digest = hashlib.sha1(view)
+    for instance in sorted(instances, key=lambda instance: instance['uuid']):
+        info_cache = instance.get('info_cache') or {}
+        digest.update('%s|%s|%s|%s|%s;' % (instance['uuid'],
+                                           instance.get('updated_at'),
+                                           instance.get('vm_state'),
+                                           instance.get('task_state'),
+                                           info_cache.get('updated_at')))
+    return '"%s"' % digest.hexdigest()
+
+def etag_matches(req, etag):
+    """ Returns True if the request's If-None-Match header matches etag. """
+    header = req.headers.get('If-None-Match')
+    if not header:
+        return False
+    tags = [tag.strip() for tag in header.split(',')]
+    return '*' in tags or etag in tags or ('W/' + etag) in tags
+
 class GridcentricServerControllerExtension(wsgi.Controller):
     """
     The OpenStack Extension definition for the Gridcentric capabilities. Currently this includes:
@@ -69,7 +125,8 @@ class GridcentricServerControllerExtension(wsgi.Controller):
     def _bless_instance(self, req, id, body):
         context = req.environ["nova.context"]
         result = self.gridcentric_api.bless_instance(context, id)
-        return self._build_instance_list(req, [result])
+        return self._build_instance_list(req, [result],
+                                         requested_view(req, body.get('gc_bless'), 'detail'))
 
     @wsgi.action('gc_discard')
     @convert_exception
@@ -83,10 +140,18 @@ class GridcentricServerControllerExtension(wsgi.Controller):
     def _launch_instance(self, req, id, body):
         context = req.environ["nova.context"]
         try:
-            params = body.get('gc_launch', {})
-            result = self.gridcentric_api.launch_instance(context, id,
-                                                          params=params)
-            return self._build_instance_list(req, [result])
+            params = dict(body.get('gc_launch') or {})
+            view = requested_view(req, params, 'detail')
+            params.pop('view', None)
+            try:
+                count = int(params.pop('count', 1))
+            except ValueError:
+                raise exc.HTTPBadRequest(explanation=_("The launch count must be an integer."))
+            if count < 1:
+                raise exc.HTTPBadRequest(explanation=_("The launch count must be positive."))
+            result = self.gridcentric_api.launch_instances(context, id, count,
+                                                           params=params)
+            return self._build_instance_list(req, result, view)
         except novaexc.QuotaError as error:
             self._handle_quota_error(error)
 
@@ -108,28 +173,20 @@ class GridcentricServerControllerExtension(wsgi.Controller):
     @convert_exception
     def _list_launched_instances(self, req, id, body):
         context = req.environ["nova.context"]
-        return self._build_instance_list(req, self.gridcentric_api.list_launched_instances(context, id))
+        return self._build_instance_list(req,
+                    self.gridcentric_api.list_launched_instances(context, id),
+                    requested_view(req, body.get('gc_list_launched'), 'detail'))
 
     @wsgi.action('gc_list_blessed')
     @convert_exception
     def _list_blessed_instances(self, req, id, body):
         context = req.environ["nova.context"]
-        return self._build_instance_list(req, self.gridcentric_api.list_blessed_instances(context, id))
-
-    def _build_instance_list(self, req, instances):
-        def _build_view(req, instance, is_detail=True):
-            project_id = getattr(req.environ['nova.context'], 'project_id', '')
-            base_url = req.application_url
-            flavor_builder = nova.api.openstack.views.flavors.ViewBuilderV11(
-                base_url, project_id)
-            image_builder = nova.api.openstack.views.images.ViewBuilderV11(
-                base_url, project_id)
-            addresses_builder = nova.api.openstack.views.addresses.ViewBuilderV11()
-            builder = nova.api.openstack.views.servers.ViewBuilderV11(
-                addresses_builder, flavor_builder, image_builder,
-                base_url, project_id)
-            return builder.build(instance, is_detail=is_detail)
-        instances = self._view_builder.detail(req, instances)['servers']
+        return self._build_instance_list(req,
+                    self.gridcentric_api.list_blessed_instances(context, id),
+                    requested_view(req, body.get('gc_list_blessed'), 'detail'))
+
+    def _build_instance_list(self, req, instances, view='detail'):
+        instances = build_views(req, instances, view, self._view_builder)
         return webob.Response(status_int=200, body=json.dumps(instances))
 
     ## Utility methods taken from nova core ##
@@ -162,11 +219,86 @@ class GridcentricTargetBootController(object):
     def __init__(self):
         self.nova_servers = servers.Controller()
         self.nova_servers.compute_api = API()
+        self.gridcentric_api = API()
+        self.view_builder = views_servers.ViewBuilder()
 
     @convert_exception
     def create(self, req, body):
         return self.nova_servers.create(req, body)
 
+    @convert_exception
+    def action(self, req, body):
+        """
+        Runs a list of gridcentric actions in one request. The body is of the form
+        {"actions": [{"id": <server id>, "action": <gc_bless|gc_launch|gc_discard|delete>,
+        "params": {...}}, ...], "view": <summary|detail>} and the response has a result
+        for every action. The servers are given in the summary view by default.
+        """
+        context = req.environ["nova.context"]
+        view = requested_view(req, body, 'summary')
+        actions = (body or {}).get('actions')
+        if not isinstance(actions, list) or \
+           [action for action in actions if not isinstance(action, dict)]:
+            raise exc.HTTPBadRequest(explanation=_("Expected a list of actions."))
+
+        results = self.gridcentric_api.bulk_action(context, actions)
+        for result in results:
+            result['servers'] = build_views(req, result['servers'], view, self.view_builder)
+        return webob.Response(status_int=200, body=json.dumps({'results': results}))
+
+    @convert_exception
+    def launched(self, req, id):
+        """
+        Lists the instances launched from a blessed instance. This is the
+        conditional form of gc_list_launched: it honours If-None-Match.
+        """
+        context = req.environ["nova.context"]
+        return self._build_conditional_instance_list(req,
+                    self.gridcentric_api.list_launched_instances(context, id),
+                    requested_view(req, None, 'detail'))
+
+    @convert_exception
+    def blessed(self, req, id):
+        """
+        Lists the instances blessed from an instance. This is the conditional
+        form of gc_list_blessed: it honours If-None-Match.
+        """
+        context = req.environ["nova.context"]
+        return self._build_conditional_instance_list(req,
+                    self.gridcentric_api.list_blessed_instances(context, id),
+                    requested_view(req, None, 'detail'))
+
+    def _build_conditional_instance_list(self, req, instances, view):
+        """
+        Builds the instance list with an ETag, or replies 304 (without building
+        the views) if the client already has the current list.
+        """
+        etag = list_etag(instances, view)
+        if etag_matches(req, etag):
+            response = webob.Response(status_int=304)
+        else:
+            response = webob.Response(status_int=200,
+                body=json.dumps(build_views(req, instances, view, self.view_builder)))
+        response.headers['ETag'] = etag
+        return response
+
+    def events(self, req):
+        """
+        Streams the gridcentric instance state transitions as server-sent events.
+        The stream can be filtered by ?lineage=<server id> and, for admins,
+        ?tenant=<tenant id> (other users only see their own tenant).
+        """
+        context = req.environ["nova.context"]
+        tenant_id = context.project_id
+        if context.is_admin:
+            tenant_id = req.GET.get('tenant')
+        subscription = events.HUB.subscribe(tenant_id=tenant_id,
+                                            lineage=req.GET.get('lineage'))
+        response = webob.Response(status_int=200, content_type='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        response.app_iter = events.stream(subscription)
+        return response
+
 class Gridcentric_extension(object):
     """ 
     The OpenStack Extension definition for the Gridcentric capabilities. Currently this includes:
@@ -193,7 +325,11 @@ class Gridcentric_extension(object):
     def get_resources(self):
         resources = []
         resource = extensions.ResourceExtension('gcservers',
-                                               GridcentricTargetBootController())
+                                               GridcentricTargetBootController(),
+                                               collection_actions={'action': 'POST',
+                                                                   'events': 'GET'},
+                                               member_actions={'launched': 'GET',
+                                                               'blessed': 'GET'})
         resources.append(resource)
         return resources
 
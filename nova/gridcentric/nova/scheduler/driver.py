@@ -0,0 +1,121 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+A scheduler driver that places launched instances by clone density.
+
+The driver extends the MultiScheduler, so compute and volume requests still
+go to the configured drivers. To use it, set
+
+    scheduler_driver=gridcentric.nova.scheduler.driver.GridcentricScheduler
+"""
+
+import time
+
+from nova import db
+from nova import exception
+from nova import flags
+from nova.openstack.common import cfg
+from nova.openstack.common import log as logging
+from nova.openstack.common import rpc
+from nova.scheduler import multi
+
+# Defines gridcentric_topic.
+import gridcentric.nova.api
+import gridcentric.nova.memory as memory
+from gridcentric.nova.scheduler import filters
+
+LOG = logging.getLogger('nova.gridcentric.scheduler')
+FLAGS = flags.FLAGS
+driver_opts = [
+               cfg.IntOpt('gridcentric_scheduler_capabilities_ttl',
+               default=300,
+               help='The number of seconds after which the state reported by a '
+                    'gridcentric host is no longer trusted.')]
+FLAGS.register_opts(driver_opts)
+
+class GridcentricScheduler(multi.MultiScheduler):
+
+    def __init__(self, *args, **kwargs):
+        super(GridcentricScheduler, self).__init__(*args, **kwargs)
+        # The state of each gridcentric host and when it was reported.
+        self.gridcentric_states = {}
+
+    def update_service_capabilities(self, service_name, host, capabilities):
+        if service_name == 'gridcentric':
+            self.gridcentric_states[host] = (filters.GridcentricHostState(host, capabilities),
+                                             time.time())
+        super(GridcentricScheduler, self).update_service_capabilities(service_name, host,
+                                                                      capabilities)
+
+    def _compute_memory(self, context):
+        """ Returns the memory of each compute host, as the compute scheduler sees it. """
+        try:
+            states = self.host_manager.get_all_host_states(context, FLAGS.compute_topic)
+        except Exception, e:
+            LOG.warn(_("Unable to get the state of the compute hosts: %s"), str(e))
+            return {}
+        if isinstance(states, dict):
+            states = states.values()
+        return dict([(state.host, {'total_mb': state.total_usable_ram_mb,
+                                   'free_mb': state.free_ram_mb}) for state in states])
+
+    def _host_states(self, context):
+        """
+        Returns the states of the gridcentric hosts that are up. The hosts
+        that have not reported recently get the (full allocation) memory
+        known to the compute scheduler, if any.
+        """
+        host_states = []
+        compute_memory = None
+        now = time.time()
+        for host in self.hosts_up(context, FLAGS.gridcentric_topic):
+            host_state, reported = self.gridcentric_states.get(host, (None, 0))
+            if host_state == None or now - reported > FLAGS.gridcentric_scheduler_capabilities_ttl:
+                if compute_memory == None:
+                    compute_memory = self._compute_memory(context)
+                capabilities = {}
+                if host in compute_memory:
+                    capabilities['memory'] = compute_memory[host]
+                host_state = filters.GridcentricHostState(host, capabilities)
+                self.gridcentric_states[host] = (host_state, now)
+            host_states.append(host_state)
+        return host_states
+
+    def schedule_launch_instance(self, context, instance_uuid, **kwargs):
+        """ Picks the host for a launched instance and sends it the launch. """
+        instance_ref = db.instance_get_by_uuid(context, instance_uuid)
+        metadata = dict([(item['key'], item['value']) for item in instance_ref['metadata']])
+        blessed_uuid = metadata.get('launched_from')
+        blessed_name = None
+        if blessed_uuid:
+            blessed_name = db.instance_get_by_uuid(context, blessed_uuid)['name']
+
+        memory_mb = memory.guest_memory_mb(instance_ref)
+        properties = {'blessed_uuid': blessed_uuid,
+                      'blessed_name': blessed_name,
+                      'memory_mb': memory_mb}
+        host_state = filters.select_host(self._host_states(context), properties)
+        if host_state == None:
+            raise exception.NoValidHost(reason=_("No gridcentric host has enough memory "
+                                                 "for %s.") % instance_uuid)
+        host_state.consume(blessed_uuid, memory_mb)
+
+        LOG.debug(_("Launching %s on %s."), instance_uuid, host_state.host)
+        kwargs['instance_uuid'] = instance_uuid
+        rpc.cast(context,
+                 db.queue_get_for(context, FLAGS.gridcentric_topic, host_state.host),
+                 {"method": "launch_instance",
+                  "args": kwargs})
@@ -0,0 +1,155 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Placement of launched instances based on clone density.
+
+The clones of a blessed instance share most of their memory with the other
+clones of the same blessed instance running on the same host, so a clone only
+costs its unique memory on a host that already runs one of its siblings. How
+much is shared is measured on each host for each blessed instance. The host
+states are built from the capabilities reported by the gridcentric managers
+(see GridCentricManager.get_capabilities).
+"""
+
+from nova import flags
+from nova.openstack.common import cfg
+from nova.openstack.common import log as logging
+from nova.scheduler import filters
+
+LOG = logging.getLogger('nova.gridcentric.scheduler')
+FLAGS = flags.FLAGS
+scheduler_opts = [
+               cfg.IntOpt('gridcentric_scheduler_reserved_memory_mb',
+               default=512,
+               help='The memory (in MB) that is kept free on every gridcentric host.'),
+
+               cfg.BoolOpt('gridcentric_scheduler_use_unknown_hosts',
+               default=True,
+               help='Whether hosts that have not reported their state recently (and '
+                    'whose memory is not known to the compute scheduler) can be chosen. '
+                    'They are only used when no known host fits, and the launches are '
+                    'spread between them.'),
+
+               cfg.FloatOpt('gridcentric_scheduler_fetch_cost',
+               default=0.25,
+               help='The cost added for hosts that would have to download the artifacts '
+                    'of the blessed instance, relative to the cost of its full memory.'),
+
+               cfg.FloatOpt('gridcentric_scheduler_queue_cost',
+               default=0.05,
+               help='The cost added for each launch waiting to run on a host, relative to '
+                    'the cost of the full memory of the clone.')]
+FLAGS.register_opts(scheduler_opts)
+
+class GridcentricHostState(object):
+    """ The state of a gridcentric host, as last reported in its capabilities. """
+
+    def __init__(self, host, capabilities=None):
+        self.host = host
+        capabilities = capabilities or {}
+        memory = capabilities.get('memory') or {}
+        self.total_mb = memory.get('total_mb')
+        self.free_mb = memory.get('free_mb')
+        self.memory_servers = capabilities.get('memory_servers', 0)
+        self.clones = dict(capabilities.get('clones') or {})
+        # The measured fraction of the memory of a clone that is shared with
+        # its siblings, for each blessed instance.
+        self.sharing = dict(capabilities.get('sharing') or {})
+        self.cached_blessed = capabilities.get('cached_blessed')
+        self.launch_queue_depth = capabilities.get('launch_queue_depth', 0)
+
+    def known(self):
+        """ Returns True if the host has reported its memory. """
+        return self.free_mb != None
+
+    def shares_memory(self, blessed_uuid):
+        """
+        Returns True if a new clone of blessed_uuid would share memory with its
+        siblings on this host, i.e. if they run here and were measured to
+        share some of their memory.
+        """
+        return self.clones.get(blessed_uuid, 0) > 0 and self.sharing.get(blessed_uuid, 0) > 0
+
+    def clone_cost_mb(self, blessed_uuid, memory_mb):
+        """ Returns the memory (in MB) that a new clone would use on this host. """
+        if self.shares_memory(blessed_uuid):
+            return int(memory_mb * (1.0 - min(1.0, self.sharing[blessed_uuid])))
+        return memory_mb
+
+    def has_artifacts(self, blessed_name):
+        """ Returns True unless the host is known not to cache the artifacts. """
+        if self.cached_blessed == None or blessed_name == None:
+            return True
+        return blessed_name in self.cached_blessed
+
+    def consume(self, blessed_uuid, memory_mb):
+        """ Accounts for a clone placed here until the host reports again. """
+        if self.known():
+            self.free_mb -= self.clone_cost_mb(blessed_uuid, memory_mb)
+        self.clones[blessed_uuid] = self.clones.get(blessed_uuid, 0) + 1
+        self.launch_queue_depth += 1
+
+class CloneDensityFilter(filters.BaseHostFilter):
+    """
+    Passes the hosts that have enough free memory for the clone, counting
+    only its unique memory on hosts that already run one of its siblings.
+    The filter properties carry the 'blessed_uuid' and the 'memory_mb' of
+    the clone.
+    """
+
+    def host_passes(self, host_state, filter_properties):
+        if not host_state.known():
+            return FLAGS.gridcentric_scheduler_use_unknown_hosts
+        cost = host_state.clone_cost_mb(filter_properties['blessed_uuid'],
+                                        filter_properties['memory_mb'])
+        return host_state.free_mb - cost >= FLAGS.gridcentric_scheduler_reserved_memory_mb
+
+def clone_density_cost_fn(host_state, weighing_properties):
+    """
+    Returns the cost of launching the clone on the host (lower is better):
+    the fraction of its memory that it would use there, plus the cost of
+    downloading its artifacts and of the launches already waiting.
+    """
+    memory_mb = max(1, weighing_properties['memory_mb'])
+    queue_cost = FLAGS.gridcentric_scheduler_queue_cost * host_state.launch_queue_depth
+    if not host_state.known():
+        # Only use hosts that have not reported when nothing else fits, and
+        # spread the launches between them (consume() adds to their queue).
+        return 2.0 + FLAGS.gridcentric_scheduler_fetch_cost + queue_cost
+    cost = float(host_state.clone_cost_mb(weighing_properties['blessed_uuid'],
+                                          memory_mb)) / memory_mb
+    if not host_state.has_artifacts(weighing_properties.get('blessed_name')):
+        cost += FLAGS.gridcentric_scheduler_fetch_cost
+    return cost + queue_cost
+
+def select_host(host_states, properties):
+    """
+    Returns the host state with the lowest cost that passes the filter, or
+    None. Among hosts of equal cost the fullest one is chosen, so that the
+    clones are packed rather than spread.
+    """
+    host_filter = CloneDensityFilter()
+    best = None
+    best_key = None
+    for host_state in host_states:
+        if not host_filter.host_passes(host_state, properties):
+            continue
+        key = (clone_density_cost_fn(host_state, properties),
+               host_state.known() and host_state.free_mb or 0)
+        if best == None or key < best_key:
+            best = host_state
+            best_key = key
+    return best
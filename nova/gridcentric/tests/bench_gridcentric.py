@@ -0,0 +1,222 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+End-to-end benchmarks for the gridcentric stack.
+
+The benchmark drives the gridcentric API and manager in-process: RPC messages
+are delivered directly to a local GridCentricManager, which uses the simulated
+vms connection. It reports the launch throughput, the latency percentiles of
+each operation and the number of database queries per operation, and writes
+the results as JSON so that they can be compared against a baseline:
+
+    python -m gridcentric.tests.bench_gridcentric --output=bench.json
+    python -m gridcentric.tests.bench_gridcentric --baseline=bench.json
+"""
+
+import argparse
+import json
+import sys
+import time
+
+import eventlet
+
+from nova import context
+from nova import flags
+from nova.db.sqlalchemy import session as db_session
+from nova.openstack.common import rpc
+
+from sqlalchemy import event
+
+import gridcentric.nova.api as gc_api
+import gridcentric.nova.extension.manager as gc_manager
+import gridcentric.tests as tests
+import gridcentric.tests.utils as utils
+
+FLAGS = flags.FLAGS
+
+class LoopbackRpc(object):
+    """
+    Delivers RPC messages straight to an in-process manager. Messages for
+    nova-compute (e.g. pre_live_migration) are dropped.
+    """
+
+    def __init__(self):
+        self.manager = None
+
+    def _dispatch(self, context, queue, msg):
+        method = msg['method']
+        args = dict(msg.get('args', {}))
+        if queue == FLAGS.scheduler_topic:
+            # The scheduler would pick a host and forward the message.
+            args.pop('topic', None)
+            return getattr(self.manager, method)(context, **args)
+        elif queue.startswith(FLAGS.gridcentric_topic):
+            return getattr(self.manager, method)(context, **args)
+        return None
+
+    def call(self, context, queue, msg, timeout=None):
+        return self._dispatch(context, queue, msg)
+
+    def cast(self, context, queue, msg):
+        self._dispatch(context, queue, msg)
+
+class QueryCounter(object):
+    """ Counts the SQL statements run against the nova database. """
+
+    def __init__(self):
+        self.count = 0
+        event.listen(db_session.get_engine(), 'before_cursor_execute', self._count)
+
+    def _count(self, *args, **kwargs):
+        self.count += 1
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[int(round((p / 100.0) * (len(values) - 1)))]
+
+def summarize(latencies, queries):
+    return {'count': len(latencies),
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'max': latencies and max(latencies) or None,
+            'mean': latencies and sum(latencies) / len(latencies) or None,
+            'queries_per_op': latencies and float(queries) / len(latencies) or None}
+
+class Benchmark(object):
+
+    def __init__(self, options):
+        self.options = options
+
+        FLAGS.connection_type = 'fake'
+        FLAGS.stub_network = True
+        FLAGS.gridcentric_simulate = True
+        FLAGS.gridcentric_sim_latency = options.latency
+        FLAGS.gridcentric_sim_host_memory_mb = options.host_memory_mb
+        tests.setup()
+
+        self.rpc = LoopbackRpc()
+        rpc.call = self.rpc.call
+        rpc.cast = self.rpc.cast
+
+        self.context = context.RequestContext('fake', 'fake', True)
+        self.manager = gc_manager.GridCentricManager()
+        self.rpc.manager = self.manager
+        self.api = gc_api.API()
+        self.queries = QueryCounter()
+
+    def _timed(self, results, fn, *args, **kwargs):
+        start = time.time()
+        result = fn(*args, **kwargs)
+        results.append(time.time() - start)
+        return result
+
+    def run(self):
+        bless_latencies = []
+        launch_latencies = []
+        discard_latencies = []
+
+        instance_uuid = utils.create_instance(self.context, {'host': self.manager.host})
+
+        blessed = []
+        start_queries = self.queries.count
+        for i in range(self.options.blessed):
+            blessed.append(self._timed(bless_latencies, self.api.bless_instance,
+                                       self.context, instance_uuid)['uuid'])
+        bless_queries = self.queries.count - start_queries
+
+        pool = eventlet.GreenPool(self.options.concurrency)
+        launched = []
+        def launch(blessed_uuid):
+            launched.append(self._timed(launch_latencies, self.api.launch_instance,
+                                        self.context, blessed_uuid)['uuid'])
+
+        start_queries = self.queries.count
+        start = time.time()
+        for i in range(self.options.clones):
+            pool.spawn(launch, blessed[i % len(blessed)])
+        pool.waitall()
+        launch_time = time.time() - start
+        launch_queries = self.queries.count - start_queries
+
+        # Get rid of the clones so that the blessed instances can be discarded.
+        for uuid in launched:
+            self.manager.db.instance_destroy(self.context, uuid)
+
+        start_queries = self.queries.count
+        for uuid in blessed:
+            self._timed(discard_latencies, self.api.discard_instance, self.context, uuid)
+        discard_queries = self.queries.count - start_queries
+
+        launch_results = summarize(launch_latencies, launch_queries)
+        launch_results['clones_per_second'] = len(launch_latencies) / launch_time
+        return {'config': {'clones': self.options.clones,
+                           'blessed': self.options.blessed,
+                           'concurrency': self.options.concurrency,
+                           'latency': self.options.latency,
+                           'host_memory_mb': self.options.host_memory_mb},
+                'results': {'bless': summarize(bless_latencies, bless_queries),
+                            'launch': launch_results,
+                            'discard': summarize(discard_latencies, discard_queries)}}
+
+def compare(results, baseline, out):
+    """ Writes the relative change of every result compared to the baseline. """
+    for operation, values in sorted(results['results'].items()):
+        base_values = baseline['results'].get(operation, {})
+        for key, value in sorted(values.items()):
+            base = base_values.get(key)
+            if value == None or not base:
+                continue
+            out.write('%-8s %-18s %12.4f %12.4f %+8.1f%%\n' %
+                      (operation, key, base, value, 100.0 * (value - base) / base))
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the gridcentric stack.')
+    parser.add_argument('--clones', type=int, default=200,
+                        help='the number of clones to launch')
+    parser.add_argument('--blessed', type=int, default=1,
+                        help='the number of blessed instances to launch from')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='the number of launches in flight at once')
+    parser.add_argument('--latency', action='append', default=None,
+                        help='a simulated command latency (see gridcentric_sim_latency)')
+    parser.add_argument('--host-memory-mb', type=int, default=1 << 20,
+                        help='the memory of the simulated host')
+    parser.add_argument('--output', default=None,
+                        help='the file to write the JSON results to')
+    parser.add_argument('--baseline', default=None,
+                        help='a previous JSON result to compare against')
+    options = parser.parse_args(argv)
+    if options.latency == None:
+        # Measure our own overhead by default.
+        options.latency = []
+
+    results = Benchmark(options).run()
+
+    if options.output:
+        with open(options.output, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    else:
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+
+    if options.baseline:
+        with open(options.baseline) as baseline:
+            compare(results, json.load(baseline), sys.stdout)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,149 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+"""
+Measures how many clones fit on a simulated cluster.
+
+Clones of several blessed instances are launched (in a random order) until
+the first launch that does not fit. The hosts account for memory the way vms
+does: the shared part of a blessed instance's memory is only used once per
+host, and each clone adds its unique part. The clones are placed either the
+way the generic scheduler would (a full memory_mb allocation on the host
+with the most free memory) or with the gridcentric clone density filter and
+cost function, fed with the capabilities the hosts would report:
+
+    python -m gridcentric.tests.bench_scheduler --hosts=16 --blessed=8
+"""
+
+import argparse
+import json
+import random
+import sys
+
+from nova import flags
+
+from gridcentric.nova.scheduler import filters
+
+FLAGS = flags.FLAGS
+
+class SimulatedHost(object):
+
+    def __init__(self, name, memory_mb, shared_ratio):
+        self.name = name
+        self.memory_mb = memory_mb
+        self.shared_ratio = shared_ratio
+        self.shared = {}
+        self.clones = {}
+        # The memory the generic scheduler believes is used.
+        self.allocated_mb = 0
+
+    def used_mb(self):
+        unique = sum([count * memory_mb * (1.0 - self.shared_ratio)
+                      for (blessed, memory_mb), count in self.clones.items()])
+        return int(unique + sum(self.shared.values()))
+
+    def fits(self, blessed, memory_mb):
+        extra = memory_mb * (1.0 - self.shared_ratio)
+        if blessed not in self.shared:
+            extra += memory_mb * self.shared_ratio
+        return self.used_mb() + extra <= self.memory_mb
+
+    def launch(self, blessed, memory_mb):
+        if blessed not in self.shared:
+            self.shared[blessed] = memory_mb * self.shared_ratio
+        key = (blessed, memory_mb)
+        self.clones[key] = self.clones.get(key, 0) + 1
+        self.allocated_mb += memory_mb
+
+    def capabilities(self):
+        """ The capabilities the gridcentric manager would report. """
+        clones = {}
+        for (blessed, memory_mb), count in self.clones.items():
+            clones[blessed] = clones.get(blessed, 0) + count
+        return {'memory': {'total_mb': self.memory_mb,
+                           'free_mb': self.memory_mb - self.used_mb()},
+                'clones': clones,
+                'sharing': dict([(blessed, self.shared_ratio) for blessed in clones]),
+                'launch_queue_depth': 0}
+
+def generic_placement(hosts, blessed, memory_mb):
+    """ Places the clone like a ram-weighed filter scheduler (full allocations). """
+    candidates = [host for host in hosts if host.memory_mb - host.allocated_mb >= memory_mb]
+    if not candidates:
+        return None
+    return max(candidates, key=lambda host: host.memory_mb - host.allocated_mb)
+
+def gridcentric_placement(hosts, blessed, memory_mb):
+    states = dict([(host.name, filters.GridcentricHostState(host.name, host.capabilities()))
+                   for host in hosts])
+    state = filters.select_host(states.values(), {'blessed_uuid': blessed,
+                                                  'blessed_name': None,
+                                                  'memory_mb': memory_mb})
+    if state == None:
+        return None
+    return [host for host in hosts if host.name == state.host][0]
+
+PLACEMENTS = {'generic': generic_placement, 'gridcentric': gridcentric_placement}
+
+def run(placement, options, launches):
+    hosts = [SimulatedHost('host%d' % i, options.host_memory_mb, options.shared_ratio)
+             for i in range(options.hosts)]
+    placed = 0
+    for blessed, memory_mb in launches:
+        host = placement(hosts, blessed, memory_mb)
+        if host == None or not host.fits(blessed, memory_mb):
+            break
+        host.launch(blessed, memory_mb)
+        placed += 1
+    used = sum([host.used_mb() for host in hosts])
+    return {'clones': placed,
+            'memory_used_mb': used,
+            'memory_total_mb': options.hosts * options.host_memory_mb,
+            'hosts_used': len([host for host in hosts if host.clones])}
+
+def main(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the placement of clones.')
+    parser.add_argument('--hosts', type=int, default=16,
+                        help='the number of hosts in the cluster')
+    parser.add_argument('--host-memory-mb', type=int, default=32768,
+                        help='the memory of each host')
+    parser.add_argument('--blessed', type=int, default=8,
+                        help='the number of blessed instances to launch from')
+    parser.add_argument('--memory-mb', type=int, default=2048,
+                        help='the memory of each clone')
+    parser.add_argument('--shared-ratio', type=float, default=0.75,
+                        help='the fraction of the memory of a clone shared with its siblings')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='the random seed for the order of the launches')
+    options = parser.parse_args(argv)
+
+    FLAGS.gridcentric_scheduler_reserved_memory_mb = 0
+
+    # Enough launches to fill the cluster even if every page were shared.
+    count = int(options.hosts * options.host_memory_mb /
+                (options.memory_mb * max(0.01, 1.0 - options.shared_ratio))) + 1
+    rand = random.Random(options.seed)
+    launches = [('blessed-%d' % rand.randrange(options.blessed), options.memory_mb)
+                for i in range(count)]
+
+    results = dict([(name, run(placement, options, launches))
+                    for name, placement in PLACEMENTS.items()])
+    if results['generic']['clones'] > 0:
+        results['gain'] = float(results['gridcentric']['clones']) / results['generic']['clones']
+    json.dump(results, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
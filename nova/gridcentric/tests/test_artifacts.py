@@ -0,0 +1,110 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from wsgiref import simple_server
+
+from nova import flags
+
+from gridcentric.nova.extension import artifacts
+
+FLAGS = flags.FLAGS
+
+class QuietHandler(simple_server.WSGIRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+class ArtifactsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = tempfile.mkdtemp()
+        self.data = 'blessed-memory' * 1000
+        with open(os.path.join(self.cache, 'instance-1.0.gc'), 'wb') as artifact:
+            artifact.write(self.data)
+
+        self.server = simple_server.make_server('127.0.0.1', 0,
+                                                artifacts.ArtifactServer(self.cache, port=1),
+                                                handler_class=QuietHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+        FLAGS.gridcentric_artifact_port = self.server.server_port
+        FLAGS.gridcentric_artifact_secret = 'secret'
+        self.target = os.path.join(self.cache, 'target')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+        FLAGS.gridcentric_artifact_port = None
+        FLAGS.gridcentric_artifact_secret = None
+        shutil.rmtree(self.cache)
+
+    def test_fetch_from_peers(self):
+        checksum = hashlib.md5(self.data).hexdigest()
+        peer = artifacts.fetch_from_peers(['127.0.0.1'], 'instance-1.0.gc', self.target,
+                                          size=len(self.data), checksum=checksum)
+        self.assertEquals('127.0.0.1', peer)
+        self.assertEquals(self.data, open(self.target).read())
+
+    def test_fetch_rejects_bad_checksum(self):
+        self.assertEquals(None, artifacts.fetch_from_peers(['127.0.0.1'], 'instance-1.0.gc',
+                                                           self.target, checksum='0' * 32))
+
+    def test_server_requires_token(self):
+        status = []
+        app = artifacts.ArtifactServer(self.cache, port=1)
+        app({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/instance-1.0.gc'},
+            lambda code, headers: status.append(code))
+        self.assertEquals(['403 Forbidden'], status)
+
+    def test_server_rejects_replayed_token(self):
+        app = artifacts.ArtifactServer(self.cache, port=1)
+        token = artifacts.artifact_token('instance-1.0.gc')
+        self.assertTrue(app.check_token('instance-1.0.gc', token))
+        self.assertFalse(app.check_token('instance-1.0.gc', token))
+        self.assertFalse(app.check_token('instance-2.0.gc',
+                                         artifacts.artifact_token('instance-1.0.gc')))
+
+    def test_server_rejects_expired_token(self):
+        app = artifacts.ArtifactServer(self.cache, port=1)
+        token = artifacts.artifact_token('instance-1.0.gc', now=1000)
+        self.assertFalse(app.check_token('instance-1.0.gc', token))
+        self.assertTrue(app.check_token('instance-1.0.gc', token, now=1001))
+
+    def test_server_requires_secret(self):
+        FLAGS.gridcentric_artifact_secret = None
+        app = artifacts.ArtifactServer(self.cache, port=1)
+        self.assertRaises(Exception, app.start)
+        self.assertFalse(app.check_token('instance-1.0.gc', 'anything'))
+
+    def test_server_only_serves_cache_files(self):
+        self.assertEquals(None, artifacts.fetch_from_peers(['127.0.0.1'], '../etc/passwd',
+                                                           self.target))
+        self.assertEquals(None, artifacts.fetch_from_peers(['127.0.0.1'], 'missing',
+                                                           self.target))
+
+    def test_cached_blessed_instances(self):
+        with open(os.path.join(self.cache, 'instance-1.1.gc'), 'wb') as artifact:
+            artifact.write('x' * 10)
+        open(os.path.join(self.cache, 'tmpabc.part'), 'wb').close()
+        open(os.path.join(self.cache, 'a94a8fe5ccb19ba61c4c0873d391e987982fbbd3'), 'wb').close()
+        self.assertEquals({'instance-1': len(self.data) + 10},
+                          artifacts.cached_blessed_instances(self.cache))
@@ -0,0 +1,186 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from gridcentric.nova.client import client
+from gridcentric.nova.client import exceptions
+
+class FakeResponse(dict):
+
+    def __init__(self, status, headers={}):
+        super(FakeResponse, self).__init__(headers)
+        self.status = status
+
+class FakeNovaClient(client.NovaClient):
+    """ A client talking to a fake server that accepts a single valid token. """
+
+    def __init__(self, *args, **kwargs):
+        apikey = kwargs.pop('apikey', 'key')
+        super(FakeNovaClient, self).__init__('http://auth/v1.0', 'user', apikey, *args, **kwargs)
+        self.server = {'token': 'token-0', 'auths': 0, 'requests': []}
+
+    def _authenticate(self):
+        time.sleep(0.01)
+        if self.apikey != 'key':
+            raise exceptions.HttpException(code=401)
+        self.server['auths'] += 1
+        self.server['token'] = 'token-%d' % self.server['auths']
+        self.auth_token = self.server['token']
+        self.management_url = 'http://nova/v1.1'
+        self.token_expires = None
+
+    def request(self, uri, method='GET', body=None, headers=None):
+        self.server['requests'].append((uri, method, headers))
+        if headers.get('X-Auth-Token') != self.server['token']:
+            raise exceptions.HttpException(code=401)
+        if uri.endswith('/missing/action'):
+            raise exceptions.HttpException(code=404)
+        if self.server.get('failures'):
+            code, retry_after = self.server['failures'].pop(0)
+            raise exceptions.HttpException(code=code, retry_after=retry_after)
+        return FakeResponse(200), {'servers': []}
+
+class NovaClientTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.tmpdir, 'tokens')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_token_shared_between_clients(self):
+        first = FakeNovaClient(token_cache_path=self.cache_path)
+        first.authenticated_request('/servers', 'GET')
+        self.assertEquals(1, first.server['auths'])
+
+        second = FakeNovaClient(token_cache_path=self.cache_path)
+        second.server = first.server
+        second.authenticated_request('/servers', 'GET')
+        self.assertEquals(1, first.server['auths'])
+
+    def test_token_not_shared_without_credentials(self):
+        first = FakeNovaClient(token_cache_path=self.cache_path)
+        first.authenticated_request('/servers', 'GET')
+
+        second = FakeNovaClient(token_cache_path=self.cache_path, apikey='wrong')
+        second.server = first.server
+        self.assertRaises(exceptions.HttpException,
+                          second.authenticated_request, '/servers', 'GET')
+        self.assertEquals(None, second.auth_token)
+
+        # Nor through the token file.
+        cache = client.TokenCache(self.cache_path)
+        self.assertEquals(None, cache.get(second._token_key()))
+
+    def test_token_persisted(self):
+        first = FakeNovaClient(token_cache_path=self.cache_path)
+        first.authenticated_request('/servers', 'GET')
+
+        # A new process starts with an empty cache in memory.
+        cache = client.TokenCache(self.cache_path)
+        entry = cache.get(first._token_key())
+        self.assertEquals(first.auth_token, entry['token'])
+        self.assertEquals('http://nova/v1.1', entry['management_url'])
+
+    def test_single_flight_reauthentication(self):
+        nova = FakeNovaClient(token_cache_path=self.cache_path)
+        nova.authenticated_request('/servers', 'GET')
+        # The token is revoked on the server.
+        nova.server['token'] = 'revoked'
+
+        threads = [threading.Thread(target=nova.authenticated_request, args=('/servers', 'GET'))
+                   for i in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(2, nova.server['auths'])
+
+    def test_connection_pool_is_bounded(self):
+        pool = client.ConnectionPool(size=2)
+        first = pool.get()
+        second = pool.get()
+        self.assertEquals(2, pool.created)
+        pool.put(first)
+        self.assertTrue(pool.get() is first)
+
+    def test_map_actions(self):
+        nova = FakeNovaClient(token_cache_path=self.cache_path)
+        result = nova.map_actions([('launch_instance', 'blessed', {})] * 5 +
+                                  [('bless_instance', 'missing')], concurrency=3)
+
+        self.assertEquals(6, len(result))
+        self.assertFalse(result.ok())
+        self.assertEquals(1, len(result.errors))
+        index, error = result.errors[0]
+        self.assertEquals(5, index)
+        self.assertEquals(404, error.code)
+        self.assertEquals(1, nova.server['auths'])
+        self.assertRaises(ValueError, nova.map_actions, [('request', '/')])
+
+class RetryPolicyTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.nova = FakeNovaClient(retry_policy=client.RetryPolicy(backoff=0, jitter=0))
+
+    def test_idempotent_request_retried(self):
+        self.nova.server['failures'] = [(503, '0'), (500, None)]
+        self.nova.list_launched_instances('blessed')
+        self.assertEquals(3, len(self.nova.server['requests']))
+
+    def test_unsafe_request_only_retried_when_refused(self):
+        self.nova.server['failures'] = [(429, None)]
+        self.nova.launch_instance('blessed')
+
+        self.nova.server['failures'] = [(500, None)]
+        try:
+            self.nova.launch_instance('blessed')
+            self.fail("A launch that failed on the server should not be retried.")
+        except exceptions.HttpException, e:
+            self.assertEquals(500, e.code)
+
+    def test_over_quota_not_retried(self):
+        self.nova.server['failures'] = [(413, '0')]
+        try:
+            self.nova.launch_instance('blessed')
+            self.fail("A launch over quota should not be retried.")
+        except exceptions.HttpException, e:
+            self.assertEquals(413, e.code)
+
+        self.nova.server['failures'] = [(413, '0')]
+        self.assertRaises(exceptions.HttpException, self.nova.list_blessed_instances, 'blessed')
+
+        self.nova.server['requests'] = []
+        self.nova.retry_policy.max_retry_after = 0
+        self.nova.server['failures'] = [(413, '1')]
+        self.nova.launch_instance('blessed')
+        self.assertEquals(2, len(self.nova.server['requests']))
+
+    def test_retry_budget(self):
+        self.nova.retry_policy.budget = 1.0
+        self.nova.server['failures'] = [(503, '0'), (503, '0')]
+        self.assertRaises(exceptions.HttpException, self.nova.list_blessed_instances, 'blessed')
+
+    def test_retry_after(self):
+        policy = client.RetryPolicy(backoff=1.0, jitter=0)
+        self.assertEquals(2.0, policy.delay(exceptions.HttpException(503, retry_after='2'), 0))
+        self.assertEquals(4.0, policy.delay(exceptions.HttpException(503), 2))
@@ -0,0 +1,112 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import json
+import unittest
+
+from nova import flags
+
+from gridcentric.nova.osapi import events
+
+FLAGS = flags.FLAGS
+
+def notification(event_type, instance_id, tenant_id='tenant1', lineage=[]):
+    return {'message_id': 'message-%s' % instance_id,
+            'event_type': event_type,
+            'timestamp': '2012-07-17 13:52:50',
+            'payload': {'instance_id': instance_id,
+                        'tenant_id': tenant_id,
+                        'lineage': lineage}}
+
+class EventHubTestCase(unittest.TestCase):
+
+    def setUp(self):
+        FLAGS.gridcentric_events_consume = False
+        self.hub = events.HUB
+
+    def tearDown(self):
+        self.hub.subscriptions.clear()
+        self.hub.parents.clear()
+
+    def test_local_notifier_publishes_events(self):
+        subscription = self.hub.subscribe()
+        events.notify(None, notification('gridcentric.instance.launch.end', 'clone-1'))
+        events.notify(None, notification('compute.instance.create.end', 'other-1'))
+
+        event = subscription.get(timeout=0)
+        self.assertEquals('clone-1', event['instance_id'])
+        self.assertEquals('ACTIVE', event['status'])
+        self.assertEquals(None, subscription.get(timeout=0))
+
+    def test_filters(self):
+        tenant = self.hub.subscribe(tenant_id='tenant2')
+        lineage = self.hub.subscribe(lineage='original')
+        events.notify(None, notification('gridcentric.instance.bless.end', 'blessed-1',
+                                          lineage=['original']))
+        events.notify(None, notification('gridcentric.instance.launch.end', 'clone-1',
+                                          tenant_id='tenant2',
+                                          lineage=['blessed-1', 'original']))
+        events.notify(None, notification('gridcentric.instance.launch.end', 'clone-2',
+                                          lineage=['blessed-2', 'other']))
+
+        self.assertEquals('clone-1', tenant.get(timeout=0)['instance_id'])
+        self.assertEquals(None, tenant.get(timeout=0))
+        self.assertEquals('blessed-1', lineage.get(timeout=0)['instance_id'])
+        self.assertEquals('clone-1', lineage.get(timeout=0)['instance_id'])
+        self.assertEquals(None, lineage.get(timeout=0))
+
+    def test_hub_resolves_lineage(self):
+        self.hub.parents['blessed-1'] = 'original'
+        subscription = self.hub.subscribe(lineage='original')
+        message = notification('gridcentric.instance.launch.end', 'clone-1')
+        del message['payload']['lineage']
+        message['payload']['parent_id'] = 'blessed-1'
+        events.notify(None, message)
+
+        self.assertEquals(['blessed-1', 'original'], subscription.get(timeout=0)['lineage'])
+        self.assertEquals('blessed-1', self.hub.parents['clone-1'])
+
+    def test_parents_are_bounded(self):
+        max_parents = events.MAX_PARENTS
+        events.MAX_PARENTS = 2
+        try:
+            self.hub.subscribe()
+            for clone in ('clone-1', 'clone-2'):
+                message = notification('gridcentric.instance.launch.end', clone)
+                message['payload']['parent_id'] = 'blessed-1'
+                events.notify(None, message)
+            # Seeing clone-1 again keeps it over clone-2.
+            self.hub.lineage('clone-1')
+            message = notification('gridcentric.instance.launch.end', 'clone-3')
+            message['payload']['parent_id'] = 'blessed-1'
+            events.notify(None, message)
+        finally:
+            events.MAX_PARENTS = max_parents
+
+        self.assertEquals(['clone-1', 'clone-3'], self.hub.parents.keys())
+
+    def test_stream(self):
+        subscription = self.hub.subscribe()
+        stream = events.stream(subscription, keepalive=0)
+        self.assertEquals('retry: 0\n\n', stream.next())
+        self.assertEquals(': keepalive\n\n', stream.next())
+
+        events.notify(None, notification('gridcentric.instance.discard.end', 'blessed-1'))
+        lines = stream.next().split('\n')
+        self.assertEquals('event: gridcentric.instance.discard.end', lines[1])
+        self.assertEquals('DELETED', json.loads(lines[2][len('data: '):])['status'])
+
+        stream.close()
+        self.assertFalse(subscription in self.hub.subscriptions)
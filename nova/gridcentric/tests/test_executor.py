@@ -0,0 +1,104 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import threading
+import time
+import unittest
+
+import eventlet
+
+from gridcentric.nova.extension import executor
+
+def bless(value):
+    if value < 0:
+        raise ValueError("negative")
+    return (os.getpid(), value)
+
+class VmsExecutorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = executor.VmsExecutor(limits={'launch': 2}, default_limit=1,
+                                             process_commands=['bless'], processes=1)
+
+    def test_parse_limits(self):
+        self.assertEquals({'bless': 4, 'launch': 16},
+                          executor.parse_limits(['bless:4', ' launch : 16']))
+        self.assertRaises(ValueError, executor.parse_limits, ['bless'])
+
+    def test_execute_records_stats(self):
+        self.assertEquals(5, self.executor.execute('launch', lambda x: x + 1, 4))
+        try:
+            self.executor.execute('launch', lambda: 1 / 0)
+            self.fail("The exception should have been raised to the caller.")
+        except ZeroDivisionError:
+            pass
+
+        stats = self.executor.stats()['launch']
+        self.assertEquals(1, stats['completed'])
+        self.assertEquals(1, stats['failed'])
+        self.assertEquals(0, stats['queued'])
+        self.assertEquals(0, stats['running'])
+
+    def test_execute_respects_limit(self):
+        lock = threading.Lock()
+        active = [0, 0]
+        def command():
+            with lock:
+                active[0] += 1
+                active[1] = max(active[1], active[0])
+            time.sleep(0.05)
+            with lock:
+                active[0] -= 1
+
+        pool = eventlet.GreenPool()
+        for i in range(6):
+            pool.spawn(self.executor.execute, 'launch', command)
+        pool.waitall()
+
+        self.assertTrue(active[1] <= 2, "At most 2 launches should have run at once.")
+        self.assertEquals(6, self.executor.stats()['launch']['completed'])
+
+    def test_commands_run_on_their_own_threads(self):
+        native_threading = eventlet.patcher.original('threading')
+        release = native_threading.Event()
+        def thread_name():
+            return native_threading.current_thread().name
+        def launch():
+            release.wait(5)
+            return thread_name()
+
+        pool = eventlet.GreenPool()
+        launches = [pool.spawn(self.executor.execute, 'launch', launch) for i in range(2)]
+        eventlet.sleep(0.05)
+        # Both launch threads are busy, but a discard still runs right away.
+        self.assertEquals('vms-discard-0',
+                          self.executor.execute('discard', thread_name))
+        release.set()
+        self.assertEquals(set(['vms-launch-0', 'vms-launch-1']),
+                          set([launch.wait() for launch in launches]))
+
+    def test_process_commands(self):
+        pid, value = self.executor.execute('bless', bless, 1)
+        self.assertNotEquals(os.getpid(), pid)
+        self.assertEquals(1, value)
+        # The worker is reused.
+        self.assertEquals(pid, self.executor.execute('bless', bless, 2)[0])
+        self.assertRaises(ValueError, self.executor.execute, 'bless', bless, -1)
+
+        # Functions that cannot be pickled stay in this process.
+        self.assertEquals(os.getpid(), self.executor.execute('bless', lambda: os.getpid()))
+        self.assertEquals(3, self.executor.stats()['bless']['completed'])
+        self.assertEquals(1, self.executor.stats()['bless']['failed'])
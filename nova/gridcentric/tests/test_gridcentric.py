@@ -24,6 +24,9 @@ from nova import context
 from nova import exception
 from nova.openstack.common import rpc
 from nova.compute import vm_states
+from nova.db.sqlalchemy import session as db_session
+
+from sqlalchemy import event
 
 # Setup VMS environment.
 os.environ['VMS_SHELF_PATH'] = '.'
@@ -224,6 +227,29 @@ class GridCentricTestCase(unittest.TestCase):
         except exception.NovaException, e:
             pass # Success!
 
+    def test_bulk_action(self):
+        instance_uuids = [utils.create_instance(self.context, {'host': 'host1'})
+                          for i in range(2)]
+
+        results = self.gridcentric_api.bulk_action(self.context,
+                        [{'id': instance_uuids[0], 'action': 'gc_bless'},
+                         {'id': instance_uuids[1], 'action': 'gc_bless'},
+                         {'id': instance_uuids[1], 'action': 'gc_launch'},
+                         {'id': 'missing', 'action': 'gc_discard'}])
+
+        self.assertEquals(['ok', 'ok', 'error', 'error'],
+                          [result['status'] for result in results])
+        self.assertEquals(400, results[2]['error']['code'])
+        self.assertEquals(404, results[3]['error']['code'])
+        self.assertEquals(1, len(results[0]['servers']))
+
+        # Both blesses should have been sent to host1 in a single message.
+        self.assertEquals(1, len(self.mock_rpc.cast_log))
+        queue, message = self.mock_rpc.cast_log[0]
+        self.assertEquals('run_batch', message['method'])
+        self.assertEquals([result['servers'][0]['uuid'] for result in results[:2]],
+                          [call['args']['instance_uuid'] for call in message['args']['calls']])
+
     def test_launch_instance_twice(self):
 
         instance_uuid = utils.create_instance(self.context)
@@ -298,3 +324,24 @@ class GridCentricTestCase(unittest.TestCase):
         except ValueError:
             pass
 
+    def test_prefetch_hosts_queries(self):
+        FLAGS.gridcentric_prefetch_lineage_hosts = 4
+        queries = []
+        def count(*args, **kwargs):
+            queries.append(args[2])
+        event.listen(db_session.get_engine(), 'before_cursor_execute', count)
+
+        instance_uuid = utils.create_instance(self.context)
+        instance_ref = db.instance_get_by_uuid(self.context, instance_uuid)
+        def prefetch_queries():
+            self.gridcentric._prefetch_hosts(self.context, instance_ref)
+            del queries[:]
+            self.gridcentric._prefetch_hosts(self.context, instance_ref)
+            return len(queries)
+
+        self.gridcentric_api.bless_instance(self.context, instance_uuid)
+        one_sibling = prefetch_queries()
+        for i in range(3):
+            self.gridcentric_api.bless_instance(self.context, instance_uuid)
+        # The clones of the siblings are not looked up again for every bless.
+        self.assertEquals(one_sibling, prefetch_queries())
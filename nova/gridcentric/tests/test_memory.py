@@ -0,0 +1,54 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+from gridcentric.nova import memory
+
+class ChargedMemoryTestCase(unittest.TestCase):
+
+    def test_full_mode_charges_the_guest_memory(self):
+        self.assertEquals(2048, memory.charged_memory_mb(2048, '512MB', mode='full'))
+
+    def test_target_mode_charges_the_target(self):
+        self.assertEquals(512, memory.charged_memory_mb(2048, '512MB', mode='target'))
+        self.assertEquals(512, memory.charged_memory_mb(2048, '512mb', mode='working_set'))
+        # The charge is rounded up to the next MB.
+        self.assertEquals(2, memory.charged_memory_mb(2048, '1028KB', mode='target'))
+
+    def test_target_mode_is_capped_by_the_guest_memory(self):
+        self.assertEquals(2048, memory.charged_memory_mb(2048, '4GB', mode='target'))
+
+    def test_no_target_charges_the_guest_memory(self):
+        self.assertEquals(2048, memory.charged_memory_mb(2048, None, mode='target'))
+        self.assertEquals(2048, memory.charged_memory_mb(2048, '0', mode='target'))
+        self.assertEquals(2048, memory.charged_memory_mb(2048, 'garbage', mode='target'))
+
+    def test_invalid_mode(self):
+        self.assertRaises(ValueError, memory.charged_memory_mb, 2048, '512MB', mode='half')
+
+    def test_guest_memory_is_the_instance_type_memory(self):
+        self.assertEquals(2048, memory.guest_memory_mb({'memory_mb': 512,
+                                                        'instance_type': {'memory_mb': 2048}}))
+        self.assertEquals(512, memory.guest_memory_mb({'memory_mb': 512,
+                                                       'instance_type': None}))
+
+    def test_recorded_charge(self):
+        self.assertEquals(None, memory.recorded_charge_mb({'system_metadata': []}))
+        self.assertEquals(512, memory.recorded_charge_mb(
+                                    {'system_metadata': [{'key': memory.CHARGE_KEY,
+                                                          'value': '512'}]}))
+        self.assertEquals(256, memory.recorded_charge_mb(
+                                    {'system_metadata': {memory.CHARGE_KEY: '256'}}))
@@ -0,0 +1,73 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import unittest
+
+from nova import flags
+
+from gridcentric.nova.scheduler import filters
+
+FLAGS = flags.FLAGS
+
+def host_state(host, free_mb, clones={}, sharing=0.75, cached_blessed=None):
+    return filters.GridcentricHostState(host, {'memory': {'total_mb': 8192,
+                                                          'free_mb': free_mb},
+                                               'clones': clones,
+                                               'sharing': dict([(blessed, sharing)
+                                                                for blessed in clones]),
+                                               'cached_blessed': cached_blessed})
+
+class CloneDensityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        FLAGS.gridcentric_scheduler_reserved_memory_mb = 0
+        self.properties = {'blessed_uuid': 'blessed', 'blessed_name': 'instance-1',
+                           'memory_mb': 2048}
+
+    def test_siblings_only_cost_unique_memory(self):
+        host_filter = filters.CloneDensityFilter()
+        self.assertTrue(host_filter.host_passes(host_state('a', 512, {'blessed': 1}),
+                                                self.properties))
+        self.assertFalse(host_filter.host_passes(host_state('a', 512), self.properties))
+        # Hosts that measured no sharing get no discount.
+        self.assertFalse(host_filter.host_passes(host_state('a', 512, {'blessed': 1}, 0),
+                                                 self.properties))
+
+    def test_select_host_packs_siblings(self):
+        states = [host_state('empty', 8192),
+                  host_state('sibling', 4096, {'blessed': 2}),
+                  host_state('other', 4096, {'other': 2})]
+        self.assertEquals('sibling', filters.select_host(states, self.properties).host)
+
+    def test_select_host_prefers_cached_artifacts(self):
+        states = [host_state('a', 8192, cached_blessed={}),
+                  host_state('b', 8192, cached_blessed={'instance-1': 100})]
+        self.assertEquals('b', filters.select_host(states, self.properties).host)
+
+    def test_consume(self):
+        state = host_state('a', 8192, {'blessed': 1})
+        state.consume('blessed', 2048)
+        state.consume('other', 2048)
+        self.assertEquals(8192 - 512 - 2048, state.free_mb)
+        self.assertEquals(2, state.clones['blessed'])
+
+    def test_unknown_hosts_are_spread(self):
+        states = [filters.GridcentricHostState('a'), filters.GridcentricHostState('b')]
+        chosen = []
+        for i in range(4):
+            state = filters.select_host(states, self.properties)
+            state.consume('blessed', 2048)
+            chosen.append(state.host)
+        self.assertEquals(['a', 'b', 'a', 'b'], chosen)
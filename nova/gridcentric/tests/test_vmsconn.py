@@ -0,0 +1,353 @@
+# Copyright 2011 GridCentric Inc.
+# All Rights Reserved.
+#
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from nova import context
+from nova import exception
+from nova import flags
+
+import gridcentric.nova.extension.vmsconn as vmsconn
+
+FLAGS = flags.FLAGS
+
+TEMPLATE_XML = """<domain>
+  <name>instance-0000000a</name>
+  <uuid>11111111-1111-1111-1111-111111111111</uuid>
+  <devices>
+    <disk type="file"><source file="/instances/instance-0000000a/disk"/></disk>
+    <interface type="bridge">
+      <mac address="fa:16:3e:00:00:01"/>
+      <filterref filter="nova-instance-instance-0000000a-fa163e000001">
+        <parameter name="IP" value="10.0.0.2"/>
+        <parameter name="DHCPSERVER" value="10.0.0.1"/>
+      </filterref>
+    </interface>
+  </devices>
+</domain>"""
+
+def network_info(mac, ip):
+    return [({'bridge': 'br100'}, {'mac': mac, 'ips': [{'ip': ip}]})]
+
+class DomainTemplateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.template = vmsconn.DomainTemplate(TEMPLATE_XML,
+                                               {'name': 'instance-0000000a',
+                                                'uuid': '11111111-1111-1111-1111-111111111111'},
+                                               network_info('fa:16:3e:00:00:01', '10.0.0.2'),
+                                               None)
+
+    def test_render_patches_instance_fields(self):
+        xml = self.template.render({'name': 'instance-0000000b',
+                                    'uuid': '22222222-2222-2222-2222-222222222222'},
+                                   network_info('fa:16:3e:00:00:02', '10.0.0.25'))
+
+        self.assertTrue('<name>instance-0000000b</name>' in xml)
+        self.assertTrue('22222222-2222-2222-2222-222222222222' in xml)
+        self.assertTrue('/instances/instance-0000000b/disk' in xml)
+        self.assertTrue('fa:16:3e:00:00:02' in xml)
+        self.assertTrue('nova-instance-instance-0000000b-fa163e000002' in xml)
+        self.assertTrue('value="10.0.0.25"' in xml)
+        # Shared network values must be left alone.
+        self.assertTrue('value="10.0.0.1"' in xml)
+        self.assertFalse('instance-0000000a' in xml)
+
+    def test_render_with_different_vifs(self):
+        two_vifs = network_info('fa:16:3e:00:00:02', '10.0.0.3') + \
+                   network_info('fa:16:3e:00:00:03', '10.0.0.4')
+        self.assertEquals(None, self.template.render({'name': 'instance-0000000b',
+                                                      'uuid': '2222'}, two_vifs))
+
+class FakeLibvirtConnection(object):
+
+    def __init__(self, files):
+        self.files = files
+        self.created = 0
+
+    def legacy_nwinfo(self):
+        return False
+
+    def to_xml(self, instance, network_info, rescue, block_device_info=None):
+        return TEMPLATE_XML.replace('instance-0000000a', instance['name'])
+
+    def _create_image(self, context, instance, xml, network_info=None, block_device_info=None):
+        self.created += 1
+        working_dir = os.path.join(FLAGS.instances_path, instance['name'])
+        for path in self.files + ['console.log']:
+            with open(os.path.join(working_dir, path), 'w') as target:
+                target.write(instance['name'])
+        with open(os.path.join(working_dir, 'libvirt.xml'), 'w') as target:
+            target.write(xml)
+
+class PreLaunchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.instances_path = FLAGS.instances_path
+        FLAGS.instances_path = tempfile.mkdtemp()
+        FLAGS.gridcentric_cache_domain_templates = True
+        FLAGS.host = 'host'
+        self.check_command = vmsconn.utilities.check_command
+        vmsconn.utilities.check_command = self.run_command
+        self.vms_conn = vmsconn.LibvirtConnection()
+        self.vms_conn.openstack_uid = os.getuid()
+        self.vms_conn.openstack_gid = os.getgid()
+        self.vms_conn._reset_domain_templates()
+        self.context = context.RequestContext('fake', 'fake', True)
+
+    def tearDown(self):
+        shutil.rmtree(FLAGS.instances_path)
+        FLAGS.instances_path = self.instances_path
+        vmsconn.utilities.check_command = self.check_command
+
+    def run_command(self, command):
+        # Only the file creation matters here (not the users or permissions).
+        if 'mkdir' in command:
+            if not os.path.exists(command[-1]):
+                os.makedirs(command[-1])
+        elif 'touch' in command:
+            open(command[-1], 'w').close()
+
+    def launch(self, name, mac, ip, vifs=None):
+        instance_ref = vmsconn.AttribDictionary({'name': name, 'uuid': name + '-uuid'})
+        instance_ref.os_type = 'linux'
+        libvirt_file, _base = self.vms_conn.pre_launch(self.context, instance_ref,
+                                                       vifs or network_info(mac, ip),
+                                                       blessed_name='blessed')
+        with open(libvirt_file) as xml_file:
+            return xml_file.read()
+
+    def working_files(self, name):
+        return sorted(os.listdir(os.path.join(FLAGS.instances_path, name)))
+
+    def test_siblings_reuse_the_template(self):
+        self.vms_conn.libvirt_conn = FakeLibvirtConnection(['data'])
+        self.launch('instance-0000000a', 'fa:16:3e:00:00:01', '10.0.0.2')
+        xml = self.launch('instance-0000000b', 'fa:16:3e:00:00:02', '10.0.0.3')
+
+        self.assertEquals(1, self.vms_conn.libvirt_conn.created)
+        self.assertTrue('<name>instance-0000000b</name>' in xml)
+        self.assertFalse('instance-0000000a' in xml)
+        # The skeleton has the shared files, but not the per-instance ones.
+        self.assertEquals(['data', 'libvirt.xml'], self.working_files('instance-0000000b'))
+
+        # A sibling that the template cannot be patched for falls back to libvirt.
+        two_vifs = network_info('fa:16:3e:00:00:03', '10.0.0.4') + \
+                   network_info('fa:16:3e:00:00:04', '10.0.0.5')
+        xml = self.launch('instance-0000000c', None, None, vifs=two_vifs)
+        self.assertEquals(2, self.vms_conn.libvirt_conn.created)
+        self.assertTrue('<name>instance-0000000c</name>' in xml)
+
+    def test_templates_of_other_hosts_are_kept(self):
+        other_templates = os.path.join(FLAGS.instances_path, '_templates', 'other')
+        os.makedirs(other_templates)
+        self.vms_conn.libvirt_conn = FakeLibvirtConnection(['data'])
+        self.launch('instance-0000000a', 'fa:16:3e:00:00:01', '10.0.0.2')
+
+        # The service restarts and clears its own skeletons only.
+        restarted = vmsconn.LibvirtConnection()
+        restarted._reset_domain_templates()
+        self.assertTrue(os.path.exists(other_templates))
+        self.assertFalse(os.path.exists(self.vms_conn._template_root()))
+
+        # A template whose skeleton is gone is not used.
+        xml = self.launch('instance-0000000b', 'fa:16:3e:00:00:02', '10.0.0.3')
+        self.assertEquals(2, self.vms_conn.libvirt_conn.created)
+        self.assertTrue('<name>instance-0000000b</name>' in xml)
+
+    def test_instance_artifacts_are_not_shared(self):
+        self.vms_conn.libvirt_conn = FakeLibvirtConnection(['disk.config', 'kernel'])
+        self.launch('instance-0000000a', 'fa:16:3e:00:00:01', '10.0.0.2')
+        self.launch('instance-0000000b', 'fa:16:3e:00:00:02', '10.0.0.3')
+
+        self.assertEquals(2, self.vms_conn.libvirt_conn.created)
+        self.assertEquals({}, self.vms_conn.domain_templates)
+
+class FakeControl(object):
+
+    def __init__(self, network):
+        self.network = network
+        self.killed = False
+
+    def get(self, key):
+        return getattr(self, key)
+
+    def kill(self, timeout=None):
+        self.killed = True
+
+class MemoryServerRegistryTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.controls = [FakeControl("10.0.0.1:10"), FakeControl("10.0.0.1:1000")]
+        self.probe_count = 0
+        def probe():
+            self.probe_count += 1
+            return self.controls
+        self.real_probe = vmsconn.control.probe
+        vmsconn.control.probe = probe
+        self.registry = vmsconn.MemoryServerRegistry()
+
+    def tearDown(self):
+        vmsconn.control.probe = self.real_probe
+
+    def test_kill_registered_server(self):
+        self.registry.register("mcdist://10.0.0.1:1000", self.controls[1])
+        self.registry.kill("mcdist://10.0.0.1:1000")
+
+        self.assertEquals(0, self.probe_count)
+        self.assertTrue(self.controls[1].killed)
+        self.assertEquals(None, self.registry.lookup("mcdist://10.0.0.1:1000"))
+
+    def test_kill_unregistered_server(self):
+        # Servers started before a restart are found by probing.
+        self.registry.kill("mcdist://10.0.0.1:10")
+        self.assertEquals(1, self.probe_count)
+        self.assertTrue(self.controls[0].killed)
+        # A substring match would have hit this one as well.
+        self.assertFalse(self.controls[1].killed)
+
+    def test_register_from_pid(self):
+        controls = {10: self.controls[0], 1000: self.controls[1]}
+        def get_control(pid):
+            if pid not in controls:
+                raise vmsconn.control.ControlException()
+            return controls[pid]
+        real_control = getattr(vmsconn.control, 'Control', None)
+        vmsconn.control.Control = get_control
+        try:
+            vms_conn = vmsconn.VmsConnection()
+            vms_conn._register_memory_server("mcdist://10.0.0.1:1000", 1000)
+            # The pid has been reused by a process that is not the server.
+            vms_conn._register_memory_server("mcdist://10.0.0.1:20", 10)
+            vms_conn._register_memory_server("mcdist://10.0.0.1:30", 30)
+        finally:
+            if real_control == None:
+                del vmsconn.control.Control
+            else:
+                vmsconn.control.Control = real_control
+
+        self.assertTrue(vms_conn.memory_servers.lookup("mcdist://10.0.0.1:1000") is
+                        self.controls[1])
+        self.assertEquals(None, vms_conn.memory_servers.lookup("mcdist://10.0.0.1:20"))
+        self.assertEquals(None, vms_conn.memory_servers.lookup("mcdist://10.0.0.1:30"))
+        self.assertEquals(0, self.probe_count)
+
+    def test_release_last_reference(self):
+        self.registry.hold("mcdist://10.0.0.1:1000", 2, 60)
+        self.assertFalse(self.registry.release("mcdist://10.0.0.1:1000"))
+        self.assertTrue(self.registry.release("mcdist://10.0.0.1:1000"))
+        self.assertFalse(self.registry.release("mcdist://10.0.0.1:1000"))
+
+    def test_expired_servers(self):
+        self.registry.hold("mcdist://10.0.0.1:1000", 2, 60)
+        self.registry.hold("mcdist://10.0.0.1:10", 2, -1)
+        self.assertEquals(["10.0.0.1:10"], self.registry.expired())
+        self.assertEquals([], self.registry.expired())
+
+class SimulatedConnectionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        FLAGS.gridcentric_sim_latency = []
+        FLAGS.gridcentric_sim_host_memory_mb = 1024
+        FLAGS.gridcentric_sim_shared_ratio = 0.75
+        FLAGS.gridcentric_sim_path = tempfile.mkdtemp()
+        self.vms_conn = vmsconn.SimulatedConnection()
+        self.vms_conn.configure()
+        self.context = context.RequestContext('fake', 'fake', True)
+
+    def tearDown(self):
+        shutil.rmtree(FLAGS.gridcentric_sim_path)
+
+    def launch(self, name, target="0"):
+        self.vms_conn.launch(self.context, 'blessed', target,
+                             {'name': name, 'memory_mb': 512}, None)
+
+    def test_bless_writes_artifacts(self):
+        name, url, files = self.vms_conn.bless(self.context, 'source',
+                                               {'name': 'blessed', 'memory_mb': 512})
+        self.assertEquals(2, len(files))
+        self.assertEquals(512 << 20, os.path.getsize(files[1]))
+
+        self.vms_conn.discard(self.context, 'blessed')
+        self.assertFalse(os.path.exists(files[0]))
+
+    def test_launch_goes_through_pre_launch(self):
+        simulated = []
+        simulate = self.vms_conn._simulate
+        def record(command):
+            simulated.append(command)
+            simulate(command)
+        self.vms_conn._simulate = record
+
+        FLAGS.gridcentric_cache_domain_templates = True
+        result = self.vms_conn.launch(self.context, 'blessed', "0",
+                                      {'name': 'clone-1', 'memory_mb': 512}, None,
+                                      use_image_service=True)
+        self.assertEquals('clone-1', result)
+        self.assertTrue(os.path.exists(os.path.join(FLAGS.gridcentric_sim_path,
+                                                    'instances', 'clone-1', 'libvirt.xml')))
+        self.launch('clone-2')
+        # Only the first clone fetches the artifacts and generates the domain.
+        self.assertEquals(['fetch', 'domain', 'launch', 'template', 'launch'], simulated)
+
+        self.vms_conn.destroy('clone-1')
+        self.assertFalse(os.path.exists(os.path.join(FLAGS.gridcentric_sim_path,
+                                                     'instances', 'clone-1')))
+
+    def test_clones_share_memory(self):
+        # The first clone brings in the shared memory (384MB) and each clone
+        # then uses 128MB on its own.
+        self.launch('clone-1')
+        self.assertEquals(512, self.vms_conn.memory_used())
+        self.launch('clone-2')
+        self.assertEquals(640, self.vms_conn.memory_used())
+        self.launch('clone-3', target=str(16 << 8))
+        self.assertEquals(656, self.vms_conn.memory_used())
+
+        for name in ['clone-1', 'clone-2', 'clone-3']:
+            self.vms_conn.destroy(name)
+        self.assertEquals(0, self.vms_conn.memory_used())
+
+    def test_launch_without_memory(self):
+        for i in range(5):
+            self.launch('clone-%d' % i)
+        self.assertRaises(exception.Error, self.launch, 'clone-5')
+
+    def test_launch_from_memory_server(self):
+        memory_url = self.vms_conn.serve(self.context, 'blessed', 'mcdist://10.0.0.1')
+        self.vms_conn.launch(self.context, 'blessed', "0",
+                             {'name': 'clone-1', 'memory_mb': 512}, None,
+                             memory_url=memory_url)
+        self.vms_conn.stop_serving(memory_url)
+        self.assertRaises(exception.Error, self.vms_conn.launch, self.context, 'blessed', "0",
+                          {'name': 'clone-2', 'memory_mb': 512}, None, memory_url=memory_url)
+
+    def test_host_memory_stats(self):
+        self.launch('clone-1')
+        self.launch('clone-2')
+        self.vms_conn.serve(self.context, 'blessed', 'mcdist://10.0.0.1')
+        self.assertEquals({'total_mb': 1024, 'free_mb': 384},
+                          self.vms_conn.host_memory_stats())
+        self.assertEquals(set(['clone-1', 'clone-2']), set(self.vms_conn.list_instances()))
+        self.assertEquals(128, self.vms_conn.working_set_mb('clone-1'))
+        self.assertEquals(1, self.vms_conn.count_memory_servers())
+
+    def test_injected_failure(self):
+        self.vms_conn.inject_failure('launch')
+        self.assertRaises(exception.Error, self.launch, 'clone-1')
+        self.launch('clone-1')
@@ -18,6 +18,9 @@ An extension module for novaclient that allows the `nova` application access to
 API extensions.
 """
 
+import sys
+import time
+
 from novaclient import utils
 from novaclient.v1_1 import servers
 from novaclient.v1_1 import shell
@@ -33,8 +36,13 @@ def __post_parse_args__(args):
 @utils.arg('blessed_id', metavar='<blessed id>', help="ID of the blessed instance")
 @utils.arg('--target', metavar='<target memory>', default='0', help="The memory target of the launched instance")
 @utils.arg('--params', action='append', default=[], metavar='<key=value>', help='Guest parameters to send to vms-agent')
+@utils.arg('--count', metavar='<count>', type=int, default=1, help="The number of instances to launch")
+@utils.arg('--wait', action='store_true', default=False,
+           help="Wait until all of the launched instances are active (or have failed)")
+@utils.arg('--poll-interval', dest='poll_interval', metavar='<seconds>', type=float, default=2.0,
+           help="The time between status checks when waiting")
 def do_launch(cs, args):
-    """Launch a new instance."""
+    """Launch new instances."""
     server = cs.gridcentric.get(args.blessed_id)
     guest_params = {}
     for param in args.params:
@@ -44,10 +52,67 @@ def do_launch(cs, args):
 
     launch_servers = cs.gridcentric.launch(server,
                                            target=args.target,
-                                           guest_params=guest_params)
-
-    for server in launch_servers:
-        shell._print_server(cs, server)
+                                           guest_params=guest_params,
+                                           count=args.count)
+    # Servers that do not know about the count launch a single instance.
+    for i in range(args.count - len(launch_servers)):
+        launched = cs.gridcentric.launch(server,
+                                         target=args.target,
+                                         guest_params=guest_params)
+        if not launched:
+            sys.stderr.write("Only %d of %d instances were launched.\n" %
+                             (len(launch_servers), args.count))
+            break
+        launch_servers += launched
+
+    if args.wait:
+        launch_servers = _wait_for_launched(cs, server, launch_servers, args.poll_interval)
+    _print_server_table(cs, launch_servers)
+
+def _wait_for_launched(cs, blessed, launched, interval):
+    """
+    Waits until none of the launched servers are building. Each poll lists
+    all of the servers launched from blessed at once.
+    """
+    servers = dict([(server.id, server) for server in launched])
+    pending = set(servers.keys())
+    while pending:
+        time.sleep(interval)
+        current = dict([(server.id, server) for server in cs.gridcentric.list_launched(blessed)])
+        for server_id in list(pending):
+            server = current.get(server_id)
+            if server == None:
+                # The server has been deleted in the meantime.
+                pending.discard(server_id)
+            else:
+                servers[server_id] = server
+                if server.status in ('ACTIVE', 'ERROR'):
+                    pending.discard(server_id)
+        sys.stderr.write("\rWaiting for %d of %d instances..." % (len(pending), len(servers)))
+        sys.stderr.flush()
+    sys.stderr.write("\n")
+    return [servers[server.id] for server in launched]
+
+def _print_server_table(cs, servers):
+    """ Prints the servers as one table, looking up each flavor and image only once. """
+    flavors = {}
+    images = {}
+    def lookup(cache, find, resource):
+        resource_id = (resource or {}).get('id', '')
+        if resource_id not in cache:
+            try:
+                cache[resource_id] = find(cs, resource_id).name
+            except Exception:
+                cache[resource_id] = resource_id
+        return cache[resource_id]
+
+    columns = ['ID', 'Name', 'Status', 'Flavor', 'Image', 'Networks']
+    formatters = {'Flavor': lambda server: lookup(flavors, shell._find_flavor,
+                                                  getattr(server, 'flavor', None)),
+                  'Image': lambda server: lookup(images, shell._find_image,
+                                                 getattr(server, 'image', None)),
+                  'Networks': utils._format_servers_list_networks}
+    utils.print_list(servers, columns, formatters)
 
 @utils.arg('server_id', metavar='<instance id>', help="ID of the instance to bless")
 def do_bless(cs, args):
@@ -206,8 +271,8 @@ class GcServer(servers.Server):
     """
     A server object extended to provide gridcentric capabilities
     """
-    def launch(self, target="0", guest_params={}):
-        return self.manager.launch(self, target, guest_params)
+    def launch(self, target="0", guest_params={}, count=1):
+        return self.manager.launch(self, target, guest_params, count)
 
     def bless(self):
         return self.manager.bless(self)
@@ -227,16 +292,24 @@ class GcServer(servers.Server):
 class GcServerManager(servers.ServerManager):
     resource_class = GcServer
 
-    def launch(self, server, target="0", guest_params={}):
-        header, info = self._action("gc_launch",
-                                   server,
-                                   {'target': target,
-                                    'guest': guest_params})
-        return [self.get(server['id']) for server in info]
+    def _servers(self, info):
+        # The actions return the full servers, so there is no need to get
+        # each one again. Any missing attribute is loaded lazily on access.
+        return [self.resource_class(self, server) for server in info]
+
+    def launch(self, server, target="0", guest_params={}, count=1):
+        params = {'target': target,
+                  'guest': guest_params}
+        if count > 1:
+            # The clones are all created by one request and launched
+            # concurrently by the gridcentric service.
+            params['count'] = count
+        header, info = self._action("gc_launch", server, params)
+        return self._servers(info)
 
     def bless(self, server):
         header, info = self._action("gc_bless", server)
-        return [self.get(server['id']) for server in info]
+        return self._servers(info)
 
     def discard(self, server):
         return self._action("gc_discard", server)
@@ -246,11 +319,11 @@ class GcServerManager(servers.ServerManager):
 
     def list_launched(self, server):
         header, info = self._action("gc_list_launched", server)
-        return [self.get(server['id']) for server in info]
+        return self._servers(info)
 
     def list_blessed(self, server):
         header, info = self._action("gc_list_blessed", server)
-        return [self.get(server['id']) for server in info]
+        return self._servers(info)
 
     def create(self, name, image, flavor, meta=None, files=None,
                reservation_id=None, min_count=None,
@@ -26,7 +26,7 @@ if PACKAGE == 'all' or PACKAGE == 'nova-gridcentric':
           author='GridCentric',
           author_email='support@gridcentric.com',
           url='http://www.gridcentric.com/',
-          packages=['gridcentric.nova'])
+          packages=['gridcentric.nova', 'gridcentric.nova.scheduler'])
 
 if PACKAGE == 'all' or PACKAGE == 'nova-compute-gridcentric':
     setup(name='nova-compute-gridcentric',